@@ -9,8 +9,32 @@ import queue
 import signal
 import random
 import datetime
+import collections
+import asyncio
+import mmap
+import struct
+import bisect
+import array
+import json
+import csv
+import io
+import platform
+import heapq
+import threading
+import http.server
+import socketserver
+import stat
+import cProfile
+import multiprocessing
+import contextlib
+import traceback
 from typing import Union, Sequence, Any
 
+try:
+    import numpy    # optional (see SydpowerModbus.decode_batch)
+except ImportError:
+    numpy = None
+
 #
 # modbus_values is a list[int] but where some values can be replaced by their symbolic equivalent, so a str.
 #
@@ -98,54 +122,149 @@ NAMED_HOLDING_REGISTERS = {
 }
 
 
-# Provide the full mapping between holding register names and indices 
-HREG_INDEX_TO_NAME = { x: (NAMED_HOLDING_REGISTERS.get(x,'h{:02d}'.format(x))) for x in range(HREG_COUNT) }
-HREG_NAME_TO_INDEX = { v: k for k, v in HREG_INDEX_TO_NAME.items() }
-
-# Provide the full mapping between input register names and indices 
-IREG_INDEX_TO_NAME : dict[int,str] = { x: (NAMED_INPUT_REGISTERS.get(x,'i{:02d}'.format(x))) for x in range(IREG_COUNT) }
-IREG_NAME_TO_INDEX = { v: k for k, v in IREG_INDEX_TO_NAME.items() }
-
-# Prefined sets of holding register names
-HREG_SETS={} 
-HREG_SETS['hALL']   = set( HREG_NAME_TO_INDEX.keys() )
-HREG_SETS['hNAMED'] = set( NAMED_HOLDING_REGISTERS.values() )
-HREG_SETS['hOTHER'] = HREG_SETS['hALL'].difference(HREG_SETS['hNAMED']) 
-HREG_SETS['hUSB']   = set( [ 'hUsbOutputSwitch',
-                             'hUsbStandbyTime',
-                            ] )
-HREG_SETS['hAC']   = set( [ 'hAcChargingRate',
-                            'hAcOutputSwitch',
-                            'hAcSilentCharging',
-                            'hAcStandbyTime',
-                            'hAcChargingBooking',
-                            'hAcChargingUpperLimit',
-                           ] )
-
-
-# Prefined sets of mappig register names
-IREG_SETS={} 
-IREG_SETS['iALL']   = set( IREG_NAME_TO_INDEX.keys() )
-IREG_SETS['iNAMED'] = set( NAMED_INPUT_REGISTERS.values() )
-IREG_SETS['iOTHER'] = IREG_SETS['iALL'].difference(IREG_SETS['iNAMED']) 
-IREG_SETS['iUSB']   = set( [ 'iStatusBits',
-                             'iUsbOutputPower1',
-                             'iUsbOutputPower2',
-                             'iUsbOutputPower3',
-                             'iUsbOutputPower4',
-                             'iUsbOutputPower5',
-                             'iUsbOutputPower6',
-                            ] )
-IREG_SETS['iAC']   = set( [ 'iStatusBits',
-                            'iAcOutputVoltage',
-                            'iAcOutputFreq',
-                            'iAcOutputPower',
-                            'iAcChargingBooking',
-                            'iAcInputVoltage',
-                            'iAcInputFreq' ])
+#
+# The register groups (in addition to ALL, NAMED and OTHER). A group G
+# provides the names iG, hG and G for its input, holding or both registers.
+#
+REGISTER_GROUPS = {
+    'USB' : [ 'iStatusBits',
+              'iUsbOutputPower1',
+              'iUsbOutputPower2',
+              'iUsbOutputPower3',
+              'iUsbOutputPower4',
+              'iUsbOutputPower5',
+              'iUsbOutputPower6',
+              'hUsbOutputSwitch',
+              'hUsbStandbyTime',
+             ],
+    'AC'  : [ 'iStatusBits',
+              'iAcOutputVoltage',
+              'iAcOutputFreq',
+              'iAcOutputPower',
+              'iAcChargingBooking',
+              'iAcInputVoltage',
+              'iAcInputFreq',
+              'hAcChargingRate',
+              'hAcOutputSwitch',
+              'hAcSilentCharging',
+              'hAcStandbyTime',
+              'hAcChargingBooking',
+              'hAcChargingUpperLimit',
+             ],
+}
+
+
+#
+# The values accepted by the set command for the writable holding registers
+# (see MQTT-MODBUS.md). Registers that are not listed cannot be written.
+#
+# CAUTION: Setting hWholeMachineUnusedTime to zero is known to brick the device. 
+#
+HREG_ALLOWED_VALUES = {
+    'hUsbOutputSwitch'        : range(0, 2),
+    'hDcOutputSwitch'         : range(0, 2),
+    'hAcOutputSwitch'         : range(0, 2),
+    'hLedControl'             : range(0, 4),
+    'hKeySound'               : range(0, 2),
+    'hAcSilentCharging'       : range(0, 2),
+    'hAcChargingBooking'      : range(0, 24*60),
+    'hDischargeLowerLimit'    : range(0, 501),
+    'hAcChargingUpperLimit'   : range(600, 1001),
+    'hWholeMachineUnusedTime' : (5, 10, 30, 480),
+}
+
+
+#
+# The physical quantity of some named registers:
+#   name: (device_class, unit, scale)
+#
+# The value is the register value multiplied by scale. The device class is
+# the one of Home Assistant sensors (or None).
+# 
+REGISTER_UNITS = {
+    'iChargingPower'     : ('power', 'W', 1),
+    'iDcInputPower'      : ('power', 'W', 1),
+    'iTotalInputPower'   : ('power', 'W', 1),
+    'iDcOuputPower1'     : ('power', 'W', 1),
+    'iAcOutputVoltage'   : ('voltage', 'V', 0.1),
+    'iAcOutputFreq'      : ('frequency', 'Hz', 0.1),
+    'iAcOutputPower'     : ('power', 'W', 1),
+    'iAcInputVoltage'    : ('voltage', 'V', 0.1),
+    'iAcInputFreq'       : ('frequency', 'Hz', 0.1),
+    'iUsbOutputPower1'   : ('power', 'W', 1),
+    'iUsbOutputPower2'   : ('power', 'W', 1),
+    'iUsbOutputPower3'   : ('power', 'W', 1),
+    'iUsbOutputPower4'   : ('power', 'W', 1),
+    'iUsbOutputPower5'   : ('power', 'W', 1),
+    'iUsbOutputPower6'   : ('power', 'W', 1),
+    'iTotalOutputPower'  : ('power', 'W', 1),
+    'iSOC1'              : ('battery', '%', 0.1),
+    'iSOC2'              : ('battery', '%', 0.1),
+    'iSOC'               : ('battery', '%', 0.1),
+    'iAcChargingBooking' : ('duration', 'min', 1),
+    'iTimeToFull'        : ('duration', 'min', 1),
+    'iTimeToEmpty'       : ('duration', 'min', 1),
+}
+
+# The registers containing a signed 16 bit integer
+REGISTER_SIGNED : set[str] = set()
+
+#
+# The known bits of the bitfield registers:
+#   name: { bit: (letter, flag, description) }
+#
+# The letter is displayed when the bit is set (see compile_bitfield_formatter)
+# and the flag is a short name (e.g. for metric labels). 
+#
+REGISTER_BITS = {
+    'iStatusBits' : {
+        12: ('L', 'led',          'Front LED panel is enabled'),
+        11: ('A', 'ac_output',    'AC ouput is enabled'),
+        10: ('D', 'dc_output',    'DC output is enabled'),
+        9:  ('U', 'usb_output',   'USB output is enabled'),
+        7:  ('X', 'dc_converter', 'Set when LED, DC, or USB is enabled'),
+        4:  ('C', 'ac_charging',  'Charging from AC'),
+        3:  ('a', 'ac_input',     'AC input is connected'),
+        2:  ('A', 'ac_output_2',  'Always identical to bit 11?'),
+        1:  ('a', 'ac_input_2',   'Always identical to bit 3?'),
+    },
+}
+
+# The name of the model described by the tables above (see RegisterSchema) 
+REGISTER_MODEL = 'builtin'
+
+#
+# The tables below are derived from the tables above by RegisterSchema.install()
+#
+
+# The full mapping between holding register names and indices 
+HREG_INDEX_TO_NAME : dict[int,str] = {}
+HREG_NAME_TO_INDEX : dict[str,int] = {}
+
+# The full mapping between input register names and indices 
+IREG_INDEX_TO_NAME : dict[int,str] = {}
+IREG_NAME_TO_INDEX : dict[str,int] = {}
 
+# Predefined sets of holding and input register names: hALL, hNAMED, hOTHER
+# and hG for each group G (and the same with the 'i' prefix)
+HREG_SETS : dict[str,set[str]] = {}
+IREG_SETS : dict[str,set[str]] = {}
 
+# The flags of the known bits of iStatusBits indexed by bit 
+STATUS_BIT_FLAGS : dict[int,str] = {}
+
+#
+# Entries in that dictionary specify a function to format the
+# register values. The index is the register name while the value is 
+# a callable that expects a single integer as argument.
+#
+# The result shall be a string
+#
+FORMATTER = {}
 
+# The formatters displaying the physical value of the scaled and signed
+# registers (see enable_scaled_formatters)
+SCALED_FORMATTER = {}
 
 
 def format_dec(v:int):
@@ -157,63 +276,285 @@ def format_dec_hex(v:int):
 def format_dec_hex_bin(v:int):
     return "{:<5d} = 0x{:04x} = {:08b}:{:08b}".format(v,v,(v>>8)&0xFF,v&0xFF)
 
-def format_iStatusBits(v:int):
-
-    # L = bit 12 = Front LED panel is enabled 
-    # A = bit 11 = AC ouput is enabled 
-    # D = bit 10 = DC output is enabled
-    # U = bit 9  = USB output is enabled
-    # X = bit 7  = Set when LED, DC, or USB is enabled
-    # C = bit 4  = Charging from AC
-    # a = bit 3  = AC input is connected  
-    # A = bit 2  = Always identical to bit 11?
-    # a = bit 1  = Always identical to bit 3?
-    #
-    # Other bits marked as '?' are currently unknown.
-    #
-    
-    on  = '???LADU?X??CaAa?'
-    off = '----------------'
+#
+# Create a formatter for a bitfield register whose known bits are given as
+# in REGISTER_BITS. Each bit is displayed by its letter when set, by '?' when
+# set but unknown and by '-' when not set. 
+#
+# The letters of all possible values of the high and low bytes are computed
+# once so formatting a value only takes two table lookups.
+#
+def compile_bitfield_formatter(bits:dict):
+    def letters(byte:int, base:int) -> str:
+        text = ''
+        for i in range(7, -1, -1):
+            if (byte >> i) & 1:
+                text += bits[base+i][0] if base+i in bits else '?'
+            else:
+                text += '-'
+        return text[0:4] + ' ' + text[4:8]
+    high = [ letters(byte, 8) for byte in range(256) ]
+    low  = [ letters(byte, 0) for byte in range(256) ]
+    def format_bitfield(v:int):
+        return "{:<5d} = 0x{:04x} = {} {}".format(v, v, high[v>>8], low[v&0xFF])
+    return format_bitfield
 
-    bits=''
-    for i in range(16):
-        if (v>>i)&1 :
-            bits = on[15-i] + bits
-        else:
-            bits = off[15-i] + bits
-    return "{:<5d} = 0x{:04x} = {} {} {} {}".format(v,v,bits[0:4],bits[4:8],bits[8:12],bits[12:16])
+# Create a formatter displaying the value of a scaled or signed register
+def compile_scaled_formatter(scale:float, unit:str, signed:bool):
+    suffix = ' '+unit if unit else ''
+    def format_scaled(v:int):
+        x = v - 0x10000 if signed and v & 0x8000 else v
+        return "{:<5d} = {:g}{}".format(v, x*scale, suffix)
+    return format_scaled
 
 def help_iStatusBits():
     print("The content of iStatusBits is currently interpreted as follow:")
-    print("  L = bit 12 = Front LED panel is enabled")
-    print("  A = bit 11 = AC ouput is enabled")
-    print("  D = bit 10 = DC output is enabled")
-    print("  U = bit 9  = USB output is enabled")
-    print("  X = bit 7  = Set when LED, DC, or USB is enabled")
-    print("  C = bit 4  = Charging from AC")
-    print("  a = bit 3  = AC input is connected")
-    print("  A = bit 2  = Always identical to bit 11?")
-    print("  a = bit 1  = Always identical to bit 3?")
+    for bit, (letter, flag, description) in sorted(REGISTER_BITS.get('iStatusBits', {}).items(), reverse=True):
+        print("  {} = bit {:<2d} = {}".format(letter, bit, description))
     print("Other bits are unknown and will be marked with '?' when set")
-    
-    
-# Entries in that dictionary specify a function to format the
-# register values. The index is the register name while the value is 
-# a callable that expects a single integer as argument.
+
+
 #
-# The result shall be a string
+# The register tables can be replaced by a schema describing another model
+# (see --model). That is a JSON file of the form
 #
-FORMATTER = {
-    'iStatusBits' : format_iStatusBits
-}
+#  { "model": "NAME",
+#    "registers": [ { "name": "iAcOutputVoltage", "index": 18,
+#                     "unit": "V", "scale": 0.1, "device_class": "voltage" },
+#                   { "name": "iStatusBits", "index": 41,
+#                     "bits": [ { "bit": 12, "letter": "L", "flag": "led",
+#                                 "description": "Front LED panel is enabled" },
+#                               ... ] },
+#                   { "name": "hKeySound", "index": 56, "writable": [ 0, 1 ] },
+#                   { "name": "hAcChargingBooking", "index": 63,
+#                     "writable": { "min": 0, "max": 1439 } },
+#                   { "name": "iSomething", "index": 70, "signed": true },
+#                   ... ],
+#    "groups": { "USB": [ "iStatusBits", "hUsbOutputSwitch", ... ], ... } }
+#
+# where the bank of each register is given by the first letter of its name.
+# All fields except 'name' and 'index' are optional. 
+#
+# Use the schema command to obtain the schema of the builtin tables. 
+#
+
+# Return the schema of the current register tables
+def schema_from_tables() -> dict:
+    registers = []
+    for named in [ NAMED_INPUT_REGISTERS, NAMED_HOLDING_REGISTERS ]:
+        for index, name in sorted(named.items()):
+            entry = { 'name': name, 'index': index }
+            if name in REGISTER_UNITS:
+                device_class, unit, scale = REGISTER_UNITS[name]
+                entry.update(unit=unit, scale=scale, device_class=device_class)
+            if name in REGISTER_SIGNED:
+                entry['signed'] = True
+            if name in REGISTER_BITS:
+                entry['bits'] = [ { 'bit': bit, 'letter': letter, 'flag': flag, 'description': description }
+                                  for bit, (letter, flag, description) in sorted(REGISTER_BITS[name].items(), reverse=True) ]
+            allowed = HREG_ALLOWED_VALUES.get(name)
+            if type(allowed) is range:
+                entry['writable'] = { 'min': allowed.start, 'max': allowed.stop-1 }
+            elif allowed is not None:
+                entry['writable'] = list(allowed)
+            registers.append(entry)
+    return { 'model': REGISTER_MODEL,
+             'registers': registers,
+             'groups': { group: list(members) for group, members in REGISTER_GROUPS.items() } }
+
+
+#
+# A register schema (see above) compiled into the register tables.
+#
+# The constructor raises ValueError if the schema is invalid. Use install()
+# to replace the current register tables. 
+#
+class RegisterSchema:
+
+    def __init__(self, schema:dict):
+        try:
+            self._compile(schema)
+        except (KeyError, TypeError, AttributeError) as err:
+            raise ValueError("malformed schema ({})".format(repr(err)))
+        
+    def _compile(self, schema:dict):
+        self.model = str(schema.get('model', 'unknown'))
+        self.named : dict[str,dict[int,str]] = { 'i': {}, 'h': {} }
+        self.units = {}
+        self.signed = set()
+        self.bits = {}
+        self.allowed = {}
+        self.groups = {}
+
+        for entry in schema['registers']:
+            name  = entry['name']
+            index = entry['index']
+            if type(name) is not str or len(name) < 2 or name[0] not in 'ih':
+                raise ValueError("invalid register name {}".format(json.dumps(name)))
+            count = IREG_COUNT if name[0] == 'i' else HREG_COUNT
+            if type(index) is not int or not 0 <= index < count:
+                raise ValueError("invalid index {} for {}".format(json.dumps(index), name))
+            if index in self.named[name[0]]:
+                raise ValueError("{} and {} have the same index".format(self.named[name[0]][index], name))
+            self.named[name[0]][index] = name
+            if 'unit' in entry or 'scale' in entry or 'device_class' in entry:
+                self.units[name] = ( entry.get('device_class'), entry.get('unit', ''), entry.get('scale', 1) )
+            if entry.get('signed'):
+                self.signed.add(name)
+            if 'bits' in entry:
+                bits = {}
+                for field in entry['bits']:
+                    bit = field['bit']
+                    if type(bit) is not int or not 0 <= bit < 16:
+                        raise ValueError("invalid bit {} in {}".format(json.dumps(bit), name))
+                    bits[bit] = ( field.get('letter', '?')[:1], field.get('flag', 'bit{}'.format(bit)), field.get('description', '') )
+                self.bits[name] = bits
+            writable = entry.get('writable')
+            if writable is not None:
+                if name[0] != 'h':
+                    raise ValueError("input register {} cannot be writable".format(name))
+                if type(writable) is dict:
+                    self.allowed[name] = range(writable['min'], writable['max']+1)
+                else:
+                    self.allowed[name] = tuple( int(x) for x in writable )
+
+        all_names = set()
+        for prefix, count in [ ('i', IREG_COUNT), ('h', HREG_COUNT) ]:
+            names = set( self.named[prefix].get(x, '{}{:02d}'.format(prefix, x)) for x in range(count) )
+            if len(names) != count:
+                raise ValueError("a register name is also the default name of another register") 
+            all_names |= names
+            
+        for group, members in schema.get('groups', {}).items():
+            if group in [ 'ALL', 'NAMED', 'OTHER' ]:
+                raise ValueError("reserved group name {}".format(group))
+            for name in members:
+                if name not in all_names:
+                    raise ValueError("unknown register {} in group {}".format(name, group))
+            self.groups[group] = list(members)
+
+    # Replace the content of the current register tables
+    def install(self):
+        global REGISTER_MODEL
+        REGISTER_MODEL = self.model
+        for prefix, count, named, index_to_name, name_to_index, sets in [
+                ('i', IREG_COUNT, NAMED_INPUT_REGISTERS, IREG_INDEX_TO_NAME, IREG_NAME_TO_INDEX, IREG_SETS),
+                ('h', HREG_COUNT, NAMED_HOLDING_REGISTERS, HREG_INDEX_TO_NAME, HREG_NAME_TO_INDEX, HREG_SETS) ]:
+            named.clear()
+            named.update(self.named[prefix])
+            index_to_name.clear()
+            index_to_name.update( (x, named.get(x, '{}{:02d}'.format(prefix, x))) for x in range(count) )
+            name_to_index.clear()
+            name_to_index.update( (v, k) for k, v in index_to_name.items() )
+            sets.clear()
+            sets[prefix+'ALL']   = set(name_to_index)
+            sets[prefix+'NAMED'] = set(named.values())
+            sets[prefix+'OTHER'] = sets[prefix+'ALL'].difference(sets[prefix+'NAMED'])
+            for group, members in self.groups.items():
+                sets[prefix+group] = set( name for name in members if name[0] == prefix )
+
+        for table, content in [ (REGISTER_GROUPS, self.groups),
+                                (REGISTER_UNITS, self.units),
+                                (REGISTER_BITS, self.bits),
+                                (HREG_ALLOWED_VALUES, self.allowed) ]:
+            table.clear()
+            table.update(content)
+        REGISTER_SIGNED.clear()
+        REGISTER_SIGNED.update(self.signed)
+        STATUS_BIT_FLAGS.clear()
+        STATUS_BIT_FLAGS.update( (bit, flag) for bit, (letter, flag, description) in self.bits.get('iStatusBits', {}).items() )
+
+        FORMATTER.clear()
+        for name in HREG_SETS['hOTHER'] | IREG_SETS['iOTHER']:
+            FORMATTER[name] = format_dec_hex
+        SCALED_FORMATTER.clear()
+        for name in set(self.units) | self.signed:
+            device_class, unit, scale = self.units.get(name, (None, '', 1))
+            if scale != 1 or name in self.signed:
+                SCALED_FORMATTER[name] = compile_scaled_formatter(scale, unit, name in self.signed)
+        for name, bits in self.bits.items():
+            FORMATTER[name] = compile_bitfield_formatter(bits)
+
+            
+# Display the physical value of the scaled and signed registers in the text
+# output, e.g. 'iAcOutputVoltage = 2302  = 230.2 V' (option --units)
+def enable_scaled_formatters():
+    FORMATTER.update(SCALED_FORMATTER)
+
+            
+# Build the derived tables of the builtin model
+RegisterSchema(schema_from_tables()).install()
+
+# The directory of the schemas of the known models
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+
+#
+# Load the schema of a model given either as a JSON file or as the name of
+# a file NAME.json in MODELS_DIR.
+#
+def load_schema(model:str) -> RegisterSchema:
+    path = model
+    if not os.path.exists(path):
+        path = os.path.join(MODELS_DIR, model+'.json')
+    try:
+        with open(path) as file:
+            return RegisterSchema(json.load(file))
+    except OSError as err:
+        print("Error: Cannot read the schema of model '{}': {}".format(model, err.strerror))
+        sys.exit(1)
+    except ValueError as err:
+        print("Error: Invalid schema '{}': {}".format(path, err))
+        sys.exit(1)
+
+
+# Format a time (default now) as [ISO-8601]
+def timestamp(t:float|None=None):
+    if t is None:
+        return "["+datetime.datetime.now().isoformat()+"]"
+    return "["+datetime.datetime.fromtimestamp(t).isoformat()+"]"
 
-for i in HREG_SETS['hOTHER'] | IREG_SETS['iOTHER']:
-    if i not in FORMATTER:
-        FORMATTER[i] = format_dec_hex
+# Return an integer with the 16 bits 16*i..16*i+15 set for each register index i 
+def register_mask(indices) -> int:
+    mask = 0
+    for i in indices:
+        mask |= 0xFFFF << (16*i)
+    return mask
 
+#
+# The estimated cost of a read request expressed as a number of registers.
+#
+# Each request costs a round-trip to the device and about 80 bytes of
+# MQTT topics and MODBUS headers while each additional register only costs
+# 2 bytes in the response. 
+# 
+READ_REQUEST_COST = 40
 
-def timestamp():
-    return "["+datetime.datetime.now().isoformat()+"]"
+#
+# Compute the cheapest list of (start, count) ranges covering all given
+# register indices where the cost of a range is request_cost plus its
+# number of registers. 
+#
+def plan_register_reads(indices, request_cost:int=READ_REQUEST_COST) -> list[tuple[int,int]]:
+    indices = sorted(set(indices))
+    n = len(indices)
+    # best[j] is the cost of the cheapest plan for the first j indices and
+    # first[j] is the position of the first index of the last range of that plan.
+    best  = [ 0 ] + [ None ] * n
+    first = [ 0 ] * (n+1)
+    for j in range(1, n+1):
+        for i in range(j):
+            cost = best[i] + request_cost + indices[j-1] - indices[i] + 1
+            if best[j] is None or cost < best[j]:
+                best[j]  = cost
+                first[j] = i
+    ranges = []
+    j = n
+    while j > 0:
+        i = first[j]
+        ranges.append( (indices[i], indices[j-1] - indices[i] + 1) )
+        j = i
+    ranges.reverse()
+    return ranges
 
 def hreg_index_to_name(index: int):
      return HREG_INDEX_TO_NAME.get(index)
@@ -253,8 +594,8 @@ def help_register_names():
     print(" - iALL,   hALL,   ALL   : all input, holding or both registers")
     print(" - iNAMED, hNAMED, NAMED : all named input, holding or both registers")
     print(" - iOTHER, hOTHER, OTHER : all unnamed input, holding or both registers")
-    print(" - iUSB,   hUSB,   USB   : all USB input, holding or both registers")
-    print(" - iAC,    hAC,    AC    : all AC input, holding or both registers")
+    for group in REGISTER_GROUPS:
+        print(" - {:<8}{:<8}{:<6}: all {} input, holding or both registers".format('i'+group+',', 'h'+group+',', group, group))
     print()
 
 #
@@ -277,21 +618,10 @@ def parse_register_names(names:list):
             holdings.update(HREG_SETS[name])
         elif name in IREG_SETS:            
             inputs.update(IREG_SETS[name])
-        elif name=='ALL':
-            holdings.update(HREG_SETS['hALL'])
-            inputs.update(IREG_SETS['iALL'])
-        elif name=='NAMED':
-            holdings.update(HREG_SETS['hNAMED'])
-            inputs.update(IREG_SETS['iNAMED'])
-        elif name=='OTHER':
-            holdings.update(HREG_SETS['hOTHER'])
-            inputs.update(IREG_SETS['iOTHER'])
-        elif name=='USB':
-            holdings.update(HREG_SETS['hUSB'])
-            inputs.update(IREG_SETS['iUSB'])            
-        elif name=='AC':
-            holdings.update(HREG_SETS['hAC'])
-            inputs.update(IREG_SETS['iAC'])            
+        elif 'h'+name in HREG_SETS:
+            # ALL, NAMED, OTHER or a group in REGISTER_GROUPS 
+            holdings.update(HREG_SETS['h'+name])
+            inputs.update(IREG_SETS['i'+name])
         else:            
             print("Error: Unknown register '"+name+"'")
             sys.exit(1)
@@ -302,6 +632,155 @@ def parse_register_names(names:list):
     return inputs, holdings
 
 
+#
+# Parse a list of NAME=VALUE assignments of holding registers and return
+# a list of (index,value). 
+#
+# The values are checked against HREG_ALLOWED_VALUES.
+#
+def parse_holding_assignments(assignments:list[str]) -> list[tuple[int,int]]:
+    values = {}
+    for text in assignments:
+        name, sep, value = text.partition('=')
+        if not sep:
+            print("Error: Expected NAME=VALUE but got '"+text+"'")
+            sys.exit(1)
+        index = hreg_name_to_index(name)
+        if index is None:
+            print("Error: Unknown holding register '"+name+"'")
+            sys.exit(1)
+        allowed = HREG_ALLOWED_VALUES.get(name)
+        if allowed is None:
+            print("Error: Holding register '"+name+"' is not writable")
+            sys.exit(1)
+        try:
+            value = int(value, 0)
+        except ValueError:
+            print("Error: Invalid value '"+value+"' for "+name)
+            sys.exit(1)
+        if value not in allowed:
+            if type(allowed) is range:
+                allowed = "{}..{}".format(allowed.start, allowed.stop-1)
+            else:
+                allowed = ", ".join(str(x) for x in allowed)
+            print("Error: Value {} is not allowed for {} (allowed: {})".format(value, name, allowed))
+            sys.exit(1)
+        values[index] = value
+    return list(values.items())
+
+
+#
+# A decoded MODBUS message (see SydpowerModbus.decode_frame).
+#
+# For the known functions (0x03, 0x04 and 0x06), arg1 and arg2 are the two
+# 16 bit arguments and the payload is an array('H') with the registers of a
+# read response (empty otherwise). For the other functions (including the
+# error responses), arg1 and arg2 are None and the payload is a read-only
+# memoryview of the bytes between the function code and the CRC.
+#
+# The function name and the symbolic register name are only computed when
+# asked for.
+#
+class ModbusFrame:
+
+    __slots__ = ( 'kind', 'code', 'arg1', 'arg2', 'payload', 'crc', 'raw' )
+
+    FUNC_NAMES = { 3: "ReadHoldingRegisters",
+                   4: "ReadInputRegisters",
+                   6: "WriteHoldingRegister" }
+
+    def __init__(self, kind:str, code:int, arg1:int|None, arg2:int|None, payload, crc:int, raw:bytes):
+        self.kind    = kind      # 'request' or 'response'
+        self.code    = code      # the function code
+        self.arg1    = arg1
+        self.arg2    = arg2
+        self.payload = payload
+        self.crc     = crc
+        self.raw     = raw       # the encoded message
+
+    @property
+    def func(self) -> str:
+        return self.FUNC_NAMES.get(self.code) or "Func"+str(self.code)
+
+    @property
+    def args(self) -> modbus_values:
+        return [] if self.arg1 is None else [ self.arg1, self.arg2 ]
+
+    # The name of the register given by arg1 for a write or a read response
+    # of a single register (else None)
+    @property
+    def name(self) -> str | None:
+        code = self.code
+        if code == SydpowerModbus.FUNC_WRITE_HOLDING_REGISTER:
+            return hreg_index_to_name(self.arg1)
+        if self.kind == 'response' and self.arg2 == 1:
+            if code == SydpowerModbus.FUNC_READ_HOLDING_REGISTERS:
+                return hreg_index_to_name(self.arg1)
+            if code == SydpowerModbus.FUNC_READ_INPUT_REGISTERS:
+                return ireg_index_to_name(self.arg1)
+        return None
+
+    # The arguments with the register index replaced by its name when known 
+    @property
+    def symbolic_args(self) -> modbus_values:
+        name = self.name
+        if name:
+            return [ name, self.arg2 ]
+        return self.args
+
+
+# The function code and the two arguments of a MODBUS message (after the channel)
+MODBUS_HEADER = struct.Struct('>xBHH')
+
+# The 16 bit registers are big-endian  
+MODBUS_SWAP_WORDS = sys.byteorder == 'little'
+
+
+#
+# The MODBUS CRC (CRC-16 with the reflected polynomial 0xA001).
+#
+# MODBUS_CRC_TABLE gives the CRC update for one byte and MODBUS_CRC_TABLE2
+# for two bytes at once, indexed by the CRC xor the next two bytes as a
+# little-endian word. Note that the CRC is stored most significant byte
+# first in the Sydpower messages.
+#
+def _crc_table() -> list[int]:
+    table = []
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 0x0001 else crc >> 1
+        table.append(crc)
+    return table
+
+MODBUS_CRC_TABLE  = _crc_table()
+MODBUS_CRC_TABLE2 = [ (c >> 8) ^ MODBUS_CRC_TABLE[c & 0xFF]
+                      for c in ( (x >> 8) ^ MODBUS_CRC_TABLE[x & 0xFF] for x in range(65536) ) ]
+
+# MODBUS_CRC_TABLE2 as a NumPy array (created when needed)
+MODBUS_CRC_ARRAY2 = None
+
+# The CRC of the first size bytes of buf
+def modbus_crc(buf, size:int) -> int:
+    words = array.array('H')
+    with memoryview(buf) as view:
+        words.frombytes(view[:size & ~1])
+    if not MODBUS_SWAP_WORDS:
+        words.byteswap()
+    crc = 0xFFFF
+    table = MODBUS_CRC_TABLE2
+    for word in words:
+        crc = table[crc ^ word]
+    if size & 1:
+        crc = (crc >> 8) ^ MODBUS_CRC_TABLE[(crc ^ buf[size-1]) & 0xFF]
+    return crc
+
+
+# The exception raised when decoding a malformed MODBUS message 
+class ModbusError(Exception):
+    pass
+
+
 #
 # That class provide various features related to MODBUS 
 #
@@ -315,16 +794,7 @@ class SydpowerModbus:
 
     # Compute a CRC for a modbus message    
     def compute_crc(self, buf, size:int):
-        crc = 0xFFFF
-        for i in range(size):
-            crc ^= buf[i]
-            for bit in range(8):
-                if crc & 0x0001:
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
-
+        crc = modbus_crc(buf, size)
         return [ (crc & 0xFF00) >> 8 , crc & 0xFF ]
 
     def append_crc(self, buf: bytearray):
@@ -335,15 +805,14 @@ class SydpowerModbus:
     def check_crc(self, buf):
         if len(buf) < 2:
             return False
-        hi,lo = self.compute_crc(buf,len(buf)-2)
-        return (hi==buf[-2] and lo==buf[-1])
+        return modbus_crc(buf, len(buf)-2) == (buf[-2]<<8) | buf[-1]
 
     # Extract a single 16 word from a bytes or bytearray buffer
     def get_word(self, buf: bytes|bytearray , index:int) -> int:
         try:
             return ((buf[index]&0xFF)<<8) + (buf[index+1]&0xFF)
         except:
-            raise Exception('[modbus] malformed message')
+            raise ModbusError('[modbus] malformed message')
 
     # Extract n 16bit words from a bytes of bytearray buffer 
     def get_words(self, buf: bytes|bytearray, index:int, n:int) -> modbus_values :
@@ -356,7 +825,7 @@ class SydpowerModbus:
 
     def check_size(self, buf: bytes|bytearray , arg_size:int, payload_size:int) -> None:
         if len(buf) != 4+arg_size+payload_size :
-            raise Exception('[modbus] malformed message')
+            raise ModbusError('[modbus] malformed message')
 
     def encode_ReadHoldingRegisters(self, start:int, count:int) -> bytearray :
         msg = bytearray()
@@ -375,389 +844,4619 @@ class SydpowerModbus:
         self.append_word(msg,count)
         self.append_crc(msg)
         return msg
+
+    def encode_WriteHoldingRegister(self, index:int, value:int) -> bytearray :
+        msg = bytearray()
+        msg.append(self.CHANNEL)
+        msg.append(self.FUNC_WRITE_HOLDING_REGISTER)
+        self.append_word(msg,index)
+        self.append_word(msg,value)
+        self.append_crc(msg)
+        return msg
+
+    # Encode the response to ReadHoldingRegisters or ReadInputRegisters  
+    def encode_ReadRegistersResponse(self, func:int, start:int, values:Sequence[int]) -> bytearray :
+        msg = bytearray()
+        msg.append(self.CHANNEL)
+        msg.append(func)
+        self.append_word(msg,start)
+        self.append_word(msg,len(values))
+        for v in values:
+            self.append_word(msg,v)
+        self.append_crc(msg)
+        return msg
+
+    # Encode an error response (the most significant bit of the function code is set)
+    def encode_ErrorResponse(self, func:int, code:int) -> bytearray :
+        msg = bytearray()
+        msg.append(self.CHANNEL)
+        msg.append(func | 0x80)
+        msg.append(code)
+        self.append_crc(msg)
+        return msg
     
-    # Decode a modbus message.
+    # Encode a request for any function that takes two 16 bit arguments
+    def encode_request(self, func:int, arg1:int, arg2:int) -> bytearray :
+        msg = bytearray()
+        msg.append(self.CHANNEL)
+        msg.append(func)
+        self.append_word(msg,arg1)
+        self.append_word(msg,arg2)
+        self.append_crc(msg)
+        return msg
+    
+    # Decode a modbus message into a ModbusFrame.
     #
     # The argument kind shall be
     #  - 'request' for a message from the client
     #  - 'response' for a message from the device
     #
-    # The argument symbolic indicates if register numbers
-    # shall be replaced by their symbolic name when possible.
+    # The registers of a read response are copied in a single operation and
+    # nothing else is allocated except the frame itself.
     #
-    def decode(self, msg:bytes, kind:str, symbolic:bool) ->  tuple[str, modbus_values, modbus_payload , int]: 
+    def decode_frame(self, msg:bytes, kind:str) -> ModbusFrame:
 
-        channel : int
-        crc: int
-        func: int | str
-        payload: modbus_payload
-        n: int
-        args: modbus_values
-        name: str | None
-        
-        if kind not in ['request','response']:
+        if kind != 'request' and kind != 'response':
             raise Exception('[modbus] bad kind argument')
 
-        if len(msg)<4:
-            raise Exception('[modbus] tiny message')
-        channel = msg[0]
-        if channel != self.CHANNEL:
-            raise Exception('[modbus] Unexpected channel')
+        size = len(msg)
+        if size<4:
+            raise ModbusError('[modbus] tiny message')
+        if msg[0] != self.CHANNEL:
+            raise ModbusError('[modbus] Unexpected channel')
         if not self.check_crc(msg):
-            raise Exception('[modbus] Bad CRC')
-        crc = self.get_word(msg,-2)       
-        func = msg[1]
-
-        if func == self.FUNC_READ_HOLDING_REGISTERS:
-            args = self.get_words(msg,2,2) # index and count
-            n=args[1] if kind=='response' else 0
-            self.check_size(msg, 2*2, n*2) 
-            payload = self.get_words(msg,6,n)
-            func = "ReadHoldingRegisters"
-            if symbolic and n==1:
-                name = hreg_index_to_name(args[0])
-                if name:
-                    args[0] = name                
-
-        elif func == self.FUNC_READ_INPUT_REGISTERS:
-            args = self.get_words(msg,2,2) # index and count
-            n=args[1] if kind=='response' else 0
-            self.check_size(msg, 2*2, n*2) 
-            payload = self.get_words(msg,6,n)
-            func = "ReadInputRegisters"
-
-            if symbolic and n==1:
-                name = ireg_index_to_name(args[0])
-                if name:
-                    args[0] = name
-
-        elif func==self.FUNC_WRITE_HOLDING_REGISTER :
-            args = self.get_words(msg,2,2) # index and value
-            self.check_size(msg, 2*2, 0)
-            payload = []
-            func = "WriteHoldingRegister"
-
-            if symbolic:
-                name = hreg_index_to_name(args[0])
-                if name:
-                    args[0] = name
+            raise ModbusError('[modbus] Bad CRC')
+        crc = (msg[-2]<<8) | msg[-1]
+        code = msg[1]
 
+        if code == self.FUNC_READ_HOLDING_REGISTERS or code == self.FUNC_READ_INPUT_REGISTERS:
+            if size < 8:
+                raise ModbusError('[modbus] malformed message')
+            _, arg1, arg2 = MODBUS_HEADER.unpack_from(msg)
+            payload = array.array('H')
+            if kind == 'response':
+                if size != 8+2*arg2:
+                    raise ModbusError('[modbus] malformed message')
+                payload.frombytes(memoryview(msg)[6:-2])
+                if MODBUS_SWAP_WORDS:
+                    payload.byteswap()
+            elif size != 8:
+                raise ModbusError('[modbus] malformed message')
+        elif code == self.FUNC_WRITE_HOLDING_REGISTER:
+            if size != 8:
+                raise ModbusError('[modbus] malformed message')
+            _, arg1, arg2 = MODBUS_HEADER.unpack_from(msg)
+            payload = array.array('H')
         else:
             # Unknown function so assume no arguments and a byte payload
-            args=[]
-            payload = msg[2:-2]  
-            func = "Func"+str(func)
+            arg1 = arg2 = None
+            payload = memoryview(msg).toreadonly()[2:-2]
+
+        return ModbusFrame(kind, code, arg1, arg2, payload, crc, msg)
+
+    # Decode many read responses of the same registers at once.
+    #
+    # The messages are expected to be responses of the function code (0x03
+    # or 0x04) for the count registers starting at start. Return a tuple
+    # (values, valid) with one row of count registers per message and a
+    # flag telling if the message was such a response with a good CRC. The
+    # rows of the invalid messages are zero.
+    #
+    # With NumPy, values is a 2-D uint16 array (messages x registers), valid
+    # is a boolean array and the CRCs of all messages are computed at once.
+    # Otherwise, values is a list of array('H') and valid a list of bool.
+    #
+    def decode_batch(self, msgs:Sequence[bytes], code:int, start:int, count:int):
+        if numpy is None:
+            return self.decode_batch_python(msgs, code, start, count)
+        size = 8+2*count
+        n = len(msgs)
+        sized = numpy.fromiter( (len(msg) == size for msg in msgs), bool, n )
+        rows = numpy.zeros((n, size), numpy.uint8)
+        if sized.any():
+            data = b''.join( msg for msg in msgs if len(msg) == size )
+            rows[sized] = numpy.frombuffer(data, numpy.uint8).reshape(-1, size)
+        # The CRC two bytes at a time for all messages (see modbus_crc)
+        global MODBUS_CRC_ARRAY2
+        if MODBUS_CRC_ARRAY2 is None:
+            MODBUS_CRC_ARRAY2 = numpy.array(MODBUS_CRC_TABLE2, numpy.uint16)
+        columns = numpy.ascontiguousarray(rows.view('<u2')[:, :size//2-1].T)
+        crc = numpy.full(n, 0xFFFF, numpy.uint16)
+        for column in columns:
+            crc = MODBUS_CRC_ARRAY2[crc ^ column]
+        words = rows.view('>u2')
+        valid = ( sized & (rows[:,0] == self.CHANNEL) & (rows[:,1] == code)
+                  & (words[:,1] == start) & (words[:,2] == count) & (words[:,-1] == crc) )
+        values = words[:, 3:3+count].astype(numpy.uint16)
+        values[~valid] = 0
+        return values, valid
+
+    # The implementation of decode_batch() without NumPy
+    def decode_batch_python(self, msgs:Sequence[bytes], code:int, start:int, count:int):
+        size = 8+2*count
+        expected = (code, start, count)
+        values = []
+        valid = []
+        for msg in msgs:
+            row = array.array('H')
+            ok = ( len(msg) == size and msg[0] == self.CHANNEL
+                   and MODBUS_HEADER.unpack_from(msg) == expected and self.check_crc(msg) )
+            if ok:
+                row.frombytes(memoryview(msg)[6:-2])
+                if MODBUS_SWAP_WORDS:
+                    row.byteswap()
+            else:
+                row.frombytes(bytes(2*count))
+            values.append(row)
+            valid.append(ok)
+        return values, valid
 
-        return func, args, payload, crc
+    # Decode a modbus message.
+    #
+    # The argument kind shall be
+    #  - 'request' for a message from the client
+    #  - 'response' for a message from the device
+    #
+    # The argument symbolic indicates if register numbers
+    # shall be replaced by their symbolic name when possible.
+    #
+    # Return the function name, the arguments, the payload (a list of
+    # registers or the bytes of an unknown function) and the CRC. 
+    # decode_frame() is faster.
+    #
+    def decode(self, msg:bytes, kind:str, symbolic:bool) ->  tuple[str, modbus_values, modbus_payload , int]: 
+        frame = self.decode_frame(msg, kind)
+        args = frame.symbolic_args if symbolic else frame.args
+        if frame.arg1 is None:
+            payload = bytes(frame.payload)
+        else:
+            payload = frame.payload.tolist()
+        return frame.func, args, payload, frame.crc
 
 
 #
-# A simple base class for MQTT clients: 
+# Capture files: a compact append-only binary log of MQTT messages.
 #
-# Provide:
-#   - a main loop
-#   - for MQTT event (on_connect, on_disconnect, on_subscribe, on_message) 
-#   - a callback called at regular interval (TIC)
+# The file starts with CAPTURE_MAGIC followed by a sequence of records. 
+# All integers are little-endian.
 #
+#   - a topic record binds a topic id to a topic name:
+#       'T' (1 byte), topic id (uint16), length (uint16), topic (utf-8)
 #
-class SimpleMqttApp :
+#   - a message record:
+#       'M' (1 byte), topic id (uint16), flags (uint8), receive time
+#       (float64, seconds since epoch), length (uint32), payload
+#
+#     The flags bit 0 indicates a retained message.
+#
+# Topic ids are only valid from their topic record onward so a file can be 
+# appended by several recording sessions.
+#
+CAPTURE_MAGIC   = b'SYDPCAP1'
+CAPTURE_TOPIC   = struct.Struct('<BHH')
+CAPTURE_MESSAGE = struct.Struct('<BHBdI')
+CAPTURE_KIND_TOPIC   = ord('T')
+CAPTURE_KIND_MESSAGE = ord('M')
 
-    # args is typically a 'argparse.Namespace' object but any object with 
-    # the following attributes will do (or use setattr(args, NAME, VALUE) to
-    # manually set attributes).
-    #
-    #  - args.mqtt_hostname   (str)       The hostname or IP address of the mqtt server
-    #  - args.mqtt_port       (int)       The MQTT port
-    #  - args.mqtt_username   (str|None)  The MQTT username
-    #  - args.mqtt_password   (str|None)  The MQTT password
-    #
-    def __init__(self, args) :
 
-        # print(type(args))
-        
-        self.mqtt_hostname = args.mqtt_hostname
-        self.mqtt_port     = args.mqtt_port 
-        self.mqtt_username = args.mqtt_username
-        self.mqtt_password = args.mqtt_password
+# A MQTT message read from a capture file. 
+#
+# It provides the same attributes than a paho MQTTMessage (topic, payload,
+# retain) plus the receive time.
+class CapturedMessage:
 
-        self.tic_interval = 0.1   # minimal interval in seconds between two tics 
+    __slots__ = ( 'topic', 'payload', 'retain', 'time' )
 
-        self._last_tic_time = time.time()   # When self.on_tic was last called
+    qos = 0
+    
+    def __init__(self, topic:str, payload:bytes, retain:bool, t:float):
+        self.topic   = topic
+        self.payload = payload
+        self.retain  = retain
+        self.time    = t
 
-        self.event_queue = queue.Queue()
-        
-        self.result = None   # Setting this to any value will stop the run()  
 
-        self.mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-            
-        if self.mqtt_username:
-            self.mqtt_client.username_pw_set(self.mqtt_username, self.mqtt_password)
+#
+# Append messages to a capture file.
+#
+# A truncated record at the end of an existing file (e.g. after a crash
+# while recording) is removed before appending.
+#
+class CaptureWriter:
 
-        self.mqtt_client.on_connect    = self._on_connect_cb
-        self.mqtt_client.on_disconnect = self._on_disconnect_cb
-        self.mqtt_client.on_message    = self._on_message_cb
-        self.mqtt_client.on_subscribe  = self._on_subscribe_cb
+    def __init__(self, path:str):
+        self.file = open(path, 'ab', buffering=1<<16)
+        size = self.file.tell()
+        if size > 0:
+            reader = CaptureReader(path)
+            end = reader.complete_size()
+            reader.close()
+            if end < size:
+                self.file.truncate(end)
+        else:
+            self.file.write(CAPTURE_MAGIC)
+        self.topics : dict[str,int] = {}
+        self.count = 0
 
-    def _on_connect_cb(self, client, userdata, flags, reason_code, properties):
-        self.event_queue.put( ['connect', flags, reason_code, properties ] )
+    def write(self, topic:str, payload:bytes, retain:bool, t:float):
+        tid = self.topics.get(topic)
+        if tid is None:
+            tid = len(self.topics)
+            if tid > 0xFFFF:
+                # Start over with a new topic table
+                self.topics.clear()
+                tid = 0
+            self.topics[topic] = tid
+            name = topic.encode()
+            self.file.write(CAPTURE_TOPIC.pack(CAPTURE_KIND_TOPIC, tid, len(name)))
+            self.file.write(name)
+        self.file.write(CAPTURE_MESSAGE.pack(CAPTURE_KIND_MESSAGE, tid, 1 if retain else 0, t, len(payload)))
+        self.file.write(payload)
+        self.count += 1
 
-    def _on_disconnect_cb(self, client, userdata, flags, reason_code, properties):
-        self.event_queue.put( ['disconnect', flags, reason_code, properties ] )
-        
-    def _on_message_cb(self, client, userdata, msg):
-        self.event_queue.put( ['message', msg ] )
+    def flush(self):
+        self.file.flush()
 
-    def _on_subscribe_cb(self, client, userdata, mid, reason_code_list, properties):
-        # TODO 
-        # See /usr/lib/python3/dist-packages/paho/mqtt/reasoncodes.py
-        # Note: is rc.value supposed to be a public attribute
-        #       or are we supposed to use rc.is_failure to detect failure and
-        #       then rc.getName() to display the reason?
-        # Also the 'mid' would need to be matched with the result of
-        # the client.subscribe() call.
-        for rc in reason_code_list:
-            if rc.is_failure:                
-                print("==> Warning subscribe error mid=%d value=%d name='%s' "
-                      % ( mid, rc.value, rc.getName() ) )
-        pass
+    def close(self):
+        self.file.close()
 
-    #
-    # For now, this is just an alias for self.client.subscribe(...)
-    # 
-    # TODO: Check for success in on_subscribe_cb
-    #
-    def subscribe(self, topic, qos=0):
-        return self.mqtt_client.subscribe(topic,qos)  
 
-    def publish(self, topic, payload, qos=0, retain=False, properties=None):
-        return self.mqtt_client.publish(topic, payload, qos, retain, properties)  
-    
-    def on_message(self, msg):
-        print("# "+msg.topic+" "+ msg.payload.hex())
+#
+# Iterate over the messages of a capture file using memory-mapped I/O.
+#
+# A truncated record at the end of the file (e.g. after a crash while
+# recording) is silently ignored.
+#
+class CaptureReader:
 
-    def on_connect(self, flags, reason_code, properties):
-        pass
-    
-    def on_disconnect(self, flags, reason_code, properties):
-        # TODO: Provide automatic reconnection.
-        pass
+    def __init__(self, path:str):
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size < len(CAPTURE_MAGIC):
+            raise Exception("[capture] '{}' is not a capture file".format(path))
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise Exception("[capture] '{}' is not a capture file".format(path))
+
+    def __iter__(self):
+        data = self.data
+        end  = len(data)
+        pos  = len(CAPTURE_MAGIC)
+        topics : dict[int,str] = {}
+        unpack_topic   = CAPTURE_TOPIC.unpack_from
+        unpack_message = CAPTURE_MESSAGE.unpack_from
+        topic_size     = CAPTURE_TOPIC.size
+        message_size   = CAPTURE_MESSAGE.size
+        while pos < end:
+            kind = data[pos]
+            if kind == CAPTURE_KIND_MESSAGE:
+                if pos+message_size > end:
+                    break
+                _, tid, flags, t, n = unpack_message(data, pos)
+                pos += message_size
+                if pos+n > end:
+                    break
+                yield CapturedMessage(topics[tid], data[pos:pos+n], bool(flags&1), t)
+                pos += n
+            elif kind == CAPTURE_KIND_TOPIC:
+                if pos+topic_size > end:
+                    break
+                _, tid, n = unpack_topic(data, pos)
+                pos += topic_size
+                topics[tid] = data[pos:pos+n].decode()
+                pos += n
+            else:
+                raise Exception('[capture] corrupted record at offset {}'.format(pos))
+
+    # The size of the file without a truncated record at the end
+    def complete_size(self) -> int:
+        data = self.data
+        end  = len(data)
+        pos  = len(CAPTURE_MAGIC)
+        while pos < end:
+            kind = data[pos]
+            if kind == CAPTURE_KIND_MESSAGE:
+                if pos+CAPTURE_MESSAGE.size > end:
+                    break
+                n = CAPTURE_MESSAGE.unpack_from(data, pos)[4]
+                size = CAPTURE_MESSAGE.size + n
+            elif kind == CAPTURE_KIND_TOPIC:
+                if pos+CAPTURE_TOPIC.size > end:
+                    break
+                n = CAPTURE_TOPIC.unpack_from(data, pos)[2]
+                size = CAPTURE_TOPIC.size + n
+            else:
+                raise Exception('[capture] corrupted record at offset {}'.format(pos))
+            if pos+size > end:
+                break
+            pos += size
+        return pos
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+#
+# Read the MQTT messages of a pcap file (e.g. 'tcpdump -w FILE port 1883').
+#
+# The TCP streams are reassembled and the PUBLISH packets are extracted
+# from the MQTT connections to the given broker port. As a broker forwards
+# each message to all subscribers, only the messages sent to the broker are
+# used by default (direction 'to-broker'). Use 'from-broker' for a capture
+# made on a client or 'both'.
+#
+# The file is read sequentially and only the incomplete MQTT packets of
+# each stream are kept in memory, so the memory use does not depend on
+# the size of the capture. A stream with lost segments is resynchronized
+# on the next segment.
+#
+# The pcapng format is not supported (see 'editcap -F pcap').
+#
+PCAP_HEADER  = struct.Struct('IHHiIII')
+PCAP_RECORD  = struct.Struct('IIII')
+PCAP_MAGICS  = { b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+                 b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9) }
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+PCAP_DIRECTIONS = [ 'to-broker', 'from-broker', 'both' ]
+
+# One direction of a TCP connection
+class TcpStream:
+
+    __slots__ = ( 'seq', 'buffer', 'pending' )
+
+    MAX_PENDING = 64    # out of order segments kept before giving up on a missing one
+
+    def __init__(self):
+        self.seq : int | None = None     # the next expected sequence number
+        self.buffer = bytearray()        # the data not yet consumed
+        self.pending : dict[int,bytes] = {}   # out of order segments
+
+    # Add a segment and return False if the stream had to be resynchronized
+    def add(self, seq:int, data:bytes) -> bool:
+        if self.seq is None:
+            self.seq = seq
+        delta = (seq - self.seq) & 0xFFFFFFFF
+        if delta >= 0x80000000:
+            # Retransmission (possibly with new data)
+            skip = (self.seq - seq) & 0xFFFFFFFF
+            if skip >= len(data):
+                return True
+            data = data[skip:]
+        elif delta:
+            self.pending[seq] = data
+            if len(self.pending) <= self.MAX_PENDING:
+                return True
+            # Give up on the missing data
+            self.buffer.clear()
+            self.seq = min(self.pending, key=lambda s: (s - self.seq) & 0xFFFFFFFF)
+            data = self.pending.pop(self.seq)
+            self._append(data)
+            return False
+        self._append(data)
+        return True
+
+    def _append(self, data:bytes):
+        self.buffer += data
+        self.seq = (self.seq + len(data)) & 0xFFFFFFFF
+        while self.pending:
+            data = self.pending.pop(self.seq, None)
+            if data is None:
+                break
+            self.buffer += data
+            self.seq = (self.seq + len(data)) & 0xFFFFFFFF
+
+
+# A MQTT connection: the streams to and from the broker
+class MqttConnection:
+
+    __slots__ = ( 'streams', 'version' )
+
+    def __init__(self):
+        self.streams = ( TcpStream(), TcpStream() )
+        self.version = 4     # the MQTT protocol level (from the CONNECT packet)
+
+
+class PcapReader:
+
+    MAX_CONNECTIONS = 4096      # the oldest connections are forgotten beyond that
+    MAX_PACKET = 1<<20          # larger MQTT packets are assumed to be a lost synchronization
+
+    def __init__(self, path:str, port:int=1883, direction:str='to-broker'):
+        self.file = open(path, 'rb', buffering=1<<20)
+        magic = self.file.read(4)
+        if magic not in PCAP_MAGICS:
+            raise Exception("[pcap] '{}' is not a pcap file".format(path))
+        order, self.resolution = PCAP_MAGICS[magic]
+        self.header = struct.Struct(order + PCAP_HEADER.format)
+        self.record = struct.Struct(order + PCAP_RECORD.format)
+        header = self.header.unpack(magic + self.file.read(self.header.size-4))
+        self.linktype = header[6]
+        self.port = port
+        self.directions = ( direction != 'from-broker', direction != 'to-broker' )
+        self.connections : dict[tuple,MqttConnection] = {}
+        self.packets = 0      # pcap records
+        self.messages = 0     # PUBLISH packets
+        self.resyncs = 0      # streams resynchronized after lost data
+
+    def summary(self) -> str:
+        return "{} packets, {} MQTT messages, {} resynchronizations".format(self.packets, self.messages, self.resyncs)
+
+    # Return the IP packet of a link layer frame (or None)
+    def _ip_packet(self, frame:memoryview) -> memoryview | None:
+        linktype = self.linktype
+        if linktype == 1:      # Ethernet
+            offset, ethertype = 14, (frame[12]<<8) | frame[13]
+            while ethertype in (0x8100, 0x88a8) and len(frame) >= offset+4:   # VLAN
+                ethertype = (frame[offset+2]<<8) | frame[offset+3]
+                offset += 4
+            return frame[offset:] if ethertype in (0x0800, 0x86dd) else None
+        if linktype in (101, 12, 14):   # Raw IP
+            return frame
+        if linktype == 113:    # Linux cooked capture
+            return frame[16:]
+        if linktype == 276:    # Linux cooked capture v2
+            return frame[20:]
+        if linktype == 0:      # BSD loopback
+            return frame[4:]
+        return None
+
+    def __iter__(self):
+        read = self.file.read
+        record = self.record
+        record_size = record.size
+        resolution = self.resolution
+        while True:
+            data = read(record_size)
+            if len(data) < record_size:
+                break
+            seconds, fraction, size, _ = record.unpack(data)
+            data = read(size)
+            if len(data) < size:
+                break
+            self.packets += 1
+            yield from self._frame(memoryview(data), seconds + fraction*resolution)
+
+    def _frame(self, frame:memoryview, t:float):
+        ip = self._ip_packet(frame)
+        if ip is None or len(ip) < 20:
+            return
+        version = ip[0] >> 4
+        if version == 4:
+            header = (ip[0] & 0x0F) * 4
+            if ip[9] != 6 or (((ip[6]<<8) | ip[7]) & 0x3FFF):   # not TCP or fragmented
+                return
+            tcp = ip[header:((ip[2]<<8) | ip[3]) or len(ip)]   # 0 with TCP segmentation offload
+            src, dst = bytes(ip[12:16]), bytes(ip[16:20])
+        elif version == 6:
+            if len(ip) < 40 or ip[6] != 6:   # not TCP (extension headers are not supported)
+                return
+            tcp = ip[40:40+((ip[4]<<8) | ip[5])]
+            src, dst = bytes(ip[8:24]), bytes(ip[24:40])
+        else:
+            return
+        if len(tcp) < 20:
+            return
+        sport, dport, seq, _, offset, flags = struct.unpack_from('>HHIIBB', tcp)
+        if dport == self.port:
+            key, inbound = (src, sport, dst, dport), True
+        elif sport == self.port:
+            key, inbound = (dst, dport, src, sport), False
+        else:
+            return
+        connection = self.connections.get(key)
+        if flags & 0x04:   # RST
+            self.connections.pop(key, None)
+            return
+        if connection is None:
+            if len(self.connections) >= self.MAX_CONNECTIONS:
+                del self.connections[next(iter(self.connections))]
+            connection = self.connections[key] = MqttConnection()
+        stream = connection.streams[0 if inbound else 1]
+        if flags & 0x02:   # SYN
+            stream.seq = (seq + 1) & 0xFFFFFFFF
+            stream.buffer.clear()
+            stream.pending.clear()
+            return
+        payload = tcp[(offset >> 4) * 4:]
+        if payload:
+            if not stream.add(seq, payload):
+                self.resyncs += 1
+            yield from self._mqtt_packets(connection, stream, inbound, t)
+        if flags & 0x01 and not inbound:   # FIN from the broker
+            self.connections.pop(key, None)
+
+    # Extract the complete MQTT packets of a stream
+    def _mqtt_packets(self, connection:MqttConnection, stream:TcpStream, inbound:bool, t:float):
+        buffer = stream.buffer
+        size = len(buffer)
+        pos = 0
+        wanted = self.directions[0 if inbound else 1]
+        while size - pos >= 2:
+            first = buffer[pos]
+            # The remaining length (at most 4 bytes)
+            length = 0
+            i = pos+1
+            for shift in (0, 7, 14, 21, 28):
+                if shift == 28 or i >= size:
+                    break
+                byte = buffer[i]
+                length |= (byte & 0x7F) << shift
+                i += 1
+                if not byte & 0x80:
+                    shift = -1
+                    break
+            if shift == 28 or length > self.MAX_PACKET or first >> 4 == 0:
+                # Lost synchronization: drop the buffered data
+                self.resyncs += 1
+                pos = size
+                break
+            if shift >= 0 or i + length > size:
+                break   # incomplete
+            kind = first >> 4
+            if kind == 3 and wanted:
+                message = self._publish(connection, first, memoryview(buffer)[i:i+length], t)
+                if message:
+                    self.messages += 1
+                    yield message
+            elif kind == 1 and length >= 7:
+                # CONNECT: remember the protocol level
+                name = (buffer[i]<<8) | buffer[i+1]
+                if i+2+name < size:
+                    connection.version = buffer[i+2+name]
+            pos = i + length
+        if pos:
+            del buffer[:pos]
+
+    def _publish(self, connection:MqttConnection, first:int, body:memoryview, t:float) -> CapturedMessage | None:
+        try:
+            n = (body[0]<<8) | body[1]
+            topic = bytes(body[2:2+n]).decode()
+            pos = 2+n
+            if first & 0x06:   # QoS > 0: packet identifier
+                pos += 2
+            if connection.version >= 5:
+                length = 0
+                shift = 0
+                while True:
+                    byte = body[pos]
+                    pos += 1
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                pos += length
+            payload = bytes(body[pos:])
+        except (IndexError, UnicodeDecodeError):
+            return None
+        finally:
+            body.release()
+        return CapturedMessage(topic, payload, bool(first & 0x01), t)
+
+    def close(self):
+        self.file.close()
+
+
+#
+# Read the messages of a mosquitto_sub dump with one message per line:
+#
+#   mosquitto_sub -t '#' -F "%t %l %x"       topic, payload length and payload in hex
+#   mosquitto_sub -t '#' -F "%U %t %l %x"    the same prefixed by the receive time (%U or %I)
+#
+# The messages without a time are at time 0. Invalid lines are skipped.
+#
+class DumpReader:
+
+    def __init__(self, path:str):
+        self.file = open(path, 'rb', buffering=1<<20)
+        self.messages = 0
+        self.skipped = 0
+
+    def summary(self) -> str:
+        return "{} MQTT messages, {} invalid lines".format(self.messages, self.skipped)
+
+    def __iter__(self):
+        for line in self.file:
+            fields = line.split()
+            if not fields:
+                continue
+            try:
+                t = 0.0
+                if len(fields) == 4 or (len(fields) == 3 and fields[-1] == b'0'):
+                    text = fields.pop(0).decode()
+                    try:
+                        t = float(text)
+                    except ValueError:
+                        t = datetime.datetime.fromisoformat(text).timestamp()
+                payload = bytes.fromhex(fields[2].decode()) if len(fields) == 3 else b''
+                if len(fields) not in (2, 3) or int(fields[1]) != len(payload):
+                    raise ValueError
+                topic = fields[0].decode()
+            except (ValueError, UnicodeDecodeError):
+                self.skipped += 1
+                continue
+            self.messages += 1
+            yield CapturedMessage(topic, payload, False, t)
+
+    def close(self):
+        self.file.close()
+
+
+# Open a capture file, a pcap file or a mosquitto_sub dump according to its content
+def open_capture(path:str, port:int=1883, direction:str='to-broker'):
+    with open(path, 'rb') as f:
+        magic = f.read(len(CAPTURE_MAGIC))
+    if magic == CAPTURE_MAGIC:
+        return CaptureReader(path)
+    if magic[:4] in PCAP_MAGICS:
+        return PcapReader(path, port, direction)
+    if magic[:4] == PCAPNG_MAGIC:
+        raise Exception("[pcap] '{}' is a pcapng file. Convert it with 'editcap -F pcap'".format(path))
+    return DumpReader(path)
+
+
+#
+# Register history: a columnar store of register snapshots.
+#
+# Each (device, bank) pair is a series stored in two files in the store
+# directory ('MAC.i.dat' + 'MAC.i.idx' for the input registers and
+# 'MAC.h.dat' + 'MAC.h.idx' for the holding registers):
+#
+#  - The .dat file is a sequence of blocks of up to HistoryStore.BLOCK_ROWS
+#    rows. Each row is a full bank of 80 registers and its time.
+#
+#  - The .idx file contains one HISTORY_INDEX entry per block: time of the
+#    first and last row, offset and size of the block in the .dat file and
+#    number of rows. It is small enough to be loaded entirely so queries
+#    only read the blocks they need. 
+#
+# A block is made of a HISTORY_BLOCK header (number of rows) followed by
+# the offsets of its 81 columns (uint32, relative to the end of the offset
+# table) and the columns themselves:
+#    - column 0 contains the time of each row in milliseconds encoded as
+#      deltas from the previous row (the first one is absolute).
+#    - column 1+i contains the values of register i.
+#
+# Each column is a sequence of (zigzag(value-previous), count) pairs of 
+# varints where 'previous' is the value of the previous pair (initially 0)
+# and 'count' is the number of consecutive rows with that value.
+#
+# Registers rarely change so a block usually takes a few bytes per row.
+#
+HISTORY_INDEX = struct.Struct('<ddQII')
+HISTORY_BLOCK = struct.Struct('<I')
+HISTORY_COLUMNS = 81
+HISTORY_OFFSETS = struct.Struct('<{}I'.format(HISTORY_COLUMNS))
+
+def _zigzag(v:int) -> int:
+    return (v << 1) if v >= 0 else ((-v << 1) - 1)
+
+def _unzigzag(v:int) -> int:
+    return (v >> 1) if not v & 1 else -((v + 1) >> 1)
+
+def _put_varint(buf:bytearray, v:int) -> None:
+    while v >= 0x80:
+        buf.append((v & 0x7F) | 0x80)
+        v >>= 7
+    buf.append(v)
+
+def _get_varint(buf, pos:int) -> tuple[int,int]:
+    v = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        v |= (b & 0x7F) << shift
+        if b < 0x80:
+            return v, pos
+        shift += 7
+
+# Decode up to 'rows' values from a history column
+def _decode_column(buf, rows:int) -> list[int]:
+    out : list[int] = []
+    pos = 0
+    value = 0
+    end = len(buf)
+    while len(out) < rows and pos < end:
+        delta, pos = _get_varint(buf, pos)
+        count, pos = _get_varint(buf, pos)
+        value += _unzigzag(delta)
+        out.extend( [value] * count )
+    del out[rows:]
+    return out
+
+
+# The write side of a history series: rows are encoded on the fly so only
+# the compressed block is kept in memory. 
+class HistorySeries:
+
+    __slots__ = ( 'name', 'values', 'current', 'runs', 'previous', 'columns',
+                  'rows', 'repeat', 'first_time', 'last_time', 'last_ms' )
+    
+    def __init__(self, name:str):
+        self.name   = name
+        self.values : list[int] | None = None  # the last row
+        self._reset()
+
+    def _reset(self):
+        self.current  = [0] * HISTORY_COLUMNS  # the value of the current run in each column 
+        self.runs     = [0] * HISTORY_COLUMNS  # the length of the current run in each column
+        self.previous = [0] * HISTORY_COLUMNS  # the value of the last encoded run in each column 
+        self.columns  = [ bytearray() for _ in range(HISTORY_COLUMNS) ]
+        self.rows     = 0
+        self.repeat   = 0     # rows identical to the last one and not yet added to the runs
+        self.first_time = 0.0
+        self.last_time  = 0.0
+        self.last_ms    = 0
+
+    def _push(self, col:int, v:int):
+        if self.runs[col] and self.current[col] == v:
+            self.runs[col] += 1
+            return
+        self._end_run(col)
+        self.current[col] = v
+        self.runs[col] = 1
+
+    def _end_run(self, col:int):
+        if self.runs[col]:
+            buf = self.columns[col]
+            _put_varint(buf, _zigzag(self.current[col]-self.previous[col]))
+            _put_varint(buf, self.runs[col])
+            self.previous[col] = self.current[col]
+            self.runs[col] = 0
+
+    def append(self, t:float, values:list[int]):
+        ms = int(round(t*1000))
+        if self.rows == 0:
+            self.first_time = t
+        self._push(0, ms-self.last_ms)
+        self.last_ms = ms
+        self.last_time = t
+        self.rows += 1
+        # Fast path for a row identical to the previous one (of the same block)
+        if self.runs[1] and values == self.values:
+            self.repeat += 1
+            return
+        if self.repeat:
+            for col in range(1,HISTORY_COLUMNS):
+                self.runs[col] += self.repeat
+            self.repeat = 0
+        for i, v in enumerate(values):
+            self._push(i+1, v)
+        self.values = list(values)
+
+    # Encode the pending rows as a block and start a new one
+    def encode_block(self) -> bytes:
+        if self.repeat:
+            for col in range(1,HISTORY_COLUMNS):
+                self.runs[col] += self.repeat
+            self.repeat = 0
+        for col in range(HISTORY_COLUMNS):
+            self._end_run(col)
+        offsets = []
+        pos = 0
+        for buf in self.columns:
+            offsets.append(pos)
+            pos += len(buf)
+        block = HISTORY_BLOCK.pack(self.rows) + HISTORY_OFFSETS.pack(*offsets) + b''.join(self.columns)
+        values = self.values
+        self._reset()
+        self.values = values
+        return block
+
+
+#
+# See the description of the file format above.
+#
+# The store is opened for writing with append() or for queries with series()
+# and state_at(). Rows are only visible to queries once their block is
+# written (see BLOCK_ROWS and FLUSH_INTERVAL).
+#
+class HistoryStore:
+
+    BLOCK_ROWS     = 3600     # maximum number of rows per block 
+    FLUSH_INTERVAL = 600.0    # maximum age in seconds of an unwritten row 
+    
+    def __init__(self, directory:str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.writers : dict[str,HistorySeries] = {}
+
+    def _path(self, mac:str, bank:str, ext:str) -> str:
+        return os.path.join(self.directory, '{}.{}.{}'.format(mac, bank, ext))
+
+    #
+    # Add a snapshot of the registers start..start+len(values)-1 of a bank
+    # ('i' or 'h') at time t.
+    #
+    # A partial snapshot is merged with the previous row and ignored if no 
+    # full snapshot was seen yet. 
+    #
+    def append(self, mac:str, bank:str, t:float, start:int, values:list[int]):
+        key = mac+'.'+bank
+        series = self.writers.get(key)
+        if series is None:
+            series = self.writers[key] = HistorySeries(key)
+        if start != 0 or len(values) != HISTORY_COLUMNS-1:
+            if series.values is None:
+                return 
+            row = list(series.values)
+            row[start:start+len(values)] = values
+            del row[HISTORY_COLUMNS-1:]
+            values = row
+        series.append(t, values)
+        if series.rows >= self.BLOCK_ROWS:
+            self._write_block(mac, bank, series)
+
+    def _write_block(self, mac:str, bank:str, series:HistorySeries):
+        first, last, rows = series.first_time, series.last_time, series.rows
+        block = series.encode_block()
+        with open(self._path(mac, bank, 'dat'), 'ab') as f:
+            offset = f.tell()
+            f.write(block)
+        with open(self._path(mac, bank, 'idx'), 'ab') as f:
+            f.write(HISTORY_INDEX.pack(first, last, offset, len(block), rows))
+
+    # Write the blocks whose oldest row is older than FLUSH_INTERVAL (or all blocks when forced)  
+    def flush(self, now:float, force:bool=False):
+        for key, series in self.writers.items():
+            if series.rows and (force or now - series.first_time >= self.FLUSH_INTERVAL):
+                mac, bank = key.rsplit('.', 1)
+                self._write_block(mac, bank, series)
+
+    def close(self):
+        self.flush(0.0, True)
+
+    # Return the index entries of a series as (first_time, last_time, offset, size, rows)
+    def index(self, mac:str, bank:str) -> list[tuple]:
+        try:
+            with open(self._path(mac, bank, 'idx'), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        n = len(data) // HISTORY_INDEX.size
+        return list( HISTORY_INDEX.iter_unpack(data[:n*HISTORY_INDEX.size]) )
+
+    def _read_block(self, f, entry) -> tuple[int, bytes, tuple]:
+        f.seek(entry[2])
+        block = f.read(entry[3])
+        rows, = HISTORY_BLOCK.unpack_from(block, 0)
+        offsets = HISTORY_OFFSETS.unpack_from(block, HISTORY_BLOCK.size)
+        base = HISTORY_BLOCK.size + HISTORY_OFFSETS.size
+        return rows, memoryview(block)[base:], offsets + (len(block)-base,)
+
+    @staticmethod
+    def _times(rows:int, data, offsets) -> list[float]:
+        ms = 0
+        times = []
+        for delta in _decode_column(data[offsets[0]:offsets[1]], rows):
+            ms += delta
+            times.append(ms / 1000.0)
+        return times
+
+    # Return all (time, value) samples of a register of a bank between t1 and t2 (inclusive)  
+    def series(self, mac:str, bank:str, index:int, t1:float, t2:float) -> list[tuple[float,int]]:
+        result = []
+        entries = [ e for e in self.index(mac, bank) if e[1] >= t1 and e[0] <= t2 ]
+        if not entries:
+            return result
+        with open(self._path(mac, bank, 'dat'), 'rb') as f:
+            for entry in entries:
+                rows, data, offsets = self._read_block(f, entry)
+                times  = self._times(rows, data, offsets)
+                values = _decode_column(data[offsets[index+1]:offsets[index+2]], rows)
+                lo = bisect.bisect_left(times, t1)
+                hi = bisect.bisect_right(times, t2)
+                result.extend( zip(times[lo:hi], values[lo:hi]) )
+        result.sort(key=lambda x: x[0])
+        return result
+
+    # Return (time, values) for the last row of a bank at or before t or None 
+    def state_at(self, mac:str, bank:str, t:float) -> tuple[float,list[int]] | None:
+        entries = [ e for e in self.index(mac, bank) if e[0] <= t ]
+        if not entries:
+            return None
+        entry = max(entries, key=lambda e: min(e[1],t))
+        with open(self._path(mac, bank, 'dat'), 'rb') as f:
+            rows, data, offsets = self._read_block(f, entry)
+        times = self._times(rows, data, offsets)
+        row = bisect.bisect_right(times, t) - 1
+        values = [ _decode_column(data[offsets[col]:offsets[col+1]], row+1)[row]
+                   for col in range(1, HISTORY_COLUMNS) ]
+        return times[row], values
+
+
+#
+# Output sinks: the records produced by monitor and trace.
+#
+# Three kinds of records are produced:
+#  - message(): a decoded MODBUS message (monitor)
+#  - raw():     an MQTT message that is not a MODBUS message (monitor)
+#  - change():  a register value change (trace)
+#
+# and comment() is used for informational lines. 
+#
+# The Sink base class ignores all records.
+#
+class Sink:
+
+    def comment(self, text:str):
+        print(text, file=sys.stderr, flush=True)
+
+    def message(self, t:float, mac:str, frame:ModbusFrame):
+        pass
+
+    def raw(self, t:float, topic:str, payload:bytes):
+        pass
+
+    def change(self, t:float, mac:str, bank:str, index:int, name:str, value:int):
+        pass
+
+    # A burst of 'count' changes coalesced by ChangeFilter. The values were
+    # in the range low..high and 'value' is the last one. 
+    def coalesced(self, t:float, mac:str, bank:str, index:int, name:str, value:int, low:int, high:int, count:int):
+        self.change(t, mac, bank, index, name, value)
+
+    # Called at regular interval 
+    def poll(self):
+        pass
+    
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    
+#
+# A Sink writing the records to a stream.
+#
+# All records are encoded as bytes and accumulated in memory until the 
+# flush policy triggers a single write: 
+#  - after flush_records records,
+#  - or when the oldest pending record is older than flush_ms milliseconds
+#    (see also poll() which shall be called at regular interval),
+#  - or after each record if neither is specified.
+#
+class OutputSink(Sink):
+
+    MAX_PENDING = 1<<20   # flush when that many bytes are pending 
+
+    def __init__(self, file:str|io.BufferedIOBase|None=None, flush_records:int=0, flush_ms:float=0.0):
+        if file is None or file == '-':
+            sys.stdout.flush()
+            self.stream = sys.stdout.buffer
+            self.new_stream = True
+            self.own_stream = False
+        elif not isinstance(file, str):
+            # An open binary stream: the records are appended to another
+            # stream of the same format (see shard_worker)
+            self.stream = file
+            self.new_stream = False
+            self.own_stream = False
+        else:
+            self.stream = open(file, 'ab')
+            self.new_stream = self.stream.tell() == 0
+            self.own_stream = True
+        if not flush_records and not flush_ms:
+            flush_records = 1
+        self.flush_records  = flush_records
+        self.flush_interval = flush_ms / 1000.0
+        self.pending : list[bytes] = []
+        self.pending_size = 0
+        self.flush_time = 0.0   # when the pending records must be flushed 
+        self.count = 0          # total number of records 
+
+    def _emit(self, data:bytes):
+        if not self.pending and self.flush_interval:
+            self.flush_time = time.monotonic() + self.flush_interval
+        self.pending.append(data)
+        self.pending_size += len(data)
+        self.count += 1
+        if ( (self.flush_records and len(self.pending) >= self.flush_records)
+             or self.pending_size >= self.MAX_PENDING
+             or (self.flush_interval and time.monotonic() >= self.flush_time) ):
+            self.flush()
+
+    # Write records already formatted by another sink of the same format 
+    def write(self, data:bytes):
+        self._emit(data)
+
+    # Flush the pending records if their time has come.
+    def poll(self):
+        if self.pending and self.flush_interval and time.monotonic() >= self.flush_time:
+            self.flush()
+        
+    def flush(self):
+        if self.pending:
+            self.stream.write(b''.join(self.pending))
+            self.pending.clear()
+            self.pending_size = 0
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        if self.own_stream:
+            self.stream.close()
+
+
+# Human readable text (the historical output format)
+class TextSink(OutputSink):
+
+    def __init__(self, file=None, flush_records=0, flush_ms=0.0, timestamps:bool=False, macs:bool=False):
+        super().__init__(file, flush_records, flush_ms)
+        self.timestamps = timestamps   # prefix changes by a timestamp
+        self.macs = macs               # prefix messages and changes by the device MAC
+        self._time = None
+        self._time_str = ''
+
+    def comment(self, text:str):
+        self._emit( (text+'\n').encode() )
+
+    def message(self, t, mac, frame):
+        payload = frame.payload
+        if not payload:
+            payload_str = ""
+        elif frame.arg1 is not None:
+            # 16bit values. Display in hex with spaces 
+            payload_str = " = [ " + " ".join([ "{:04x}".format(x) for x in payload ]) + " ]"
+        else:
+            # Display as a long hexadecimal sequence
+            payload_str = " = " + payload.hex()
+
+        prefix = mac+" " if self.macs else ""
+        self._emit( "{}{} {}({}){}\n".format(prefix, frame.kind, frame.func,
+                                             ",".join([str(x) for x in frame.symbolic_args]),
+                                             payload_str).encode() )
+
+    def raw(self, t, topic, payload):
+        self._emit( "# {} {}\n".format(topic, payload.hex()).encode() )
+
+    def change(self, t, mac, bank, index, name, value):
+        line = name + " = " + FORMATTER.get(name,format_dec)(value) + "\n"
+        if self.macs:
+            line = mac + " " + line
+        if self.timestamps:
+            if t != self._time:
+                self._time = t
+                self._time_str = timestamp(t) + " "
+            line = self._time_str + line
+        self._emit(line.encode())
+
+    def coalesced(self, t, mac, bank, index, name, value, low, high, count):
+        fmt = FORMATTER.get(name,format_dec)
+        line = "{} = {} ({}..{}, {} changes)\n".format(name, fmt(value), fmt(low).strip(), fmt(high).strip(), count)
+        if self.macs:
+            line = mac + " " + line
+        if self.timestamps:
+            if t != self._time:
+                self._time = t
+                self._time_str = timestamp(t) + " "
+            line = self._time_str + line
+        self._emit(line.encode())
+
+
+# JSON Lines: one JSON object per record 
+class JsonSink(OutputSink):
+
+    def message(self, t, mac, frame):
+        payload = frame.payload
+        if frame.arg1 is None:
+            payload = payload.hex()
+        else:
+            payload = payload.tolist()
+        record = { 't': t, 'mac': mac, 'kind': frame.kind, 'func': frame.func,
+                   'args': frame.symbolic_args, 'payload': payload }
+        self._emit( (json.dumps(record, separators=(',',':'))+'\n').encode() )
+
+    def raw(self, t, topic, payload):
+        record = { 't': t, 'topic': topic, 'payload': payload.hex() }
+        self._emit( (json.dumps(record, separators=(',',':'))+'\n').encode() )
+
+    def change(self, t, mac, bank, index, name, value):
+        self._emit( '{{"t":{:.3f},"mac":{},"reg":"{}","index":{},"value":{}}}\n'.format(
+            t, json.dumps(mac), name, index, value).encode() )
+
+    def coalesced(self, t, mac, bank, index, name, value, low, high, count):
+        self._emit( '{{"t":{:.3f},"mac":{},"reg":"{}","index":{},"value":{},"min":{},"max":{},"count":{}}}\n'.format(
+            t, json.dumps(mac), name, index, value, low, high, count).encode() )
+
+        
+#
+# Comma Separated Values.
+#
+#  - changes:  time,mac,register,index,value
+#  - messages: time,mac,kind,function,args,payload
+#
+# where args is a space separated list and the payload is in hexadecimal.
+# Raw messages use kind 'raw' and their topic as function.
+#
+class CsvSink(OutputSink):
+
+    def __init__(self, file=None, flush_records=0, flush_ms=0.0):
+        super().__init__(file, flush_records, flush_ms)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._header = None
+
+    def _row(self, header:tuple, row:tuple|None):
+        if self._header is not header:
+            self._header = header
+            if self.new_stream:
+                self._writer.writerow(header)
+        if row is not None:
+            self._writer.writerow(row)
+        if self._buffer.tell():
+            self._emit(self._buffer.getvalue().encode())
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    MESSAGE_HEADER = ('time','mac','kind','function','args','payload')
+    CHANGE_HEADER  = ('time','mac','register','index','value')
+
+    # Write the header of the rows written with write() 
+    def write_header(self, header:tuple):
+        self._row(header, None)
+
+    def message(self, t, mac, frame):
+        # The payload is in the raw message either way
+        payload = frame.raw[6:-2] if frame.arg1 is not None else frame.payload
+        self._row(self.MESSAGE_HEADER, ('{:.3f}'.format(t), mac, frame.kind, frame.func,
+                                        " ".join([str(x) for x in frame.symbolic_args]), payload.hex()))
+
+    def raw(self, t, topic, payload):
+        self._row(self.MESSAGE_HEADER, ('{:.3f}'.format(t), '', 'raw', topic, '', payload.hex()))
+
+    def change(self, t, mac, bank, index, name, value):
+        self._row(self.CHANGE_HEADER, ('{:.3f}'.format(t), mac, name, index, value))
+        
+
+#
+# A compact binary format. The stream starts with OUTPUT_MAGIC followed
+# by records (little-endian) starting by a kind byte: 
+#
+#  - 'C' change:  time (float64), mac (12 bytes), bank ('i' or 'h'),
+#                 index (uint8), value (uint16)
+#  - 'M' message: time (float64), mac (12 bytes), kind (0 for requests, 1
+#                 for responses), size (uint16) followed by the raw MODBUS
+#                 message 
+#  - 'X' raw:     time (float64), topic size (uint16), payload size
+#                 (uint32) followed by the topic and the payload 
+#
+OUTPUT_MAGIC   = b'SYDPOUT1'
+OUTPUT_CHANGE  = struct.Struct('<Bd12sBBH')
+OUTPUT_MESSAGE = struct.Struct('<Bd12sBH')
+OUTPUT_RAW     = struct.Struct('<BdHI')
+
+class BinarySink(OutputSink):
+
+    def __init__(self, file=None, flush_records=0, flush_ms=0.0):
+        super().__init__(file, flush_records, flush_ms)
+        if self.new_stream:
+            self.stream.write(OUTPUT_MAGIC)
+
+    def message(self, t, mac, frame):
+        raw = frame.raw
+        self._emit( OUTPUT_MESSAGE.pack(ord('M'), t, mac.encode(), 0 if frame.kind=='request' else 1, len(raw)) + raw )
+
+    def raw(self, t, topic, payload):
+        name = topic.encode()
+        self._emit( OUTPUT_RAW.pack(ord('X'), t, len(name), len(payload)) + name + payload )
+
+    def change(self, t, mac, bank, index, name, value):
+        self._emit( OUTPUT_CHANGE.pack(ord('C'), t, mac.encode(), ord(bank), index, value) )
+
+
+OUTPUT_FORMATS = [ 'text', 'jsonl', 'csv', 'binary' ]
+
+#
+# Create the output sink described by args:
+#
+#  - args.output         (str|None)  The output file (default stdout)
+#  - args.format         (str)       One of OUTPUT_FORMATS
+#  - args.flush_records  (int)       See OutputSink 
+#  - args.flush_ms       (float)     See OutputSink 
+#  - args.timestamp      (bool)      Prefix text changes by a timestamp (optional)
+#
+def create_output_sink(args, fleet:bool) -> OutputSink:
+    file          = getattr(args, 'output', None)
+    flush_records = getattr(args, 'flush_records', 0)
+    flush_ms      = getattr(args, 'flush_ms', 0.0)
+    fmt = getattr(args, 'format', 'text')
+    if fmt == 'jsonl':
+        return JsonSink(file, flush_records, flush_ms)
+    elif fmt == 'csv':
+        return CsvSink(file, flush_records, flush_ms)
+    elif fmt == 'binary':
+        return BinarySink(file, flush_records, flush_ms)
+    else:
+        return TextSink(file, flush_records, flush_ms,
+                        timestamps = getattr(args, 'timestamp', False),
+                        macs = fleet)
+
+
+# The filter options of a register (see ChangeFilter) 
+class FilterRule:
+
+    __slots__ = ( 'deadband', 'relative', 'interval', 'coalesce' )
+
+    def __init__(self):
+        self.deadband = 0        # the deadband (0 for none)
+        self.relative = False    # True if the deadband is a percentage of the last value 
+        self.interval = 0.0      # the minimal delay between two records (in seconds) 
+        self.coalesce = 0.0      # the duration of the coalescing window (in seconds)
+
+
+# The filter state of a register of a device (see ChangeFilter) 
+class FilterState:
+
+    __slots__ = ( 'name', 'emitted', 'value', 'time',
+                  'pending', 'due', 'last', 'low', 'high', 'count' )
+
+    def __init__(self, name:str):
+        self.name    = name
+        self.emitted = False   # True once a record was emitted 
+        self.value   = 0       # the value of the last record 
+        self.time    = 0.0     # the time of the last record
+        self.pending = False   # True while a record is pending
+        self.due     = 0.0     # the time at which the pending record is emitted
+        self.last    = 0       # the last, min and max values and the number of
+        self.low     = 0       # changes of the pending record
+        self.high    = 0 
+        self.count   = 0 
+
+
+# The maximal number of allowed values of an enumerated holding register
+ENUM_MAX_VALUES = 16
+
+#
+# Return True if the register contains a bitfield (see REGISTER_BITS) or an
+# enumerated value (see HREG_ALLOWED_VALUES). The difference between two
+# values of such registers is meaningless so they cannot have a deadband. 
+#
+def is_discrete_register(name:str) -> bool:
+    if name in REGISTER_BITS:
+        return True
+    allowed = HREG_ALLOWED_VALUES.get(name)
+    return allowed is not None and len(allowed) <= ENUM_MAX_VALUES
+
+    
+#
+# Parse the filter options of args into two lists of FilterRule (or None) 
+# indexed by input and holding register index.
+#
+# Each option is a list of strings NAMES=VALUE where NAMES is a comma
+# separated list of registers or groups (see parse_register_names). If 
+# NAMES= is omitted then the value applies to ALL registers:
+#
+#  - args.deadband   (list|None)  N or N% (relative to the last value)
+#  - args.min_interval (list|None) SECONDS
+#  - args.coalesce   (list|None)  SECONDS
+#
+# A deadband given to a group (or to ALL) is not applied to the discrete
+# registers of the group (see is_discrete_register) and a deadband given
+# to a discrete register is an error.
+#
+# Return None if no filter is specified.
+#
+def parse_filter_rules(args):
+
+    irules = [ None ] * IREG_COUNT
+    hrules = [ None ] * HREG_COUNT
+    found = False
+    
+    for option in [ 'deadband', 'min_interval', 'coalesce' ]:
+        for spec in getattr(args, option, None) or []:
+            names, _, text = spec.rpartition('=')
+            iregs, hregs = parse_register_names( names.split(',') if names else ['ALL'] )
+            try:
+                relative = option == 'deadband' and text.endswith('%')
+                value = float(text[:-1] if relative else text)
+                if value < 0:
+                    raise ValueError
+            except ValueError:
+                print("Error: Invalid --{} value '{}'".format(option.replace('_','-'), spec))
+                sys.exit(1)
+            if option == 'deadband':
+                for name in names.split(',') if names else []:
+                    if is_discrete_register(name):
+                        print("Error: No deadband allowed for the bitfield or enumerated register '"+name+"'")
+                        sys.exit(1)
+                iregs = [ name for name in iregs if not is_discrete_register(name) ]
+                hregs = [ name for name in hregs if not is_discrete_register(name) ]
+            for rules, indices in ( (irules, map(ireg_name_to_index, iregs)),
+                                    (hrules, map(hreg_name_to_index, hregs)) ):
+                for index in indices:
+                    rule = rules[index]
+                    if rule is None:
+                        rule = rules[index] = FilterRule()
+                    if option == 'deadband':
+                        rule.deadband = value
+                        rule.relative = relative
+                    elif option == 'min_interval':
+                        rule.interval = value
+                    else:
+                        rule.coalesce = value
+            found = True
+            
+    return (irules, hrules) if found else None
+
+
+#
+# A Sink filtering the register changes before passing them to another sink.
+#
+# For each register with a FilterRule:
+#
+#  - A change is dropped if the value differs from the last emitted value
+#    by less than the deadband (absolute or relative). 
+#
+#  - If the previous record is more recent than the minimal interval then the
+#    record is delayed until the end of that interval. 
+#
+#  - A change starts a coalescing window during which all changes are merged
+#    into a single record with the min, max and last values (see
+#    Sink.coalesced).
+#
+# Delayed records are emitted by poll() which shall be called at regular
+# interval. 'clock' shall return the current time (see SimpleMqttApp.now).
+#
+class ChangeFilter(Sink):
+
+    def __init__(self, sink:Sink, rules, clock):
+        self.sink = sink
+        self.irules, self.hrules = rules
+        self.clock = clock
+        self.states : dict[tuple,FilterState] = {}
+        self.heap = []      # the pending records as (due, seq, key)
+        self.seq = 0
+        self.dropped = 0    # number of changes within the deadband
+        self.merged = 0     # number of changes merged into another record
+
+    def comment(self, text):
+        self.sink.comment(text)
+
+    def message(self, t, mac, frame):
+        self.sink.message(t, mac, frame)
+
+    def raw(self, t, topic, payload):
+        self.sink.raw(t, topic, payload)
+
+    def change(self, t, mac, bank, index, name, value):
+        rule = (self.irules if bank == 'i' else self.hrules)[index]
+        if rule is None:
+            self.sink.change(t, mac, bank, index, name, value)
+            return
+
+        key = (mac, bank, index)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = FilterState(name)
+
+        if state.pending and t >= state.due:
+            # The pending record is due but poll() was not called yet. Emit it
+            # so that the change starts a new record.
+            state.pending = False
+            self._emit(key, state, state.due, state.last, state.low, state.high, state.count)
+
+        if state.emitted and rule.deadband:
+            band = rule.deadband * state.value / 100 if rule.relative else rule.deadband
+            if abs(value - state.value) < band and not state.pending:
+                self.dropped += 1
+                return
+
+        if state.pending:
+            state.last  = value
+            state.low   = min(state.low, value)
+            state.high  = max(state.high, value)
+            state.count += 1
+            self.merged += 1
+            return
+
+        due = t + rule.coalesce
+        if state.emitted and rule.interval:
+            due = max(due, state.time + rule.interval)
+        if due <= t:
+            self._emit(key, state, t, value, value, value, 1)
+            return
+        
+        state.pending = True
+        state.due   = due
+        state.last  = state.low = state.high = value
+        state.count = 1
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, key))
+
+    def _emit(self, key, state, t, value, low, high, count):
+        state.emitted = True
+        state.value = value
+        state.time = t
+        mac, bank, index = key
+        if count == 1:
+            self.sink.change(t, mac, bank, index, state.name, value)
+        else:
+            self.sink.coalesced(t, mac, bank, index, state.name, value, low, high, count)
+
+    # Emit the pending records that are due before 'now'
+    def _emit_pending(self, now:float):
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            due, _, key = heapq.heappop(heap)
+            state = self.states[key]
+            if not state.pending or state.due != due:
+                continue   # already emitted by change()
+            state.pending = False
+            self._emit(key, state, due, state.last, state.low, state.high, state.count)
+
+    def poll(self):
+        self._emit_pending(self.clock())
+        self.sink.poll()
+
+    def flush(self):
+        self.sink.flush()
+
+    def close(self):
+        self._emit_pending(float('inf'))
+        if self.dropped or self.merged:
+            self.sink.comment("# {} changes within the deadband, {} changes coalesced".format(self.dropped, self.merged))
+        self.sink.close()
+
+
+#
+# The queue of MQTT events between the paho network thread and the main loop
+# of SimpleMqttApp (thread engine).
+#
+# The control events (connect, disconnect, signal) are always accepted and
+# delivered first. When 'maxsize' messages are pending (0 for unlimited), the
+# policy decides what happens to a new message:
+#
+#  - 'block':       Wait until there is room. The network thread stops reading
+#                   so the MQTT server eventually stops sending.
+#  - 'drop-oldest': Drop the oldest pending message.
+#  - 'latest':      Keep only the latest pending message of each key (see
+#                   message_key). A new message replaces the pending
+#                   message with the same key, else the oldest pending
+#                   message is dropped when the queue is full.
+#
+# The interface is a subset of queue.Queue.
+#
+QUEUE_POLICIES = [ 'block', 'drop-oldest', 'latest' ]
+
+class EventQueue:
+
+    def __init__(self, maxsize:int=0, policy:str='block'):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.control = collections.deque()
+        if policy == 'latest':
+            self.messages = collections.OrderedDict()   # by message_key() 
+        else:
+            self.messages = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0     # number of messages dropped because the queue was full
+        self.replaced = 0    # number of messages replaced by a more recent one ('latest')
+        self.max_depth = 0   # maximal number of pending messages
+
+    def qsize(self) -> int:
+        return len(self.control) + len(self.messages)
+
+    #
+    # The key of a message for the 'latest' policy: the topic and, for the
+    # MODBUS messages of the devices, the function code and the two
+    # arguments (e.g. the first register and the number of registers). So
+    # a response only replaces a response to the same request. 
+    #
+    @staticmethod
+    def message_key(msg):
+        topic = msg.topic
+        payload = msg.payload
+        if len(payload) >= 6 and topic.endswith(DEVICE_TOPIC_SUFFIXES):
+            return topic, payload[1:6]
+        return topic
+
+    def put(self, event):
+        with self.cond:
+            messages = self.messages
+            if event[0] != 'message':
+                self.control.append(event)
+            elif self.closed:
+                return
+            elif self.policy == 'latest':
+                key = self.message_key(event[1])
+                if key in messages:
+                    self.replaced += 1
+                elif self.maxsize and len(messages) >= self.maxsize:
+                    messages.popitem(last=False)
+                    self.dropped += 1
+                messages[key] = event
+            else:
+                if self.maxsize and len(messages) >= self.maxsize:
+                    if self.policy == 'block':
+                        while len(messages) >= self.maxsize and not self.closed:
+                            self.cond.wait()
+                    else:
+                        messages.popleft()
+                        self.dropped += 1
+                messages.append(event)
+            if len(messages) > self.max_depth:
+                self.max_depth = len(messages)
+            self.cond.notify_all()
+
+    def get(self, block:bool=True, timeout:float|None=None):
+        with self.cond:
+            if block and not (self.control or self.messages):
+                self.cond.wait(timeout)
+            if self.control:
+                event = self.control.popleft()
+            elif not self.messages:
+                raise queue.Empty
+            elif self.policy == 'latest':
+                event = self.messages.popitem(last=False)[1]
+            else:
+                event = self.messages.popleft()
+            self.cond.notify_all()
+            return event
+
+    def get_nowait(self):
+        return self.get(False)
+
+    # Stop blocking the producers. Later messages are ignored.
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+# Format a duration in seconds with a unit adapted to its magnitude
+def format_duration(seconds:float) -> str:
+    if seconds < 1e-3:
+        return "{:.0f}us".format(seconds*1e6)
+    if seconds < 1.0:
+        return "{:.2f}ms".format(seconds*1e3)
+    return "{:.2f}s".format(seconds)
+
+
+#
+# A histogram of durations with power of two buckets.
+#
+# Bucket k counts the durations d such that 2**(k-1) <= d < 2**k
+# microseconds so adding a value is only a few integer operations and the
+# percentiles are known within a factor of two.
+#
+class Histogram:
+
+    __slots__ = ( 'counts', 'count', 'total', 'max' )
+
+    BUCKETS = 32   # the last bucket also counts everything above 35 minutes
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds:float):
+        k = int(seconds*1e6).bit_length()
+        self.counts[k if k < self.BUCKETS else self.BUCKETS-1] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # An upper bound of the p-th quantile (0 <= p <= 1)
+    def percentile(self, p:float) -> float:
+        target = p * self.count
+        seen = 0
+        for k, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min((1<<k)*1e-6, self.max)
+        return self.max
+
+    def summary(self) -> str:
+        if not self.count:
+            return "n=0"
+        return "n={} avg={} p50<{} p99<{} max={}".format(
+            self.count, format_duration(self.total/self.count),
+            format_duration(self.percentile(0.5)), format_duration(self.percentile(0.99)),
+            format_duration(self.max))
+
+
+#
+# The instrumentation of a SimpleMqttApp (see args.stats).
+#
+# Collect, with as little overhead as possible:
+#   - queue_wait: the delay between the paho callback and the processing
+#     of a message by the main loop (thread engine only).
+#   - on_message: the time spent in on_message().
+#   - decode: the time spent in SydpowerModbus.decode() (SydpowerApp only).
+#   - rtt: the round-trip time of the requests, also per device.
+#   - the number of messages by topic, with the first level (the MAC of the
+#     Sydpower topics) replaced by '+'.
+#   - the depth of the event queue (thread engine only).
+#
+# A summary is printed on stderr every 'interval' seconds (never if 0) and
+# when the application stops.
+#
+class AppStats:
+
+    # Maximal number of devices in the 'slowest devices' line
+    SLOWEST_DEVICES = 5
+
+    def __init__(self, interval:float):
+        self.interval = interval
+        self.start = time.time()
+        self.next_report = self.start + interval
+        self.queue_wait = Histogram()
+        self.on_message = Histogram()
+        self.decode = Histogram()
+        self.rtt = Histogram()
+        self.device_rtt : dict[str,Histogram] = {}
+        self.requests = collections.Counter()    # completed requests by status
+        self.topics = collections.Counter()      # messages by topic pattern
+        self.max_depth = 0
+
+    # Return a wrapper of func adding its execution time to a histogram.
+    def timed(self, histogram:Histogram, func):
+        perf_counter = time.perf_counter
+        def wrapper(*args, **kwargs):
+            t0 = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.add(perf_counter()-t0)
+        return wrapper
+
+    def message(self, topic:str):
+        first, sep, rest = topic.partition('/')
+        self.topics['+/'+rest if sep else topic] += 1
+
+    def request(self, mac:str, request):
+        self.requests[request.status] += 1
+        if request.status != 'timeout':
+            self.rtt.add(request.rtt)
+            histogram = self.device_rtt.get(mac)
+            if histogram is None:
+                histogram = self.device_rtt[mac] = Histogram()
+            histogram.add(request.rtt)
+
+    # Called at each tic
+    def poll(self, app):
+        self.max_depth = max(self.max_depth, app.event_queue.qsize(), app.event_queue.max_depth)
+        if self.interval > 0:
+            now = time.time()
+            if now >= self.next_report:
+                self.next_report = max(self.next_report + self.interval, now)
+                self.report(app)
+
+    def report(self, app):
+        elapsed = max(time.time() - self.start, 1e-9)
+        events = app.event_queue
+        lines = []
+        total = sum(self.topics.values())
+        line = "stats: {:.1f}s, {} messages ({:.1f}/s)".format(elapsed, total, total/elapsed)
+        if app.engine == 'thread' and not app.replay:
+            # The other engines do not queue the messages
+            line += ", queue depth {} (max {}), dropped {}, replaced {}".format(
+                events.qsize(), max(self.max_depth, events.qsize()), events.dropped, events.replaced)
+        lines.append(line)
+        for name in ['queue_wait', 'on_message', 'decode', 'rtt']:
+            histogram = getattr(self, name)
+            if histogram.count:
+                lines.append("  {:<12} {}".format(name, histogram.summary()))
+        if self.requests:
+            lines.append("  requests     "+" ".join("{}={}".format(k, n) for k, n in sorted(self.requests.items())))
+        for topic, n in self.topics.most_common():
+            lines.append("  {:>9.1f}/s  {}".format(n/elapsed, topic))
+        if len(self.device_rtt) > 1:
+            slowest = sorted(self.device_rtt.items(), key=lambda item: item[1].total/item[1].count, reverse=True)
+            lines.append("  slowest devices: "+", ".join(
+                "{} {}".format(mac, format_duration(h.total/h.count)) for mac, h in slowest[:self.SLOWEST_DEVICES]))
+        print("\n".join("# "+line for line in lines), file=sys.stderr, flush=True)
+
+
+#
+# A simple base class for MQTT clients: 
+#
+# Provide:
+#   - a main loop
+#   - for MQTT event (on_connect, on_disconnect, on_subscribe, on_message) 
+#   - a callback called at regular interval (TIC)
+#
+# Two engines are available (see args.engine):
+#
+#   - 'thread' (the default): the paho network loop runs in its own thread
+#     and the MQTT events are passed to the main loop via an EventQueue.
+#
+#   - 'asyncio': the paho client is driven by an asyncio event loop (see
+#     AsyncioMqttHelper). The MQTT events are dispatched as soon as they are
+#     received, the tics are timer based and coroutines can use the
+#     awaitable methods subscribe_async() and publish_async() or be started
+#     with spawn().
+#
+# With both engines, the connection is retried until it succeeds and then
+# reestablished when lost with a delay doubling from args.reconnect_min to
+# args.reconnect_max seconds. on_connect() is called after each connection
+# and shall (re)subscribe to the topics.
+#
+# Alternatively, the messages can be replayed from a capture file (see
+# args.replay) in which case nothing is published.
+#
+class SimpleMqttApp :
+
+    # args is typically a 'argparse.Namespace' object but any object with 
+    # the following attributes will do (or use setattr(args, NAME, VALUE) to
+    # manually set attributes).
+    #
+    #  - args.mqtt_hostname   (str)       The hostname or IP address of the mqtt server
+    #  - args.mqtt_port       (int)       The MQTT port
+    #  - args.mqtt_username   (str|None)  The MQTT username
+    #  - args.mqtt_password   (str|None)  The MQTT password
+    #  - args.engine          (str)       'thread' or 'asyncio' (optional)
+    #  - args.replay          (str|None)  A capture file to replay (optional)
+    #  - args.speed           (float)     The replay speed factor or 0 for as fast as possible (optional)
+    #  - args.reconnect_min   (float)     The initial delay before reconnecting (optional)
+    #  - args.reconnect_max   (float)     The maximal delay before reconnecting (optional)
+    #  - args.queue_size      (int)       The maximal number of pending messages (optional, see EventQueue)
+    #  - args.queue_policy    (str)       What to do when the queue is full (optional, see EventQueue)
+    #  - args.stats           (float|None) Collect statistics and print them every N seconds (optional, see AppStats)
+    #
+    def __init__(self, args) :
+
+        # print(type(args))
+        
+        self.mqtt_hostname = args.mqtt_hostname
+        self.mqtt_port     = args.mqtt_port 
+        self.mqtt_username = args.mqtt_username
+        self.mqtt_password = args.mqtt_password
+
+        self.tic_interval = 0.1   # minimal interval in seconds between two tics 
+
+        self._last_tic_time = time.time()   # When self.on_tic was last called
+
+        self.event_queue = EventQueue(getattr(args, 'queue_size', 0),
+                                      getattr(args, 'queue_policy', 'block'))
+
+        self.reconnect_min = getattr(args, 'reconnect_min', 1.0)
+        self.reconnect_max = max(self.reconnect_min, getattr(args, 'reconnect_max', 60.0))
+
+        stats = getattr(args, 'stats', None)
+        self.app_stats : AppStats | None = None if stats is None else AppStats(stats)
+
+        self.result = None   # Setting this to any value will stop the run()  
+
+        self.connected = False   # True while connected to the MQTT server
+
+        self.engine = getattr(args, 'engine', 'thread')
+        self.loop : asyncio.AbstractEventLoop | None = None   # The asyncio loop (when running)
+        self._tasks : set[asyncio.Task] = set()
+        self._spawn_pending : list = []     # coroutines spawned before the loop is started  
+        self._mid_futures : dict[int,asyncio.Future] = {}   # see subscribe_async and publish_async
+        self._done : asyncio.Future | None = None
+
+        self.replay = getattr(args, 'replay', None)
+        self.replay_speed = getattr(args, 'speed', 1.0)
+        self._now : float | None = None   # The current time while replaying
+
+        # The topic filters of the application. The replay will only provide
+        # messages matching one of them.
+        self.topics : list[str] = [ '#' ]
+
+        self.mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            
+        if self.mqtt_username:
+            self.mqtt_client.username_pw_set(self.mqtt_username, self.mqtt_password)
+
+        self.mqtt_client.on_connect    = self._on_connect_cb
+        self.mqtt_client.on_connect_fail = self._on_connect_fail_cb
+        self.mqtt_client.on_disconnect = self._on_disconnect_cb
+        self.mqtt_client.on_message    = self._on_message_cb
+        self.mqtt_client.on_subscribe  = self._on_subscribe_cb
+        self.mqtt_client.on_publish    = self._on_publish_cb
+
+    # With the asyncio engine, the paho callbacks are executed by the event
+    # loop so the events can be processed immediately.
+    #
+    # An exception must not escape to paho (called by an add_reader callback)
+    # because the packet would be read again and again. It stops run_async()
+    # instead, as it stops the thread engine.
+    def _post_event(self, event):
+        if self.loop:
+            if self._done.done():
+                return
+            try:
+                self._process_event(event)
+            except Exception as e:
+                self._done.set_exception(e)
+                return
+            self._check_done()
+        else:
+            self.event_queue.put(event)
+
+    def _on_connect_cb(self, client, userdata, flags, reason_code, properties):
+        self._post_event( ['connect', flags, reason_code, properties ] )
+
+    def _on_disconnect_cb(self, client, userdata, flags, reason_code, properties):
+        self._post_event( ['disconnect', flags, reason_code, properties ] )
+
+    # Called from the paho thread or by AsyncioMqttHelper
+    def _on_connect_fail_cb(self, client, userdata):
+        print("# cannot connect to the MQTT server '{}' port {}, retrying".format(self.mqtt_hostname, self.mqtt_port),
+              file=sys.stderr, flush=True)
+        
+    def _on_message_cb(self, client, userdata, msg):
+        self._post_event( ['message', msg ] )
+
+    def _on_publish_cb(self, client, userdata, mid, reason_code, properties):
+        future = self._mid_futures.pop(mid, None)
+        if future and not future.done():
+            future.set_result(reason_code)
+
+    def _on_subscribe_cb(self, client, userdata, mid, reason_code_list, properties):
+        # TODO 
+        # See /usr/lib/python3/dist-packages/paho/mqtt/reasoncodes.py
+        # Note: is rc.value supposed to be a public attribute
+        #       or are we supposed to use rc.is_failure to detect failure and
+        #       then rc.getName() to display the reason?
+        # Also the 'mid' would need to be matched with the result of
+        # the client.subscribe() call.
+        for rc in reason_code_list:
+            if rc.is_failure:                
+                print("==> Warning subscribe error mid=%d value=%d name='%s' "
+                      % ( mid, rc.value, rc.getName() ) )
+        future = self._mid_futures.pop(mid, None)
+        if future and not future.done():
+            future.set_result(reason_code_list)
+
+    #
+    # For now, this is just an alias for self.client.subscribe(...)
+    # 
+    # TODO: Check for success in on_subscribe_cb
+    #
+    def subscribe(self, topic, qos=0):
+        return self.mqtt_client.subscribe(topic,qos)  
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        if self.replay:
+            return None
+        return self.mqtt_client.publish(topic, payload, qos, retain, properties)  
+
+    # The current time or, during a replay, the receive time of the last message. 
+    def now(self) -> float:
+        if self._now is None:
+            return time.time()
+        return self._now
+
+    # The time when a message was received by paho (or recorded)
+    def receive_time(self, msg) -> float:
+        if isinstance(msg, CapturedMessage):
+            return msg.time
+        # paho uses time.monotonic() for its timestamps 
+        return time.time() - (time.monotonic() - msg.timestamp)
+
+    #
+    # Awaitable variant of subscribe() for the asyncio engine.
+    #
+    # Return the list of reason codes from the SUBACK.
+    #
+    async def subscribe_async(self, topic, qos=0):
+        result, mid = self.mqtt_client.subscribe(topic,qos)
+        if result != mqtt.MQTT_ERR_SUCCESS:
+            raise Exception("[mqtt] subscribe failed: "+mqtt.error_string(result))
+        future = self.loop.create_future()
+        self._mid_futures[mid] = future
+        return await future
+
+    #
+    # Awaitable variant of publish() for the asyncio engine.
+    #
+    # Complete when the message is sent (QoS 0) or acknowledged (QoS 1 and 2). 
+    #
+    async def publish_async(self, topic, payload, qos=0, retain=False, properties=None):
+        info = self.mqtt_client.publish(topic, payload, qos, retain, properties)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise Exception("[mqtt] publish failed: "+mqtt.error_string(info.rc))
+        if not info.is_published():
+            future = self.loop.create_future()
+            self._mid_futures[info.mid] = future
+            await future
+        return info
+
+    #
+    # Run a coroutine as a task of the asyncio engine.
+    #
+    # Coroutines spawned before the engine is started are delayed until then.
+    #
+    def spawn(self, coro):
+        if self.loop is None:
+            self._spawn_pending.append(coro)
+            return None
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task:asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() and self._done and not self._done.done():
+            self._done.set_exception(task.exception())
+    
+    def on_message(self, msg):
+        print("# "+msg.topic+" "+ msg.payload.hex())
+
+    def on_connect(self, flags, reason_code, properties):
+        pass
+    
+    def on_disconnect(self, flags, reason_code, properties):
+        print("# disconnected from the MQTT server ({}), reconnecting".format(reason_code), file=sys.stderr, flush=True)
+
+    def on_tic(self):
+        pass
+
+    def _tic(self):
+        self.on_tic()
+        if self.app_stats:
+            self.app_stats.poll(self)
+
+    # Call on_message() (and measure it when collecting statistics)
+    def _deliver(self, msg):
+        stats = self.app_stats
+        if stats is None:
+            self.on_message(msg)
+            return
+        stats.message(msg.topic)
+        t0 = time.perf_counter()
+        try:
+            self.on_message(msg)
+        finally:
+            stats.on_message.add(time.perf_counter()-t0)
+
+    def _process_event(self, event):
+        if event[0] == 'message' :
+            msg = event[1]
+            if self.app_stats and msg.timestamp and not self.loop:
+                # paho uses time.monotonic() for its timestamps 
+                self.app_stats.queue_wait.add(time.monotonic()-msg.timestamp)
+            self._deliver(msg)
+        elif event[0] == 'connect' :
+            self.connected = not event[2].is_failure
+            self.on_connect(event[1],event[2],event[3]) 
+        elif event[0] == 'disconnect' :
+            self.connected = False
+            self.on_disconnect(event[1],event[2],event[3]) 
+        elif event[0] == 'signal' :                
+            self.on_signal(event[1]) 
+        else:
+            print('Warning: Unexpected event kind ', event[0])
+
+    # Start connecting. The connection is retried until it succeeds. 
+    #
+    # This only sets the connection parameters. The thread of loop_start()
+    # or, with the asyncio engine, AsyncioMqttHelper connects and reconnects
+    # without blocking the main loop.
+    def _connect(self):
+        self.mqtt_client.reconnect_delay_set(self.reconnect_min, self.reconnect_max)
+        self.mqtt_client.connect_async(self.mqtt_hostname, self.mqtt_port, 60)
+            
+    def run(self) :
+        try:
+            if self.replay:
+                return self.run_replay()
+            if self.engine == 'asyncio':
+                return asyncio.run(self.run_async())
+            return self.run_thread()
+        finally:
+            if self.app_stats:
+                self.app_stats.report(self)
+
+    # The main loop of the thread engine
+    def run_thread(self):
+        self._connect()
+            
+        self.mqtt_client.loop_start()
+
+        # Wait for the events until the next tic (so that the tics of short
+        # intervals, e.g. in the simulator, are not delayed)
+        timeout = self.tic_interval
+        while True:
+            try:
+                event = self.event_queue.get(True, timeout) 
+                self._process_event(event)
+            except queue.Empty as err:
+                pass
+            except queue.Full as err:
+                print(repr(err))            
+
+            if not self.result is None:
+                break
+                
+            now = time.time()
+            next_tic = self._last_tic_time + self.tic_interval 
+            if now >= next_tic: 
+                self._last_tic_time = now 
+                self._tic()
+                timeout = self.tic_interval
+            else:
+                timeout = next_tic-now
+
+            if not self.result is None:
+                break
+
+        self.event_queue.close()
+        self.mqtt_client.loop_stop()
+        queue_stats = self.event_queue
+        if queue_stats.dropped or queue_stats.replaced:
+            print("# event queue: {} messages dropped, {} replaced, max depth {}".format(
+                queue_stats.dropped, queue_stats.replaced, queue_stats.max_depth), file=sys.stderr)
+        return self.result
+
+    #
+    # The main loop when replaying a capture file (or a pcap file or a
+    # mosquitto_sub dump, see open_capture).
+    #
+    # The messages are delivered at their original pace multiplied by
+    # self.replay_speed (or as fast as possible when 0) and on_tic() is
+    # called according to the replay time.
+    #
+    def run_replay(self):
+        reader = open_capture(self.replay, self.mqtt_port)
+        speed = self.replay_speed
+        selected : dict[str,bool] = {}
+        start = None
+        for msg in reader:
+            ok = selected.get(msg.topic)
+            if ok is None:
+                ok = any( mqtt.topic_matches_sub(t, msg.topic) for t in self.topics )
+                selected[msg.topic] = ok
+            if not ok:
+                continue
+            if start is None:
+                start = time.time()
+                origin = msg.time
+                self._last_tic_time = origin
+            if speed > 0:
+                delay = start + (msg.time-origin)/speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self._now = msg.time
+            self._deliver(msg)
+            if self._now >= self._last_tic_time + self.tic_interval:
+                self._last_tic_time = self._now 
+                self._tic()
+            if self.result is not None:
+                break
+        reader.close()
+        return self.result
+
+    def _check_done(self):
+        if self.result is not None and self._done and not self._done.done():
+            self._done.set_result(self.result)
+
+    # Call on_tic() at regular interval using a timer 
+    async def _tic_loop(self):
+        while True:
+            next_tic = self._last_tic_time + self.tic_interval
+            delay = next_tic - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last_tic_time = time.time()
+            self._tic()
+            self._check_done()
+
+    #
+    # A coroutine started by the asyncio engine once connected.
+    #
+    # Applications may override it to implement their main logic as a
+    # coroutine. Returning does not stop the application (set self.result
+    # for that).
+    #
+    async def main_async(self):
+        pass
+        
+    # The main loop of the asyncio engine 
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self._done = self.loop.create_future()
+        helper = AsyncioMqttHelper(self.loop, self.mqtt_client, self.reconnect_min, self.reconnect_max)
+        self._connect()
+        for coro in self._spawn_pending:
+            self.spawn(coro)
+        self._spawn_pending = []
+        self.spawn(self._tic_loop())
+        self.spawn(self.main_async())
+        try:
+            return await self._done
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+            self.mqtt_client.disconnect()
+            helper.close()
+            self.loop = None
+
+
+#
+# Drive a paho client from an asyncio event loop instead of a network thread.
+#
+# This is the integration recommended by paho: the socket is registered in
+# the event loop (add_reader/add_writer) and loop_misc() is called
+# periodically for the keep-alive. The client is connected (see
+# connect_async) and reconnected after a connection loss with a delay
+# doubling from min_delay to max_delay seconds after each failure.
+#
+# The connection (name resolution and TCP connection) is blocking so it
+# runs in the default executor. The socket callbacks called from that thread
+# are forwarded to the event loop.
+#
+class AsyncioMqttHelper:
+
+    def __init__(self, loop:asyncio.AbstractEventLoop, client:mqtt.Client, min_delay:float=1.0, max_delay:float=60.0):
+        self.loop = loop
+        self.client = client
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.thread = threading.get_ident()   # the thread of the event loop
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.misc = loop.create_task(self.misc_loop())
+
+    # Call func in the event loop
+    def _call(self, func, *args):
+        if threading.get_ident() == self.thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self.loop.add_reader, sock, client.loop_read)
+
+    # The socket is closed after the call so its file descriptor is used
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self.loop.remove_reader, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock.fileno())
+
+    async def misc_loop(self):
+        delay = self.min_delay
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    delay = self.min_delay
+                except OSError:
+                    if self.client.on_connect_fail:
+                        self.client.on_connect_fail(self.client, None)
+                    await asyncio.sleep(delay)
+                    delay = min(2*delay, self.max_delay)
+                    continue
+            await asyncio.sleep(1)
+
+    def close(self):
+        self.misc.cancel()
+
+# Suffixes of the device topics (i.e. the part following 'MAC/')
+TOPIC_SUFFIX_REQUEST     = 'client/request/data'
+TOPIC_SUFFIX_RESPONSE    = 'device/response/client/data'
+TOPIC_SUFFIX_RESPONSE_04 = 'device/response/client/04'
+DEVICE_TOPIC_SUFFIXES    = ( TOPIC_SUFFIX_REQUEST, TOPIC_SUFFIX_RESPONSE, TOPIC_SUFFIX_RESPONSE_04 )
+
+#
+# The state associated to a single device.
+#
+# In fleet mode, a SydpowerApp may have to manage thousands of those
+# so keep them small. Applications that need more per-device state shall
+# derive that class (with its own __slots__) and set DEVICE_CLASS accordingly.
+#
+class SydpowerDevice:
+
+    __slots__ = ( 'mac', 'topic_request', 'pending', 'inflight', 'next_request_time' )
+
+    def __init__(self, mac:str):
+        self.mac = mac
+        self.topic_request = mac+'/'+TOPIC_SUFFIX_REQUEST
+        # The state of the RequestScheduler for that device 
+        self.pending : collections.deque | None = None   # created on demand
+        self.inflight : SydpowerRequest | None = None
+        self.next_request_time = 0.0
+
+
+#
+# A MODBUS request managed by the RequestScheduler.
+#
+# For read functions (0x03 and 0x04), arg1 and arg2 are the index of the
+# first register and the number of registers. For the write function
+# (0x06), they are the register index and its new value. 
+#
+# Once completed, the status is one of
+#  - 'done'     when a matching response was received (see response)
+#  - 'error'    when the device replied with an error code (e.g. 0x83)
+#  - 'timeout'  when no response was received after all retries
+#
+class SydpowerRequest:
+
+    __slots__ = ( 'func', 'arg1', 'arg2', 'msg', 'callback', 'not_before',
+                  'tries', 'sent_time', 'deadline', 'status', 'response', 'rtt' )
+
+    def __init__(self, func:int, arg1:int, arg2:int, msg:bytes, callback=None, not_before:float=0.0):
+        self.func       = func
+        self.arg1       = arg1
+        self.arg2       = arg2
+        self.msg        = msg
+        self.callback   = callback      # called as callback(device, request) on completion 
+        self.not_before = not_before    # do not send before that time
+        self.tries      = 0             # number of times the request was sent
+        self.sent_time  = 0.0           # when the request was last sent
+        self.deadline   = 0.0           # when the in-flight request times out
+        self.status : str | None = None
+        self.response : bytes | None = None
+        self.rtt : float | None = None  # round-trip time of the last try 
+
+    def __repr__(self):
+        return "SydpowerRequest(0x{:02x},{},{})".format(self.func, self.arg1, self.arg2)
+
+
+#
+# Send MODBUS requests to the devices of a SydpowerApp while keeping at most
+# one request in-flight per device.
+#
+# The devices are known to ignore requests received while a previous request
+# is still pending (see MQTT-MODBUS.md) so the requests for a device are
+# queued and the next one is sent as soon as the response to the previous one
+# is received (plus an optional spacing). A response is matched to the
+# in-flight request using its function code and its two arguments. Requests
+# without response are re-sent after a timeout.
+#
+# The application must call 
+#   - on_response() for each MQTT message received on a response topic.
+#   - poll() at regular interval (typically in on_tic) to handle the timeouts
+#     and the delayed requests. 
+#
+class RequestScheduler:
+
+    def __init__(self, app, timeout:float=2.0, retries:int=2, spacing:float=0.0):
+        self.app     = app
+        self.timeout = timeout   # in seconds
+        self.retries = retries   # number of retries after the first try 
+        self.spacing = spacing   # minimal delay between a response and the next request 
+        self.busy : set[SydpowerDevice] = set()   # devices with pending or in-flight requests
+
+    def submit(self, device:SydpowerDevice, func:int, arg1:int, arg2:int,
+               callback=None, not_before:float=0.0) -> SydpowerRequest :
+        msg = bytes(self.app.modbus.encode_request(func, arg1, arg2))
+        request = SydpowerRequest(func, arg1, arg2, msg, callback, not_before)
+        if device.pending is None:
+            device.pending = collections.deque()
+        device.pending.append(request)
+        self.busy.add(device)
+        self._dispatch(device, time.time())
+        return request
+
+    def ReadHoldingRegisters(self, device:SydpowerDevice, start:int, count:int, callback=None, not_before:float=0.0):
+        return self.submit(device, SydpowerModbus.FUNC_READ_HOLDING_REGISTERS, start, count, callback, not_before)
+
+    def ReadInputRegisters(self, device:SydpowerDevice, start:int, count:int, callback=None, not_before:float=0.0):
+        return self.submit(device, SydpowerModbus.FUNC_READ_INPUT_REGISTERS, start, count, callback, not_before)
+
+    def WriteHoldingRegister(self, device:SydpowerDevice, index:int, value:int, callback=None, not_before:float=0.0):
+        return self.submit(device, SydpowerModbus.FUNC_WRITE_HOLDING_REGISTER, index, value, callback, not_before)
+
+    # Return True if the device has no pending or in-flight request
+    def idle(self, device:SydpowerDevice) -> bool:
+        return device not in self.busy
+
+    #
+    # Return the payload of a MQTT message received on a response topic if
+    # it can be the response to a request or None if it cannot: 
+    #  - a retained message is the last response known by the MQTT server
+    #    (e.g. sent before the request),
+    #  - the 04 topic only carries the responses to ReadInputRegisters, 
+    #  - the CRC must be valid.
+    #
+    def response_payload(self, msg) -> bytes | None:
+        payload = msg.payload
+        if msg.retain or len(payload) < 4:
+            return None
+        if msg.topic.endswith(TOPIC_SUFFIX_RESPONSE_04) and payload[1] & 0x7F != SydpowerModbus.FUNC_READ_INPUT_REGISTERS:
+            return None
+        if not self.app.modbus.check_crc(payload):
+            return None
+        return payload
+    
+    #
+    # Process a MQTT message received on a response topic of a device.
+    #
+    # Return the in-flight request that was completed by that response or
+    # None if the message does not match the in-flight request (see also
+    # response_payload).
+    #
+    def on_response(self, device:SydpowerDevice, msg) -> SydpowerRequest | None:
+        request = device.inflight
+        if request is None:
+            return None
+        msg = self.response_payload(msg)
+        if msg is None:
+            return None
+        func = msg[1]
+        if func == request.func:
+            if len(msg) < 6 or ((msg[2]<<8)|msg[3]) != request.arg1 or ((msg[4]<<8)|msg[5]) != request.arg2:
+                return None
+            status = 'done'
+        elif func == request.func | 0x80:
+            status = 'error'
+        else:
+            return None
+        now = time.time()
+        request.rtt = now - request.sent_time
+        request.response = msg
+        self._complete(device, request, status, now)
+        return request
+
+    # Handle the timeouts and send the delayed requests.
+    def poll(self):
+        now = time.time()
+        for device in list(self.busy):
+            request = device.inflight
+            if request and now >= request.deadline:
+                if request.tries <= self.retries:
+                    self._send(device, request, now)
+                else:
+                    self._complete(device, request, 'timeout', now)
+            self._dispatch(device, now)
+
+    def _complete(self, device:SydpowerDevice, request:SydpowerRequest, status:str, now:float):
+        device.inflight = None
+        device.next_request_time = now + self.spacing
+        request.status = status
+        if self.app.app_stats:
+            self.app.app_stats.request(device.mac, request)
+        if request.callback:
+            request.callback(device, request)
+        self._dispatch(device, now)
+
+    def _send(self, device:SydpowerDevice, request:SydpowerRequest, now:float):
+        request.tries    += 1
+        request.sent_time = now
+        request.deadline  = now + self.timeout
+        self.app.publish(device.topic_request, request.msg)
+
+    # Send the next request of a device if possible
+    def _dispatch(self, device:SydpowerDevice, now:float):
+        if device.inflight or not self.app.connected:
+            return
+        if not device.pending:
+            self.busy.discard(device)
+            return
+        request = device.pending[0]
+        if now < request.not_before or now < device.next_request_time:
+            return
+        device.pending.popleft()
+        device.inflight = request
+        self._send(device, request, now)
+
+
+# The result of a write in SydpowerApp.write_holding_registers()
+class HoldingWrite:
+
+    __slots__ = ( 'index', 'value', 'status', 'readback' )
+    
+    def __init__(self, index:int, value:int):
+        self.index = index
+        self.value = value
+        self.status : str | None = None    # the status of the write request (see SydpowerRequest)
+        self.readback : int | None = None  # the value read after all writes
+
+    @property
+    def verified(self) -> bool:
+        return self.status == 'done' and self.readback == self.value
+
+    
+# A base class for clients of Sydpower MQTT
+#
+# Currently, only works with a LOCAL MQTT server optained by 
+# redefining the DNS of mqtt.sydpower.com
+#
+# TODO: Implement cloud authentication to connect to the real mqtt.sydpower.com
+#
+# By default, the application is bound to the device given by args.mac (or
+# to the devices given by a comma separated list of MAC addresses).
+#
+# In fleet mode (args.fleet), the application subscribes to the topics of all
+# devices using wildcards and a SydpowerDevice is created on the fly the first
+# time a MAC address is seen. Use self.route() to find the device of a
+# message. 
+#
+class SydpowerApp(SimpleMqttApp):
+
+    DEVICE_CLASS = SydpowerDevice
+    
+    def __init__(self, args):
+        super().__init__(args)
+
+        self.modbus = SydpowerModbus()
+        if self.app_stats:
+            self.modbus.decode = self.app_stats.timed(self.app_stats.decode, self.modbus.decode)
+            self.modbus.decode_frame = self.app_stats.timed(self.app_stats.decode, self.modbus.decode_frame)
+        self.args = args
+        self.fleet = getattr(args, 'fleet', False)
+
+        # All known devices indexed by their MAC address. 
+        self.devices : dict[str,SydpowerDevice] = {}
+
+        self.scheduler = RequestScheduler(self,
+                                          timeout = getattr(args, 'request_timeout', 2.0),
+                                          retries = getattr(args, 'request_retries', 2))
+
+        # Where the records are written (see create_output_sink)
+        self.output : OutputSink | None = None
+
+        if self.fleet:
+            self.mac = None
+            self.topics = [ '+/device/response/#',
+                            '+/'+TOPIC_SUFFIX_REQUEST ]
+        elif args.mac: 
+            macs = args.mac.upper().split(',')
+            self.mac = macs[0]
+            self.TOPIC_ALL         = self.mac+'/#'
+            self.TOPIC_REQUEST     = self.mac+'/'+TOPIC_SUFFIX_REQUEST
+            self.TOPIC_RESPONSE    = self.mac+'/'+TOPIC_SUFFIX_RESPONSE
+            self.TOPIC_RESPONSE_04 = self.mac+'/'+TOPIC_SUFFIX_RESPONSE_04
+            self.topics = [ mac+'/#' for mac in macs ]
+            for mac in macs:
+                self.add_device(mac)
+        else:
+            print("Error: no device mac address was specified")
+            sys.exit(1)
+
+    def add_device(self, mac:str) -> SydpowerDevice:
+        device = self.DEVICE_CLASS(mac)
+        self.devices[mac] = device
+        self.on_new_device(device)
+        return device
+
+    # Called each time a new device is added.
+    def on_new_device(self, device:SydpowerDevice):
+        pass
+
+    # In fleet mode, a malformed message from a device is reported and
+    # ignored so that it does not stop the processing of all devices. 
+    def _deliver(self, msg):
+        if not self.fleet:
+            return super()._deliver(msg)
+        try:
+            super()._deliver(msg)
+        except ModbusError as e:
+            print("# {}: {} in {}".format(msg.topic.partition('/')[0], e, msg.payload.hex()),
+                  file=sys.stderr, flush=True)
+
+    #
+    # Split a topic of the form MAC/SUFFIX and return the matching device and
+    # the suffix.
+    #
+    # The device is None if the topic does not belong to a known device. In
+    # fleet mode, new devices are automatically added.
+    #
+    def route(self, topic:str) -> tuple[SydpowerDevice|None, str]:
+        mac, _, suffix = topic.partition('/')
+        device = self.devices.get(mac)
+        if device is None and self.fleet and suffix:
+            device = self.add_device(mac)
+        return device, suffix
+
+    # Display an informational line
+    def comment(self, text:str):
+        if self.output:
+            self.output.comment(text)
+        else:
+            print(text, flush=True)
+
+    def on_connect(self, flags, reason_code, properties):
+        for t in self.topics:
+            self.comment("# subscribing to "+t)
+            self.subscribe(t)
+
+    def run(self):
+        try:
+            return super().run()
+        finally:
+            if self.output:
+                self.output.close()
+
+    #
+    # Awaitable request for the asyncio engine. 
+    #
+    # The request is sent by the scheduler and the result is the completed
+    # SydpowerRequest (see its status).
+    #
+    async def request(self, device:SydpowerDevice, func:int, arg1:int, arg2:int) -> SydpowerRequest :
+        future = self.loop.create_future()
+        def done(device, request):
+            if not future.done():
+                future.set_result(request)
+        self.scheduler.submit(device, func, arg1, arg2, done)
+        return await future
+
+    #
+    # Write some holding registers of a device and verify the new values. 
+    #
+    # The writes are queued in the scheduler (so sent one at a time as fast
+    # as the device answers) followed by a single ReadHoldingRegisters 
+    # covering all written registers because the response of a write does
+    # not prove that the value was changed (see MQTT-MODBUS.md).
+    #
+    # callback(device, writes) is called with a list of HoldingWrite once
+    # the verification is done.
+    #
+    def write_holding_registers(self, device:SydpowerDevice, values:list[tuple[int,int]], callback):
+        writes = [ HoldingWrite(index, value) for index, value in values ]
+        for write in writes:
+            def written(device, request, write=write):
+                write.status = request.status
+            self.scheduler.WriteHoldingRegister(device, write.index, write.value, written)
+        start = min(write.index for write in writes)
+        count = max(write.index for write in writes) - start + 1
+        def verify(device, request):
+            if request.status == 'done':
+                func, args, payload, crc = self.modbus.decode(request.response, 'response', False)
+                for write in writes:
+                    write.readback = payload[write.index-start]
+            callback(device, writes)
+        self.scheduler.ReadHoldingRegisters(device, start, count, verify)
+
+    # When device is None, publish to the device given by --mac
+    def publish_ReadHoldingRegisters(self, start:int , count:int, device:SydpowerDevice|None=None):
+        msg = self.modbus.encode_ReadHoldingRegisters(start, count)
+        device = device or self.devices[self.mac]
+        self.publish(device.topic_request, msg) 
+
+    # When device is None, publish to the device given by --mac
+    def publish_ReadInputRegisters(self, start:int, count:int, device:SydpowerDevice|None=None):
+        msg = self.modbus.encode_ReadInputRegisters(start, count)
+        device = device or self.devices[self.mac]
+        self.publish(device.topic_request, msg) 
+        
+
+# Monitor all messages  
+class AppMonitor(SydpowerApp):
+    
+    def __init__(self, args):
+        super().__init__(args)
+        self.output = create_output_sink(args, self.fleet)
+
+    def on_tic(self):
+        self.output.poll()
+        
+    def on_message(self, msg):
+        device, suffix = self.route(msg.topic)
+        if device is None:
+            self.output.raw(self.receive_time(msg), msg.topic, msg.payload)
+            return
+        elif suffix == TOPIC_SUFFIX_REQUEST:
+            frame = self.modbus.decode_frame(msg.payload,'request')
+        elif suffix == TOPIC_SUFFIX_RESPONSE or suffix == TOPIC_SUFFIX_RESPONSE_04:
+            frame = self.modbus.decode_frame(msg.payload,'response') 
+        else:
+            self.output.raw(self.receive_time(msg), msg.topic, msg.payload)
+            return
+
+        self.output.message(self.receive_time(msg), device.mac, frame)
+
+
+# The per-device state of AppTrace.
+#
+# The last known register values of each bank are stored in a fixed
+# array('H') indexed by register index. 
+#
+# The 'known' masks are integers where the 16 bits 16*i..16*i+15 are set
+# when the value of register i is known (see AppTrace.trace_response). 
+class TraceDevice(SydpowerDevice):
+
+    __slots__ = ( 'iregs', 'hregs', 'iknown', 'hknown', 'step',
+                  'changes', 'volatility', 'due', 'query', 'wakeup' )
+
+    def __init__(self, mac:str):
+        super().__init__(mac)
+        self.iregs = array.array('H', bytes(2*IREG_COUNT))
+        self.hregs = array.array('H', bytes(2*HREG_COUNT))
+        self.iknown = 0
+        self.hknown = 0
+        self.step = 0    # the position of the next query in AppTrace.plan
+        self.changes = 0 # the mask of the traced registers changed by the last response 
+        # For adaptive polling (see AppTrace.on_query_done)
+        self.volatility : list[float] | None = None   # per query of the plan 
+        self.due : list[float] | None = None          # per query of the plan
+        self.query : SydpowerRequest | None = None    # the last submitted query 
+        self.wakeup : asyncio.Event | None = None     # wake up query_loop()
+
+        
+# Trace changes to registers
+class AppTrace(SydpowerApp):
+
+    DEVICE_CLASS = TraceDevice
+
+    # The registers traced when no target is given
+    DEFAULT_TARGETS = [ "ALL" ]
+
+    # The weight of the last query in the volatility (adaptive polling)
+    VOLATILITY_ALPHA = 0.3
+    
+    def __init__(self, args):
+        # The queries are started at the end for the devices added by SydpowerApp 
+        self.plan = []
+        super().__init__(args)
+        self.tic_interval = 0.1 if args.query else 2
+        self.adaptive = getattr(args, 'adaptive', False)
+        self.max_interval = max(getattr(args, 'max_interval', 60.0), args.interval)
+        self.status_lane = register_mask([ ireg_name_to_index('iStatusBits') ])
+
+        iregs, hregs = parse_register_names( args.target or self.DEFAULT_TARGETS )
+
+        if getattr(args, 'units', False):
+            enable_scaled_formatters()
+        self.output = self.create_output(args)
+        rules = parse_filter_rules(args)
+        if rules:
+            self.output = ChangeFilter(self.output, rules, self.now)
+        self.comment("Tracing inputs:  "+" ".join(iregs) ) 
+        self.comment("Tracing holdings:  "+" ".join(hregs) )
+
+        # The names of the traced registers indexed by register index (or None if not traced).
+        # That is shared by all devices.
+        self.iregs = [ None ] * IREG_COUNT
+        self.hregs = [ None ] * HREG_COUNT
+        for name in iregs:
+            self.iregs[ireg_name_to_index(name)] = name
+        for name in hregs:
+            self.hregs[hreg_name_to_index(name)] = name
+
+        # The masks of the traced registers (see TraceDevice)
+        self.imask = register_mask( ireg_name_to_index(name) for name in iregs )
+        self.hmask = register_mask( hreg_name_to_index(name) for name in hregs )
+
+        # Optional store for the history of all registers
+        self.history = None
+        if getattr(args, 'history', None):
+            self.history = HistoryStore(args.history)
+
+        self.plan = self.plan_queries(iregs, hregs)
+        if args.query:
+            self.comment("Query plan: " + " ".join( "{}[{}:{}]".format('h' if func == SydpowerModbus.FUNC_READ_HOLDING_REGISTERS else 'i',
+                                                                       start, start+count)
+                                                    for func, start, count in self.plan ))
+            for device in self.devices.values():
+                self.on_new_device(device)
+
+    #
+    # Compute the list of (func,start,count) read requests performed in
+    # a loop to query the traced registers (see plan_register_reads).
+    #
+    # The input registers are read in full unless args.partial_inputs is
+    # set because the 0x04 responses are retained by the MQTT server and
+    # other clients may expect them to provide all registers (see 
+    # MQTT-MODBUS.md).
+    #
+    # In adaptive mode, iStatusBits is always queried (see on_status_change). 
+    #
+    def plan_queries(self, iregs:list[str], hregs:list[str]) -> list[tuple[int,int,int]]:
+        cost = getattr(self.args, 'request_cost', READ_REQUEST_COST)
+        if self.adaptive and 'iStatusBits' not in iregs:
+            iregs = iregs + [ 'iStatusBits' ]
+        plan = [ (SydpowerModbus.FUNC_READ_HOLDING_REGISTERS, start, count)
+                 for start, count in plan_register_reads(map(hreg_name_to_index, hregs), cost) ]
+        if getattr(self.args, 'partial_inputs', False):
+            plan += [ (SydpowerModbus.FUNC_READ_INPUT_REGISTERS, start, count)
+                      for start, count in plan_register_reads(map(ireg_name_to_index, iregs), cost) ]
+        elif iregs:
+            plan.append( (SydpowerModbus.FUNC_READ_INPUT_REGISTERS, 0, IREG_COUNT) )
+        return plan
+
+
+    # Create the sink receiving the register changes 
+    def create_output(self, args):
+        return create_output_sink(args, self.fleet)
+               
+    def on_new_device(self, device:TraceDevice):
+        if self.args.query and self.plan:
+            if self.adaptive:
+                device.volatility = [ 1.0 ] * len(self.plan)
+                device.due = [ 0.0 ] * len(self.plan)
+            if self.engine == 'asyncio':
+                self.spawn(self.query_loop(device))
+            else:
+                func, start, count = self.plan[0]
+                device.query = self.scheduler.submit(device, func, start, count, self.on_query_done)
+
+    #
+    # Perform the queries of self.plan in a loop but not too fast because
+    # the device can only process one request at a time. 
+    #
+    # The scheduler sends the next query as soon as the previous one is
+    # answered but no sooner than args.interval seconds after it.
+    #
+    # In adaptive mode, the volatility of each query is the exponentially
+    # weighted moving average of 1 when a traced register was changed by
+    # the response and 0 otherwise. The query is then repeated after
+    # args.interval/volatility seconds (up to args.max_interval) so the
+    # stable registers are queried less often. 
+    #
+    def on_query_done(self, device:TraceDevice, request:SydpowerRequest):
+        not_before = self.next_query(device, request)
+        func, start, count = self.plan[device.step]
+        device.query = self.scheduler.submit(device, func, start, count, self.on_query_done, not_before)
+
+    # Select the next query in device.step and return when to send it.
+    def next_query(self, device:TraceDevice, request:SydpowerRequest) -> float:
+        not_before = request.sent_time + self.args.interval
+        if not self.adaptive:
+            device.step = (device.step + 1) % len(self.plan)
+            return not_before
+        step = device.step
+        changed = 1.0 if request.status == 'done' and device.changes else 0.0
+        volatility = device.volatility[step]
+        volatility += self.VOLATILITY_ALPHA * (changed - volatility)
+        device.volatility[step] = volatility
+        if volatility * self.max_interval > self.args.interval:
+            period = self.args.interval / volatility
+        else:
+            period = self.max_interval
+        device.due[step] = request.sent_time + period
+        due = device.due
+        device.step = step = min(range(len(due)), key=due.__getitem__)
+        return max(not_before, due[step])
+
+    # Same as on_query_done() but as a coroutine for the asyncio engine. 
+    async def query_loop(self, device:TraceDevice):
+        device.wakeup = asyncio.Event()
+        while True:
+            func, start, count = self.plan[device.step]
+            request = await self.request(device, func, start, count)
+            delay = self.next_query(device, request) - time.time()
+            if delay > 0:
+                device.wakeup.clear()
+                try:
+                    await asyncio.wait_for(device.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    #
+    # Called when the value of iStatusBits changes (e.g. AC input connected)
+    # which usually means that other registers are about to change.
+    #
+    # In adaptive mode, all queries are considered volatile again and the
+    # pending query is sent as soon as possible.
+    #
+    def on_status_change(self, device:TraceDevice):
+        if not self.adaptive or device.volatility is None:
+            return
+        for step in range(len(self.plan)):
+            device.volatility[step] = 1.0
+            device.due[step] = 0.0
+        if device.query and device.query.status is None:
+            device.query.not_before = 0.0
+        if device.wakeup:
+            device.wakeup.set()
+
+    def on_tic(self):
+        self.scheduler.poll()
+        self.output.poll()
+        if self.history:
+            self.history.flush(self.now())
+
+    def run(self):
+        try:
+            return super().run()
+        finally:
+            if self.history:
+                self.history.close()
+    
+    def on_message(self, msg):
+
+        device, suffix = self.route(msg.topic)
+        if device is None:
+            pass
+        elif suffix == TOPIC_SUFFIX_RESPONSE or suffix == TOPIC_SUFFIX_RESPONSE_04 :
+            # Trace first so that the query callback knows about the changes  
+            self.trace_response(device, self.modbus.decode_frame(msg.payload,'response'))
+            self.scheduler.on_response(device, msg)
+        else:
+            pass
+
+    
+    #
+    # The changes are detected for the whole range at once: the old and new
+    # values are converted to big integers (16 bits per register) and xored.
+    # Only the registers that are traced and changed (or not yet known) are
+    # then processed individually.
+    #
+    def trace_response(self, device: TraceDevice, frame: ModbusFrame):
+
+        code = frame.code
+        if code == SydpowerModbus.FUNC_READ_INPUT_REGISTERS :
+            names  = self.iregs
+            values = device.iregs
+            known  = device.iknown
+            mask   = self.imask
+            bank   = 'i'
+        elif code == SydpowerModbus.FUNC_READ_HOLDING_REGISTERS:
+            names  = self.hregs
+            values = device.hregs
+            known  = device.hknown
+            mask   = self.hmask
+            bank   = 'h'
+        else:
+            return
+
+        device.changes = 0
+        start = frame.arg1
+        count = min(frame.arg2, len(values)-start)
+        if count <= 0:
+            return
+        new = frame.payload
+        if count < len(new):
+            new = new[:count]
+        if self.history:
+            self.history.append(device.mac, bank, self.now(), start, new.tolist())
+
+        old = values[start:start+count]
+        lanes = ((1 << (16*count)) - 1) << (16*start)
+        unknown = lanes & ~known
+        if old == new and not unknown:
+            return
+        values[start:start+count] = new
+        if bank == 'i':
+            device.iknown = known | lanes
+        else:
+            device.hknown = known | lanes
+
+        diff = (int.from_bytes(old.tobytes(),'little') ^ int.from_bytes(new.tobytes(),'little')) << (16*start)
+        if bank == 'i' and diff & known & self.status_lane:
+            self.on_status_change(device)
+        diff = (diff | unknown) & mask
+        device.changes = diff
+        if not diff:
+            return
+
+        now = self.now()
+        while diff:
+            index = ((diff & -diff).bit_length()-1) >> 4
+            diff &= ~(0xFFFF << (16*index))
+            self.output.change(now, device.mac, bank, index, names[index], values[index])
+
+
+
+# The metrics of a device for MetricsSink 
+class DeviceMetrics:
+
+    __slots__ = ( 'labels', 'lines', 'blocks', 'dirty' )
+
+    def __init__(self, mac:str):
+        self.labels = 'mac="{}"'.format(mac)
+        # For each metric family, the exposition lines indexed by register
+        # or bit index and the cached concatenation of those lines.
+        self.lines  = [ {} for _ in MetricsSink.FAMILIES ]
+        self.blocks = [ '' for _ in MetricsSink.FAMILIES ]
+        self.dirty  = [ False for _ in MetricsSink.FAMILIES ]
+
+    def block(self, family:int) -> str:
+        if self.dirty[family]:
+            lines = self.lines[family]
+            self.blocks[family] = ''.join( lines[k] for k in sorted(lines) )
+            self.dirty[family] = False
+        return self.blocks[family]
+
+    
+#
+# A sink (see OutputSink) that maintains the register values in the
+# Prometheus text exposition format. 
+#
+# Only the lines of the changed registers are regenerated. The exposition
+# text is then rebuilt by poll() from the cached per-device blocks of the
+# metric families that changed, and served as-is by the HTTP server. 
+#
+class MetricsSink(Sink):
+
+    # name, type, help
+    FAMILIES = [
+        ( 'sydpower_input_register',   'gauge', 'Value of an input register' ),
+        ( 'sydpower_holding_register', 'gauge', 'Value of a holding register' ),
+        ( 'sydpower_status_bit',       'gauge', 'Value of a bit of iStatusBits' ),
+        ( 'sydpower_last_change_timestamp_seconds', 'gauge', 'Time of the last register change' ),
+    ]
+    INPUT, HOLDING, STATUS, LAST_CHANGE = range(4)
+
+    def __init__(self):
+        self.devices : dict[str,DeviceMetrics] = {}
+        self.dirty = [ False for _ in self.FAMILIES ]
+        self.parts = [ b'' for _ in self.FAMILIES ]
+        self.body = b''       # the full exposition text 
+
+    def _set(self, device:DeviceMetrics, family:int, key:int, line:str):
+        device.lines[family][key] = line
+        device.dirty[family] = True
+        self.dirty[family] = True
+        
+    def change(self, t, mac, bank, index, name, value):
+        device = self.devices.get(mac)
+        if device is None:
+            device = self.devices[mac] = DeviceMetrics(mac)
+        family = self.INPUT if bank == 'i' else self.HOLDING
+        self._set(device, family, index, '{}{{{},register="{}",index="{}"}} {}\n'.format(
+            self.FAMILIES[family][0], device.labels, name, index, value))
+        if name == 'iStatusBits':
+            for bit in range(16):
+                self._set(device, self.STATUS, bit, '{}{{{},bit="{}",flag="{}"}} {}\n'.format(
+                    self.FAMILIES[self.STATUS][0], device.labels, bit,
+                    STATUS_BIT_FLAGS.get(bit,'unknown'), (value >> bit) & 1))
+        self._set(device, self.LAST_CHANGE, 0, '{}{{{}}} {:.3f}\n'.format(
+            self.FAMILIES[self.LAST_CHANGE][0], device.labels, t))
+
+    # Rebuild the exposition text if needed 
+    def poll(self):
+        if not any(self.dirty):
+            return
+        for family, (name, kind, text) in enumerate(self.FAMILIES):
+            if self.dirty[family]:
+                self.parts[family] = ( '# HELP {} {}\n# TYPE {} {}\n'.format(name, text, name, kind)
+                                       + ''.join( d.block(family) for d in self.devices.values() ) ).encode()
+                self.dirty[family] = False
+        self.body = b''.join(self.parts)
+
+    def comment(self, text:str):
+        print(text, flush=True)
+
+    def flush(self):
+        self.poll()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.sink.body
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+#
+# Export the register values on a local HTTP /metrics endpoint for
+# Prometheus. 
+#
+# That is a trace (see AppTrace) whose changes are sent to a MetricsSink.
+#
+class AppExporter(AppTrace):
+
+    DEFAULT_TARGETS = [ "NAMED" ]
+    
+    def __init__(self, args):
+        super().__init__(args)
+        self.tic_interval = min(self.tic_interval, 1.0)
+        host, _, port = args.listen.rpartition(':')
+        self.server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self.server.sink = self.output
+        self.comment("# serving metrics on http://{}:{}/metrics".format(*self.server.server_address[:2]))
+
+    def create_output(self, args):
+        return MetricsSink()
+
+    def run(self):
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            return super().run()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+
+    
+#
+# A sink (see Sink) that republishes the register changes for Home Assistant. 
+#
+#  - A retained discovery config is published the first time a register of
+#    a device is seen:
+#       DISCOVERY/sensor/sydpower_MAC/NAME/config
+#
+#  - Each change is published as a retained JSON object {"value": N} on
+#       PREFIX/MAC/NAME
+#
+# The deadband and other filters are applied by ChangeFilter.
+#
+class HomeAssistantSink(Sink):
+
+    def __init__(self, app:SimpleMqttApp, prefix:str='sydpower', discovery:str='homeassistant'):
+        self.app = app
+        self.prefix = prefix
+        self.discovery = discovery
+        self.announced : dict[str,set] = {}   # the names of the announced registers per device
+        self.published = 0
+
+    def announce(self, mac:str, name:str):
+        uid = 'sydpower_{}_{}'.format(mac.lower(), name)
+        config = { 'name'        : name,
+                   'unique_id'   : uid,
+                   'object_id'   : uid,
+                   'state_topic' : '{}/{}/{}'.format(self.prefix, mac, name),
+                   'value_template' : '{{ value_json.value }}',
+                   'device'      : { 'identifiers'  : [ 'sydpower_'+mac.lower() ],
+                                     'name'         : 'Sydpower '+mac,
+                                     'manufacturer' : 'Sydpower' } }
+        sensor = REGISTER_UNITS.get(name)
+        if sensor:
+            device_class, unit, scale = sensor
+            if device_class:
+                config['device_class'] = device_class
+            config['unit_of_measurement'] = unit
+            config['state_class'] = 'measurement'
+            if scale != 1:
+                config['value_template'] = '{{{{ (value_json.value * {}) | round(1) }}}}'.format(scale)
+        topic = '{}/sensor/sydpower_{}/{}/config'.format(self.discovery, mac, name)
+        self.app.publish(topic, json.dumps(config), retain=True)
+
+    def change(self, t, mac, bank, index, name, value):
+        announced = self.announced.get(mac)
+        if announced is None:
+            announced = self.announced[mac] = set()
+        if name not in announced:
+            announced.add(name)
+            self.announce(mac, name)
+        self.app.publish('{}/{}/{}'.format(self.prefix, mac, name), '{{"value":{}}}'.format(value), retain=True)
+        self.published += 1
+
+    def close(self):
+        print("# {} values published".format(self.published), flush=True)
+
+        
+#
+# Bridge the registers to Home Assistant (see HomeAssistantSink).
+#
+# That is a trace (see AppTrace) whose changes are republished. 
+#
+class AppBridge(AppTrace):
+
+    DEFAULT_TARGETS = [ "NAMED" ]
+    
+    def create_output(self, args):
+        return HomeAssistantSink(self, args.prefix, args.discovery)
+
+
+# The cached state of a device for AppStateServer.
+#
+# For each bank: the register values, their receive times (0.0 when
+# received in a retained message, so of unknown age), the mask of the known
+# registers (bit i for register i) and the receive time of the oldest known
+# register (0.0 if unknown). body is the JSON encoded state.
+class StateDevice(SydpowerDevice):
+
+    __slots__ = ( 'iregs', 'hregs', 'itimes', 'htimes', 'iknown', 'hknown',
+                  'itime', 'htime', 'body', 'dirty' )
+
+    def __init__(self, mac:str):
+        super().__init__(mac)
+        self.iregs  = array.array('H', bytes(2*IREG_COUNT))
+        self.hregs  = array.array('H', bytes(2*HREG_COUNT))
+        self.itimes = array.array('d', bytes(8*IREG_COUNT))
+        self.htimes = array.array('d', bytes(8*HREG_COUNT))
+        self.iknown = 0
+        self.hknown = 0
+        self.itime  = 0.0
+        self.htime  = 0.0
+        self.body   = b''
+        self.dirty  = False
+
+
+class StateRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.app.query(self.path.split('?')[0])
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+#
+# Keep the last known state of the devices and serve it over HTTP (see
+# StateRequestHandler) on a TCP port or a Unix socket ('unix:PATH').
+#
+# The state is fed by all responses seen on the MQTT server, including the
+# retained 0x04 responses whose age is unknown. With args.refresh, the
+# banks older than that many seconds (or of unknown age) are read again.
+#
+# The JSON state of the changed devices is rebuilt at each tic so a query
+# only concatenates cached bytes:
+#   - /state               all devices
+#   - /state/MAC           a single device
+#   - /state/MAC/NAME      a single register
+#
+# Each bank has the receive time of its oldest register ('time', null if
+# unknown) and 'retained' is true if some registers come from a retained
+# message.
+#
+class AppStateServer(SydpowerApp):
+
+    DEVICE_CLASS = StateDevice
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.refresh = args.refresh
+        self.dirty : set[StateDevice] = set()
+        if args.listen.startswith('unix:'):
+            path = args.listen[5:]
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            self.server = UnixHTTPServer(path, StateRequestHandler)
+            url = args.listen
+        else:
+            host, _, port = args.listen.rpartition(':')
+            self.server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), StateRequestHandler)
+            self.server.daemon_threads = True
+            url = "http://{}:{}/state".format(*self.server.server_address[:2])
+        self.server.app = self
+        self.comment("# serving the device states on "+url)
+
+    def on_message(self, msg):
+        device, suffix = self.route(msg.topic)
+        if device is None or (suffix != TOPIC_SUFFIX_RESPONSE and suffix != TOPIC_SUFFIX_RESPONSE_04):
+            return
+        frame = self.modbus.decode_frame(msg.payload, 'response')
+        code = frame.code
+        if code == SydpowerModbus.FUNC_READ_INPUT_REGISTERS:
+            values, times = device.iregs, device.itimes
+        elif code == SydpowerModbus.FUNC_READ_HOLDING_REGISTERS:
+            values, times = device.hregs, device.htimes
+        else:
+            return
+        start = frame.arg1
+        count = min(frame.arg2, len(values)-start)
+        if count > 0:
+            values[start:start+count] = frame.payload[:count]
+            t = 0.0 if msg.retain else self.receive_time(msg)
+            times[start:start+count] = array.array('d', [ t ]) * count
+            lanes = ((1 << count) - 1) << start
+            if code == SydpowerModbus.FUNC_READ_INPUT_REGISTERS:
+                device.iknown |= lanes
+            else:
+                device.hknown |= lanes
+            if not device.dirty:
+                device.dirty = True
+                self.dirty.add(device)
+        self.scheduler.on_response(device, msg)
+
+    # Return the JSON state of a bank and the time of its oldest register
+    @staticmethod
+    def bank_state(values:array.array, times:array.array, known:int, names:dict[int,str]) -> tuple[dict,float]:
+        registers = {}
+        oldest = float('inf')
+        for index in range(len(values)):
+            if known >> index & 1:
+                registers[names[index]] = values[index]
+                oldest = min(oldest, times[index])
+        oldest = 0.0 if oldest == float('inf') else oldest
+        return { 'time': round(oldest, 3) if oldest else None,
+                 'retained': bool(known) and not oldest,
+                 'registers': registers }, oldest
+
+    def on_tic(self):
+        for device in self.dirty:
+            istate, device.itime = self.bank_state(device.iregs, device.itimes, device.iknown, IREG_INDEX_TO_NAME)
+            hstate, device.htime = self.bank_state(device.hregs, device.htimes, device.hknown, HREG_INDEX_TO_NAME)
+            device.body = json.dumps({ 'mac': device.mac, 'input': istate, 'holding': hstate },
+                                     separators=(',',':')).encode()
+            device.dirty = False
+        self.dirty.clear()
+        if self.refresh:
+            now = time.time()
+            for device in self.devices.values():
+                if not self.scheduler.idle(device):
+                    continue
+                if now - device.itime > self.refresh:
+                    self.scheduler.ReadInputRegisters(device, 0, IREG_COUNT)
+                if now - device.htime > self.refresh:
+                    self.scheduler.ReadHoldingRegisters(device, 0, HREG_COUNT)
+        self.scheduler.poll()
+
+    # Answer a query (called by the threads of the HTTP server). Return None if not found.
+    def query(self, path:str) -> bytes | None:
+        parts = path.strip('/').split('/')
+        if parts[0] != 'state' or len(parts) > 3:
+            return None
+        now = '{{"now":{:.3f},'.format(time.time()).encode()
+        if len(parts) == 1:
+            bodies = [ device.body for device in list(self.devices.values()) if device.body ]
+            return now + b'"devices":[' + b','.join(bodies) + b']}'
+        device = self.devices.get(parts[1].upper())
+        if device is None or not device.body:
+            return None
+        if len(parts) == 2:
+            return now + device.body[1:]
+        name = parts[2]
+        if ireg_name_to_index(name) is not None:
+            index, values, times, known = ireg_name_to_index(name), device.iregs, device.itimes, device.iknown
+        elif hreg_name_to_index(name) is not None:
+            index, values, times, known = hreg_name_to_index(name), device.hregs, device.htimes, device.hknown
+        else:
+            return None
+        if not known >> index & 1:
+            return None
+        t = times[index]
+        return now + json.dumps({ 'mac': device.mac, 'name': name, 'value': values[index],
+                                  'time': round(t, 3) if t else None }, separators=(',',':')).encode()[1:]
+
+    def run(self):
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            return super().run()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.server, UnixHTTPServer):
+                os.unlink(self.server.server_address)
+
+
+#
+# Write holding registers (see SydpowerApp.write_holding_registers).
+#
+# In fleet mode, the registers are written to all devices that are
+# discovered during args.wait seconds (typically from their retained 0x04
+# responses).
+#
+# The exit code is 1 if any write could not be verified.
+#
+class AppSet(SydpowerApp):
+
+    def __init__(self, args):
+        # Parsed first since the devices given by --mac are added by SydpowerApp
+        self.values = parse_holding_assignments(args.assignment)
+        self.active = 0          # number of devices being written
+        self.failed = 0          # number of writes that could not be verified 
+        self.deadline = None     # when the discovery of new devices ends (fleet mode)
+        super().__init__(args)
+        self.tic_interval = 0.1
+
+    def on_connect(self, flags, reason_code, properties):
+        super().on_connect(flags, reason_code, properties)
+        if self.deadline is None:
+            self.deadline = time.time() + self.args.wait if self.fleet else 0.0
+
+    def on_new_device(self, device:SydpowerDevice):
+        self.active += 1
+        self.write_holding_registers(device, self.values, self.on_written)
+
+    def on_written(self, device:SydpowerDevice, writes:list[HoldingWrite]):
+        self.active -= 1
+        for write in writes:
+            if write.verified:
+                result = "ok"
+            elif write.status != 'done':
+                result = "FAILED (write {})".format(write.status)
+            elif write.readback is None:
+                result = "FAILED (read-back failed)"
+            else:
+                result = "FAILED (read {})".format(write.readback)
+            if not write.verified:
+                self.failed += 1
+            print("{} {} = {} {}".format(device.mac, hreg_index_to_name(write.index), write.value, result), flush=True)
+
+    def on_message(self, msg):
+        device, suffix = self.route(msg.topic)
+        if device and suffix in [ TOPIC_SUFFIX_RESPONSE , TOPIC_SUFFIX_RESPONSE_04 ]:
+            self.scheduler.on_response(device, msg)
+
+    def on_tic(self):
+        self.scheduler.poll()
+        if self.active == 0 and self.deadline is not None and time.time() >= self.deadline:
+            self.result = 1 if self.failed or not self.devices else 0
+
+            
+#
+# A step of AppProbe: n read requests of count registers where
+#  - kind 'size': each request is sent as soon as the previous one
+#    completed.
+#  - kind 'spacing': each request is sent delay seconds after the previous
+#    one completed.
+#  - kind 'interval': a request is sent every delay seconds without waiting
+#    for the responses. Those requests read different registers so the
+#    responses can be matched.
+#
+class ProbeStep:
+
+    __slots__ = ( 'kind', 'func', 'count', 'delay', 'n', 'sent', 'rtts', 'lost', 'errors', 'start', 'end' )
+
+    def __init__(self, kind:str, func:int, count:int, delay:float, n:int):
+        self.kind   = kind
+        self.func   = func
+        self.count  = count
+        self.delay  = delay
+        self.n      = n
+        self.sent   = 0
+        self.rtts : list[float] = []   # the round-trip times of the responses
+        self.lost   = 0                # the requests without response
+        self.errors = 0                # the error responses 
+        self.start  = 0.0
+        self.end    = 0.0
+
+    @property
+    def loss(self) -> float:
+        return self.lost / self.sent if self.sent else 0.0
+
+    def percentile(self, p:float) -> float:
+        rtts = sorted(self.rtts)
+        return rtts[min(len(rtts)-1, int(p*len(rtts)))]
+
+    def describe(self) -> str:
+        if self.kind == 'size':
+            text = "{:<8s} 0x{:02x} count={:<3d}".format(self.kind, self.func, self.count)
+        else:
+            text = "{:<8s} {:<14s}".format(self.kind, format_duration(self.delay) if self.delay else "0")
+        text += " sent={} lost={} errors={}".format(self.sent, self.lost, self.errors)
+        if self.rtts:
+            text += " rtt p50={} p90={} max={}".format(format_duration(self.percentile(0.5)),
+                                                       format_duration(self.percentile(0.9)),
+                                                       format_duration(max(self.rtts)))
+            if self.end > self.start:
+                text += " {:.2f} responses/s".format(len(self.rtts)/(self.end-self.start))
+        return text
+
+
+class ProbeDevice(SydpowerDevice):
+
+    __slots__ = ( 'steps', 'step', 'failures', 'next_send', 'outstanding', 'sequence' )
+
+    def __init__(self, mac:str):
+        super().__init__(mac)
+        self.steps : list[ProbeStep] = []
+        self.step = -1                          # the index of the current step
+        self.failures = collections.Counter()   # the failed steps of each kind
+        self.next_send = 0.0                    # for the 'interval' steps
+        self.outstanding : dict[tuple[int,int,int],float] = {}   # the send time of the requests of an 'interval' step
+        self.sequence = 0                       # the number of requests sent by the 'interval' steps
+
+
+#
+# Measure the response latency of the devices and the request rate they
+# can sustain. The probe only sends read requests.
+#
+# The steps (see ProbeStep) measure successively
+#  - the round-trip time of ReadHoldingRegisters and ReadInputRegisters
+#    according to the number of registers,
+#  - the loss rate according to the delay between a response and the
+#    next request (args.spacings, in decreasing order),
+#  - the loss rate according to the interval between the requests when
+#    they are sent without waiting for the responses (args.intervals). 
+#
+# A delay is considered safe when the loss rate is at most args.max_loss.
+# The remaining delays of a kind are skipped after two failures.
+#
+class AppProbe(SydpowerApp):
+
+    DEVICE_CLASS = ProbeDevice
+
+    def __init__(self, args):
+        self.counts    = self.parse_list(args.counts, int)
+        self.spacings  = sorted(self.parse_list(args.spacings, float), reverse=True)
+        self.intervals = sorted(self.parse_list(args.intervals, float), reverse=True)
+        if any( count < 1 or count > HREG_COUNT for count in self.counts ):
+            print("Error: The register counts must be between 1 and {}".format(HREG_COUNT))
+            sys.exit(1)
+        if any( delay < 0 for delay in self.spacings + self.intervals ) or 0 in self.intervals:
+            print("Error: The spacings shall not be negative and the intervals shall be positive")
+            sys.exit(1)
+        self.active = 0           # number of devices being probed
+        self.answered = 0         # number of probed devices that answered
+        self.deadline = None      # when the discovery of new devices ends (fleet mode)
+        super().__init__(args)
+        self.tic_interval = 0.01
+        self.scheduler.retries = 0
+
+    @staticmethod
+    def parse_list(text:str, kind) -> list:
+        try:
+            return [ kind(item) for item in text.split(',') ]
+        except ValueError:
+            print("Error: Invalid list '"+text+"'")
+            sys.exit(1)
+
+    def on_connect(self, flags, reason_code, properties):
+        super().on_connect(flags, reason_code, properties)
+        if self.deadline is None:
+            self.deadline = time.time() + self.args.wait if self.fleet else 0.0
+
+    def on_new_device(self, device:ProbeDevice):
+        n = self.args.requests
+        for func in ( SydpowerModbus.FUNC_READ_HOLDING_REGISTERS, SydpowerModbus.FUNC_READ_INPUT_REGISTERS ):
+            for count in self.counts:
+                device.steps.append( ProbeStep('size', func, count, 0.0, n) )
+        for spacing in self.spacings:
+            device.steps.append( ProbeStep('spacing', SydpowerModbus.FUNC_READ_HOLDING_REGISTERS, HREG_COUNT, spacing, n) )
+        for interval in self.intervals:
+            device.steps.append( ProbeStep('interval', SydpowerModbus.FUNC_READ_HOLDING_REGISTERS, 1, interval, n) )
+        self.active += 1
+        print("# probing {} ({} steps of {} requests)".format(device.mac, len(device.steps), n), flush=True)
+        if self.connected:
+            self.next_step(device)
+
+    # Start the next step of a device (skipping the kinds that failed twice)
+    def next_step(self, device:ProbeDevice):
+        now = time.time()
+        device.step += 1
+        while device.step < len(device.steps) and device.failures[device.steps[device.step].kind] >= 2:
+            device.step += 1
+        if device.step >= len(device.steps):
+            self.summary(device)
+            return
+        step = device.steps[device.step]
+        step.start = now
+        if step.kind == 'interval':
+            device.next_send = now
+        else:
+            self.submit(device, step, 0.0)
+
+    def submit(self, device:ProbeDevice, step:ProbeStep, not_before:float):
+        step.sent += 1
+        self.scheduler.submit(device, step.func, 0, step.count, self.on_probe_response, not_before)
+
+    def on_probe_response(self, device:ProbeDevice, request:SydpowerRequest):
+        step = device.steps[device.step]
+        if request.status == 'done':
+            step.rtts.append(request.rtt)
+        elif request.status == 'error':
+            step.errors += 1
+        else:
+            step.lost += 1
+        if step.sent < step.n:
+            self.submit(device, step, time.time() + step.delay)
+        else:
+            self.end_step(device, step)
+
+    def end_step(self, device:ProbeDevice, step:ProbeStep):
+        step.end = time.time()
+        if step.loss > self.args.max_loss:
+            device.failures[step.kind] += 1
+        print(device.mac, step.describe(), flush=True)
+        self.next_step(device)
+
+    # The smallest safe delay of a kind (None if none is safe)
+    def safe_delay(self, device:ProbeDevice, kind:str) -> float | None:
+        safe = None
+        for step in device.steps:
+            if step.kind == kind and step.sent:
+                if step.loss > self.args.max_loss:
+                    break
+                safe = step.delay
+        return safe
+
+    def summary(self, device:ProbeDevice):
+        self.active -= 1
+        if any( step.rtts for step in device.steps ):
+            self.answered += 1
+        rtts = sorted( rtt for step in device.steps if step.kind == 'size' for rtt in step.rtts )
+        if rtts:
+            print("{} rtt p50={} p99={}".format(device.mac, format_duration(rtts[len(rtts)//2]),
+                                               format_duration(rtts[min(len(rtts)-1, int(0.99*len(rtts)))])))
+        for kind, text in ( ('spacing', 'delay after a response'), ('interval', 'interval without waiting for the responses') ):
+            safe = self.safe_delay(device, kind)
+            if safe is None:
+                print("{} no safe {} found".format(device.mac, text))
+            else:
+                print("{} safe {}: {}".format(device.mac, text, format_duration(safe) if safe else "0"))
+        sys.stdout.flush()
+
+    def on_message(self, msg):
+        device, suffix = self.route(msg.topic)
+        if device is None or suffix not in ( TOPIC_SUFFIX_RESPONSE, TOPIC_SUFFIX_RESPONSE_04 ):
+            return
+        if device.outstanding:
+            # A response to a request of an 'interval' step
+            payload = self.scheduler.response_payload(msg)
+            if payload is not None and len(payload) >= 8:
+                sent = device.outstanding.pop(MODBUS_HEADER.unpack_from(payload), None)
+                if sent is not None:
+                    device.steps[device.step].rtts.append(time.time() - sent)
+            return
+        self.scheduler.on_response(device, msg)
 
     def on_tic(self):
-        pass
+        self.scheduler.poll()
+        now = time.time()
+        for device in self.devices.values():
+            if device.step < 0 and self.connected:
+                self.next_step(device)
+            if not 0 <= device.step < len(device.steps):
+                continue
+            step = device.steps[device.step]
+            if step.kind != 'interval':
+                continue
+            while step.sent < step.n and now >= device.next_send:
+                # Each in-flight request reads a different register. The
+                # sequence continues across the steps so that a late response
+                # to the previous step does not match a new request.
+                key = (step.func, device.sequence % HREG_COUNT, step.count)
+                device.outstanding[key] = now
+                self.publish(device.topic_request, bytes(self.modbus.encode_request(*key)))
+                device.sequence += 1
+                step.sent += 1
+                device.next_send += step.delay
+            for key, sent in list(device.outstanding.items()):
+                if now - sent > self.scheduler.timeout:
+                    del device.outstanding[key]
+                    step.lost += 1
+            if step.sent >= step.n and not device.outstanding:
+                self.end_step(device, step)
+        if self.active == 0 and self.deadline is not None and now >= self.deadline:
+            self.result = 0 if self.devices and self.answered == len(self.devices) else 1
 
-    def run(self) :
 
+# Record all messages in a capture file (see CaptureWriter)
+class AppRecord(SydpowerApp):
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.tic_interval = 1.0
         try:
-            self.mqtt_client.connect(self.mqtt_hostname, self.mqtt_port, 60)
-        except ConnectionRefusedError:
-            # TODO: add support fro automatic reconnection
-            print("Error: MQTT Connection refused on '{}' port {}".format(self.mqtt_hostname, self.mqtt_port))
+            self.writer = CaptureWriter(args.file)
+        except Exception as e:
+            print("Error: "+str(e))
             sys.exit(1)
-            
-        self.mqtt_client.loop_start()
 
-        timeout = max(0.1,self.tic_interval)
-        while True:
-            try:
-                event = self.event_queue.get(True, timeout) 
-                if event[0] == 'message' :
-                    self.on_message(event[1])
-                elif event[0] == 'connect' :
-                    self.on_connect(event[1],event[2],event[3]) 
-                elif event[0] == 'disconnect' :
-                    self.on_disconnect(event[1],event[2],event[3]) 
-                elif event[0] == 'signal' :                
-                    self.on_signal(event[1]) 
-                else:
-                    print('Warning: Unexpected event kind ', kind)
-            except queue.Empty as err:
-                pass
-            except queue.Full as err:
-                print(repr(err))            
+    def on_message(self, msg):
+        self.writer.write(msg.topic, msg.payload, msg.retain, self.receive_time(msg))
 
-            if not self.result is None:
-                break
-                
-            now = time.time()
-            next_tic = self._last_tic_time + self.tic_interval 
-            if now >= next_tic: 
-                self._last_tic_time = now 
-                self.on_tic()
-                timeout = max(0.1, self.tic_interval)
-            else:
-                timeout = max(0.1 ,next_tic-now)
+    def on_tic(self):
+        self.writer.flush()
+
+    def run(self):
+        try:
+            return super().run()
+        finally:
+            self.writer.close()
+            print("# {} messages recorded".format(self.writer.count))
 
-            if not self.result is None:
-                break
-            
-        self.mqtt_client.loop_stop()
-        return self.result
 
-# A base class for clients of Sydpower MQTT
 #
-# Currently, only works with a LOCAL MQTT server optained by 
-# redefining the DNS of mqtt.sydpower.com
+# Sharded processing of the fleet traffic by several processes (see
+# args.workers).
 #
-# TODO: Implement cloud authentication to connect to the real mqtt.sydpower.com
+# AppShard receives the MQTT messages and dispatches them by MAC address to
+# worker processes running the application of the command (see
+# shard_worker) so all messages of a device are processed in order by the
+# same worker. The messages are numbered and sent by batches. The workers
+# return the output produced by each message with its number and AppShard
+# writes the outputs in that order, which is also the order of a single
+# process. The requests of the workers (trace --query) are published by
+# AppShard.
 #
-class SydpowerApp(SimpleMqttApp):
+SHARD_COMMANDS = [ 'monitor', 'trace' ]
+
+#
+# The main function of a worker process.
+#
+# The batches are read from inbox (None to stop) and the results are put
+# in outbox as (index, kind, seq, data, publishes) where kind is
+#  - 'output':  data is a list of (seq, bytes) with the output produced by
+#               the message seq (or by the tic that followed it). seq is the
+#               last message of the processed batch (None after a tic).
+#  - 'exit':    same as 'output' for the final output.
+#  - 'error':   data is the traceback of the failure.
+# and publishes is a list of (topic, payload) to publish.
+#
+def shard_worker(args, index:int, inbox, outbox):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # the parent stops the workers
+    try:
+        if args.model:
+            load_schema(args.model).install()
+        buffer = io.BytesIO()
+        args.output = buffer
+        if index == 0:
+            app = AppMonitor(args) if args.command == 'monitor' else AppTrace(args)
+        else:
+            # The comments are only shown by the first worker
+            with contextlib.redirect_stderr(io.StringIO()):
+                app = AppMonitor(args) if args.command == 'monitor' else AppTrace(args)
+        app.connected = True
+        publishes = []
+        app.publish = lambda topic, payload, *rest, **kwargs: publishes.append( (topic, bytes(payload)) )
+
+        def collect(seq, chunks):
+            app.output.flush()
+            if buffer.tell():
+                if index == 0 or seq >= 0:
+                    chunks.append( (seq, buffer.getvalue()) )
+                buffer.seek(0)
+                buffer.truncate()
+
+        chunks = []
+        collect(-1, chunks)
+        seq = -1
+        while True:
+            try:
+                batch = inbox.get(True, app.tic_interval)
+            except queue.Empty:
+                batch = []
+            if batch is None:
+                break
+            for seq, topic, payload, retain, t in batch:
+                if app.replay:
+                    if app._now is None:
+                        app._last_tic_time = t
+                    app._now = t
+                app._deliver(CapturedMessage(topic, payload, retain, t))
+                collect(seq, chunks)
+            now = app.now()
+            if now >= app._last_tic_time + app.tic_interval:
+                app._last_tic_time = now
+                app._tic()
+                collect(seq, chunks)
+            if batch or chunks or publishes:
+                outbox.put( (index, 'output', seq if batch else None, chunks, publishes[:]) )
+                chunks = []
+                publishes.clear()
+        app.output.close()
+        if getattr(app, 'history', None):
+            app.history.close()
+        collect(seq, chunks)
+        outbox.put( (index, 'exit', seq, chunks, publishes[:]) )
+    except BaseException:
+        outbox.put( (index, 'error', None, traceback.format_exc(), []) )
+
+
+class AppShard(SydpowerApp):
+
+    BATCH_SIZE = 256     # the maximal number of messages in a batch
+    INBOX_BATCHES = 16   # the maximal number of batches waiting for a worker
 
     def __init__(self, args):
+        if not getattr(args, 'fleet', False):
+            print("Error: --workers requires --fleet")
+            sys.exit(1)
         super().__init__(args)
+        # Check the arguments before starting the workers
+        if args.command == 'trace':
+            parse_register_names( args.target or AppTrace.DEFAULT_TARGETS )
+            parse_filter_rules(args)
 
-        self.modbus = SydpowerModbus()
-        self.args = args
+        self.output = create_output_sink(args, True)
+        if isinstance(self.output, CsvSink):
+            self.output.write_header(CsvSink.MESSAGE_HEADER if args.command == 'monitor' else CsvSink.CHANGE_HEADER)
 
-        if args.mac: 
-            self.mac = args.mac.upper()
-        else:
-            print("Error: no device mac address was specified")
+        worker_args = argparse.Namespace(**vars(args))
+        worker_args.workers = 1
+        # The workers do not run an engine (see shard_worker) so the queries
+        # of trace -q must be sent by the RequestScheduler, not by tasks
+        worker_args.engine = 'thread'
+        worker_args.stats = None
+        worker_args.profile = None
+        context = multiprocessing.get_context('spawn')
+        self.outbox = context.Queue()
+        self.inboxes = []
+        self.processes = []
+        for index in range(args.workers):
+            inbox = context.Queue(self.INBOX_BATCHES)
+            process = context.Process(target=shard_worker, args=(worker_args, index, inbox, self.outbox),
+                                      name='shard-{}'.format(index), daemon=True)
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        self.running = args.workers   # the workers that did not exit
+
+        self.shards : dict[str,int] = {}   # the worker of each MAC address
+        self.batches = [ [] for _ in self.processes ]
+        # The first message of the batches sent to each worker and not yet processed
+        self.inflight = [ collections.deque() for _ in self.processes ]
+        self.seq = 0        # the number of the last message
+        self.merge = []     # a heap of (seq, order, bytes) waiting to be written
+        self.order = 0
+
+    def on_message(self, msg):
+        mac = msg.topic.partition('/')[0]
+        shard = self.shards.get(mac)
+        if shard is None:
+            shard = self.shards[mac] = len(self.shards) % len(self.processes)
+        self.seq += 1
+        batch = self.batches[shard]
+        batch.append( (self.seq, msg.topic, msg.payload, msg.retain, self.receive_time(msg)) )
+        if len(batch) >= self.BATCH_SIZE:
+            self.send(shard)
+
+    # Send the pending batch of a worker (wait while the worker is too far behind)
+    def send(self, shard:int):
+        batch = self.batches[shard]
+        self.inflight[shard].append(batch[0][0])
+        self.inboxes[shard].put(batch)
+        self.batches[shard] = []
+
+    # Process the results of the workers. Wait up to timeout seconds for the first one.
+    def receive(self, timeout:float=0.0):
+        while True:
+            try:
+                index, kind, seq, data, publishes = self.outbox.get(timeout > 0, timeout or None)
+            except queue.Empty:
+                return
+            timeout = 0.0
+            if kind == 'error':
+                print("Error: worker {} failed\n{}".format(index, data))
+                sys.exit(1)
+            for topic, payload in publishes:
+                self.publish(topic, payload)
+            for chunk in data:
+                heapq.heappush(self.merge, (chunk[0], self.order, chunk[1]))
+                self.order += 1
+            inflight = self.inflight[index]
+            if kind == 'exit':
+                self.running -= 1
+                inflight.clear()
+            elif seq is not None:
+                while inflight and inflight[0] <= seq:
+                    inflight.popleft()
+
+    # Write the outputs of the messages preceding the first unprocessed message
+    def write_merged(self):
+        safe = self.seq
+        for shard in range(len(self.processes)):
+            if self.inflight[shard]:
+                safe = min(safe, self.inflight[shard][0]-1)
+            if self.batches[shard]:
+                safe = min(safe, self.batches[shard][0][0]-1)
+        merge = self.merge
+        while merge and merge[0][0] <= safe:
+            self.output.write(heapq.heappop(merge)[2])
+
+    def on_tic(self):
+        if not all( process.is_alive() for process in self.processes ):
+            self.receive()   # for the error message
+            print("Error: a worker process exited")
             sys.exit(1)
-            
-        self.TOPIC_ALL         = self.mac+'/#'
-        self.TOPIC_REQUEST     = self.mac+'/client/request/data'
-        self.TOPIC_RESPONSE    = self.mac+'/device/response/client/data'
-        self.TOPIC_RESPONSE_04 = self.mac+'/device/response/client/04'
+        for shard in range(len(self.processes)):
+            if self.batches[shard]:
+                self.send(shard)
+        self.receive()
+        self.write_merged()
+        self.output.poll()
 
-    def publish_ReadHoldingRegisters(self, start:int , count:int):
-        msg = self.modbus.encode_ReadHoldingRegisters(start, count)
-        self.publish(self.TOPIC_REQUEST, msg) 
+    def stop_workers(self):
+        for shard, inbox in enumerate(self.inboxes):
+            if not self.processes[shard].is_alive():
+                continue
+            try:
+                if self.batches[shard]:
+                    self.send(shard)
+                inbox.put(None, True, 5.0)
+            except queue.Full:
+                pass
+        while self.running > 0 and any( process.is_alive() for process in self.processes ):
+            self.receive(1.0)
+        self.receive()
+        while self.merge:
+            self.output.write(heapq.heappop(self.merge)[2])
+        for process in self.processes:
+            process.join(5.0)
 
-    def publish_ReadInputRegisters(self, start:int, count:int):
-        msg = self.modbus.encode_ReadInputRegisters(start, count)
-        self.publish(self.TOPIC_REQUEST, msg) 
-        
+    # The workers must be stopped before the output is closed by SydpowerApp.run()
+    def run(self):
+        try:
+            return SimpleMqttApp.run(self)
+        finally:
+            try:
+                self.stop_workers()
+            finally:
+                self.output.close()
 
-# Monitor all messages  
-class AppMonitor(SydpowerApp):
+#
+# Generate realistic MODBUS frames (with valid CRC) for the benchmarks.
+#
+# The register values start from a typical device state (see the retained
+# message in the README) and drift a little between two frames. 
+#
+class FrameGenerator:
+
+    SAMPLE = bytes.fromhex(
+        '11040000005000000000000100000000000000000000000000000000000000000000000000000000000008fe01f4'
+        '000800a000000000000000000000000000000000000000000000000000000000000000000000000800000804000000'
+        '000000000000003000400000000000000000b400000188000002380000000008860000000000ffffff000000000000'
+        '0000000000000000000000000000000000000000000000000000c314' )
+
+    # Registers that are expected to change between two frames 
+    VOLATILE = [ 3, 4, 6, 20, 30, 31, 34, 39, 56, 58, 59 ]
+
+    # Typical values of the holding registers
+    HOLDING = { 13:3, 24:1, 26:1, 56:1, 59:5, 60:480, 61:5, 62:5, 66:100, 67:1000, 68:30 }
     
-    def __init__(self, args):
-        super().__init__(args)
-        self.topics = [ self.TOPIC_ALL ] 
-        
-    def on_connect(self, flags, reason_code, properties):
-        for t in self.topics:
-            print("# subscribing to "+t)
-            self.subscribe(t)
+    def __init__(self, seed:int=0):
+        self.modbus = SydpowerModbus()
+        self.random = random.Random(seed)
+        self.iregs = self.initial_iregs()
+        self.hregs = self.initial_hregs()
+
+    @classmethod
+    def initial_iregs(cls) -> list[int]:
+        return SydpowerModbus().get_words(cls.SAMPLE, 6, IREG_COUNT)
+
+    @classmethod
+    def initial_hregs(cls) -> list[int]:
+        hregs = [ 0 ] * HREG_COUNT
+        for index, value in cls.HOLDING.items():
+            hregs[index] = value
+        return hregs
+
+    # Slightly modify the volatile registers  
+    @classmethod
+    def drift(cls, rnd:random.Random, values:list[int]) -> list[int]:
+        for i in cls.VOLATILE:
+            if i < len(values) and rnd.random() < 0.5:
+                values[i] = min(0xFFFF, max(0, values[i] + rnd.randint(-3,3)))
+        return values
+
+    def _drift(self, values:list[int]) -> list[int]:
+        return self.drift(self.random, values)
     
-    def on_message(self, msg):
-        # print("#", msg.topic, msg.payload.hex(), flush=True)
-        if msg.topic == self.TOPIC_REQUEST:
-            kind = "request"
-            func, args, payload, crc = self.modbus.decode(msg.payload,'request', True)
-        elif msg.topic == self.TOPIC_RESPONSE:
-            kind = "response"
-            func, args, payload, crc = self.modbus.decode(msg.payload,'response', True) 
-        elif msg.topic == self.TOPIC_RESPONSE_04:            
-            kind = "response"
-            func, args, payload, crc = self.modbus.decode(msg.payload,'response', True) 
-        else:
-            print("#", msg.topic, msg.payload.hex(), flush=True)
+    def ReadInputRegisters(self, start:int=0, count:int=IREG_COUNT) -> bytes:
+        values = self._drift(self.iregs)[start:start+count]
+        return bytes(self.modbus.encode_ReadRegistersResponse(SydpowerModbus.FUNC_READ_INPUT_REGISTERS, start, values))
+
+    def ReadHoldingRegisters(self, start:int=0, count:int=HREG_COUNT) -> bytes:
+        values = self.hregs[start:start+count]
+        return bytes(self.modbus.encode_ReadRegistersResponse(SydpowerModbus.FUNC_READ_HOLDING_REGISTERS, start, values))
+
+    def WriteHoldingRegister(self, index:int=57, value:int=1) -> bytes:
+        return bytes(self.modbus.encode_WriteHoldingRegister(index, value))
+
+    def Error(self, func:int=1, code:int=1) -> bytes:
+        return bytes(self.modbus.encode_ErrorResponse(func, code))
+
+    # Return a MAC address (as used in the topics) for the device number n  
+    @staticmethod
+    def mac(n:int) -> str:
+        return '5D0000{:06X}'.format(n)
+
+
+#
+# An in-process stand-in for the MQTT client of a SimpleMqttApp.
+#
+# Messages published on the loopback client (by the application itself or
+# by the benchmark) are delivered synchronously to the paho callback of
+# the application when they match one of its subscriptions.
+#
+class LoopbackMqttClient:
+
+    def __init__(self, app:SimpleMqttApp):
+        self.app = app
+        self.subscriptions : list[str] = []
+        self._matches : dict[str,bool] = {}
+        app.mqtt_client = self
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        self._matches.clear()
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        ok = self._matches.get(topic)
+        if ok is None:
+            ok = self._matches[topic] = any( mqtt.topic_matches_sub(t, topic) for t in self.subscriptions )
+        if ok:
+            msg = mqtt.MQTTMessage(topic=topic.encode())
+            msg.payload = payload
+            msg.retain = retain
+            self.app._on_message_cb(self, None, msg)
+        return None
+
+    # Process all the events queued by the application
+    def drain(self):
+        app = self.app
+        get = app.event_queue.get_nowait
+        try:
+            while True:
+                app._process_event(get())
+        except queue.Empty:
+            pass
+
+
+# Call func() repeatedly for about 'duration' seconds and return (iterations, seconds)
+def bench_loop(func, duration:float) -> tuple[int,float]:
+    n = 1
+    total = 0
+    elapsed = 0.0
+    while elapsed < duration:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            func()
+        elapsed += time.perf_counter() - t0
+        total += n
+        n *= 2
+    return total, elapsed
+
+#
+# Measure the cost of the hot paths: CRC, decoding, formatting, change
+# detection and the end-to-end processing of monitor and trace messages
+# by an application connected to a LoopbackMqttClient.
+#
+# The results are written in JSON (one object per benchmark). 
+#
+def bench_command(args):
+
+    gen      = FrameGenerator(args.seed)
+    modbus   = SydpowerModbus()
+    duration = args.duration
+    results  = []
+
+    def run(name:str, func, items:int=1):
+        if args.filter and not any( f in name for f in args.filter ):
             return
+        n, elapsed = bench_loop(func, duration)
+        results.append( { 'name'       : name,
+                          'iterations' : n,
+                          'items'      : items,   # messages processed per iteration
+                          'seconds'    : round(elapsed, 6),
+                          'us_per_op'  : round(1e6*elapsed/n, 3),
+                          'ops_per_s'  : round(n*items/elapsed, 1) } )
+        print("# {:<40s} {:>10.3f} us/op".format(name, 1e6*elapsed/n), file=sys.stderr, flush=True)
 
-        if not payload:
-            payload_str = ""
-        elif type(payload) == list:
-            # A list of 16bit values. Display in hex with spaces 
-            payload_str = " = [ " + " ".join([ "{:04x}".format(x) for x in payload ]) + " ]"
-        elif type(payload) == bytes:
-            # Display as a long hexadecimal sequence
-            payload_str = " = " + payload.hex()
-        else: # should not happen
-            payload_str = " = ???????????" 
-
-        print( "{} {}({}){}".format(kind, func,
-                                    ",".join([str(x) for x in args]),
-                                    payload_str  )
-               ,flush = True)
- 
-# Trace changes to registers
-class AppTrace(SydpowerApp):
+    iframe  = gen.ReadInputRegisters()
+    hframe  = gen.ReadHoldingRegisters()
+    wframe  = gen.WriteHoldingRegister()
+    eframe  = gen.Error(0x01, 0x01)
+    rframe  = bytes(modbus.encode_ReadInputRegisters(0, IREG_COUNT))
     
-    def __init__(self, args):
-        super().__init__(args)
-        self.topics = [ self.TOPIC_ALL ] 
-        self.tic_interval = 2
+    run('crc.compute.164',        lambda: modbus.compute_crc(iframe, len(iframe)-2))
+    run('crc.check.164',          lambda: modbus.check_crc(iframe))
+    run('encode.ReadInputRegisters', lambda: modbus.encode_ReadInputRegisters(0, IREG_COUNT))
+    run('decode.request.0x04',    lambda: modbus.decode(rframe, 'request', True))
+    run('decode.response.0x04',   lambda: modbus.decode(iframe, 'response', False))
+    run('decode.response.0x03.symbolic', lambda: modbus.decode(hframe, 'response', True))
+    run('decode.request.0x06',    lambda: modbus.decode(wframe, 'request', True))
+    run('decode.response.0x81',   lambda: modbus.decode(eframe, 'response', True))
+    run('decode_frame.request.0x04',  lambda: modbus.decode_frame(rframe, 'request'))
+    run('decode_frame.response.0x04', lambda: modbus.decode_frame(iframe, 'response'))
+    run('decode_frame.response.0x03.symbolic', lambda: modbus.decode_frame(hframe, 'response').symbolic_args)
+    run('decode_frame.request.0x06.symbolic',  lambda: modbus.decode_frame(wframe, 'request').symbolic_args)
+    run('decode_frame.response.0x81', lambda: modbus.decode_frame(eframe, 'response'))
+    batch = [ gen.ReadInputRegisters() for i in range(1000) ]
+    if numpy is not None:
+        run('decode_batch.numpy.1000', lambda: modbus.decode_batch(batch, SydpowerModbus.FUNC_READ_INPUT_REGISTERS, 0, IREG_COUNT), len(batch))
+    run('decode_batch.python.1000', lambda: modbus.decode_batch_python(batch, SydpowerModbus.FUNC_READ_INPUT_REGISTERS, 0, IREG_COUNT), len(batch))
+    run('format.dec',             lambda: format_dec(1234))
+    run('format.dec_hex',         lambda: format_dec_hex(1234))
+    run('format.dec_hex_bin',     lambda: format_dec_hex_bin(1234))
+    run('format.iStatusBits',     lambda: FORMATTER['iStatusBits'](0x1e8c))
 
-        self.last_request  = time.time()
-        self.last_read_response = "none"
-        
-        iregs, hregs = parse_register_names( args.target or ["ALL"] )
-        
-        print("Tracing inputs: ",   " ".join(iregs) ) 
-        print("Tracing holdings: ", " ".join(hregs) )
+    # Create an application bound to a loopback client. 
+    def loopback_app(cls, **kwargs):
+        app_args = argparse.Namespace(**vars(args))
+        app_args.fleet  = True
+        app_args.output = os.devnull
+        app_args.format = args.format
+        app_args.flush_records = 0
+        app_args.flush_ms = 0.0
+        app_args.replay = None
+        # The loopback client posts the events from the main thread so it must never block 
+        app_args.queue_size = 0
+        for k, v in kwargs.items():
+            setattr(app_args, k, v)
+        app = cls(app_args)
+        client = LoopbackMqttClient(app)
+        app.on_connect(None, None, None)
+        return app, client
 
+    # trace_response() alone, with and without changes
+    app, client = loopback_app(AppTrace, target=['ALL'], timestamp=False, query=False, interval=1.0, history=None)
+    device = app.add_device(FrameGenerator.mac(0))
+    frame = modbus.decode_frame(iframe, 'response')
+    app.trace_response(device, frame)
+    run('trace_response.unchanged', lambda: app.trace_response(device, frame))
+    frames = [ modbus.decode_frame(gen.ReadInputRegisters(), 'response') for _ in range(64) ]
+    def changed():
+        for f in frames:
+            app.trace_response(device, f)
+    run('trace_response.changed', changed, len(frames))
+
+    # End-to-end: a fleet of devices publishing full 0x04 and 0x03 responses
+    traffic = []
+    for n in range(args.devices):
+        mac = FrameGenerator.mac(n)
+        traffic.append( (mac+'/'+TOPIC_SUFFIX_RESPONSE_04, gen.ReadInputRegisters()) )
+        traffic.append( (mac+'/'+TOPIC_SUFFIX_RESPONSE, gen.ReadHoldingRegisters()) )
         
-        self.iregs = { k: None for k in iregs }
-        self.hregs = { k: None for k in hregs }
-               
-    def on_tic(self):
+    def end_to_end(client):
+        def f():
+            for topic, payload in traffic:
+                client.publish(topic, payload)
+            client.drain()
+        return f
+            
+    app, client = loopback_app(AppMonitor)
+    run('e2e.monitor', end_to_end(client), len(traffic))
+    app.output.close()
 
-        if self.args.query:
-            #
-            # Query input and holding registers at regular interval but
-            # not too fast because the device can only process one request
-            # at a time.
-            #
-            if time.time() > self.last_request + 1.0 :
-                # Alternate between ReadHoldingRegisters and ReadInputRegisters
-                if self.last_read_response == "ReadHoldingRegisters":                    
-                    self.publish_ReadInputRegisters(0,IREG_COUNT)
-                else:
-                    self.publish_ReadHoldingRegisters(0,HREG_COUNT)
+    app, client = loopback_app(AppTrace, target=['ALL'], timestamp=True, query=False, interval=1.0, history=None)
+    run('e2e.trace', end_to_end(client), len(traffic))
+    app.output.close()
+
+    report = { 'python'   : platform.python_version(),
+               'platform' : platform.platform(),
+               'time'     : time.time(),
+               'duration' : duration,
+               'devices'  : args.devices,
+               'format'   : args.format,
+               'results'  : results }
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text+'\n')
+    else:
+        print(text)
         
-                   
+    
+# The state of a device simulated by AppSimulate
+class SimulatedDevice:
+
+    __slots__ = ( 'mac', 'iregs', 'hregs', 'busy_until', 'next_report' )
+
+    def __init__(self, mac:str, next_report:float):
+        self.mac = mac
+        self.iregs = FrameGenerator.initial_iregs()
+        self.hregs = FrameGenerator.initial_hregs()
+        self.busy_until = 0.0           # the device ignores requests until then 
+        self.next_report = next_report  # when the next full 0x04 response is published
+
+
+#
+# Simulate devices speaking the Sydpower MODBUS-over-MQTT protocol.
+#
+# Each device answers the requests received on MAC/client/request/data
+# after a random latency and publishes a retained full 0x04 response once
+# per period. As described in MQTT-MODBUS.md, a device ignores requests
+# received while a previous one is still being processed. Requests can
+# also be dropped at random (see args.drop_rate).
+#
+# Holding registers that control the outputs also update iStatusBits.
+#
+class AppSimulate(SimpleMqttApp):
+
+    # Holding registers accepted by WriteHoldingRegister 
+    WRITABLE = set([ 24, 25, 26, 27, 56, 57, 59, 60, 61, 62, 63, 66, 67, 68 ])
+
+    # The bits of iStatusBits controlled by some holding registers 
+    STATUS_BITS = { 24: 1<<9, 25: 1<<10, 26: (1<<11)|(1<<2), 27: 1<<12 }
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.modbus = SydpowerModbus()
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.tic_interval = 0.01
+        self.latency = args.latency / 1000.0
+        self.jitter  = args.jitter / 1000.0
+        self.topics = [ '+/'+TOPIC_SUFFIX_REQUEST ]
+        self.responses : list[tuple] = []    # heap of (time, seq, topic, payload, retain) 
+        self.seq = 0
+        self.stats = collections.Counter()
+
+        if args.mac and args.devices == 1:
+            macs = [ args.mac.upper() ]
+        else:
+            macs = [ FrameGenerator.mac(n) for n in range(args.devices) ]
+        now = time.time()
+        # Spread the periodic reports over the period 
+        self.devices = { mac: SimulatedDevice(mac, now + self.random.random()*args.period) for mac in macs }
+        print("# simulating {} devices from {} to {}".format(len(macs), macs[0], macs[-1]), flush=True)
+
     def on_connect(self, flags, reason_code, properties):
         for t in self.topics:
-            print("# subscribing to "+t)
+            print("# subscribing to "+t, flush=True)
             self.subscribe(t)
-    
+
+    def send(self, delay:float, topic:str, payload:bytes, retain:bool=False):
+        self.seq += 1
+        heapq.heappush(self.responses, (time.time()+delay, self.seq, topic, payload, retain))
+
     def on_message(self, msg):
+        mac, _, suffix = msg.topic.partition('/')
+        device = self.devices.get(mac)
+        if device is None or suffix != TOPIC_SUFFIX_REQUEST:
+            return
+        self.stats['requests'] += 1
+        now = time.time()
+        if now < device.busy_until:
+            self.stats['busy'] += 1
+            return
+        if self.random.random() < self.args.drop_rate:
+            self.stats['dropped'] += 1
+            return
+        try:
+            func, args, payload, crc = self.modbus.decode(msg.payload, 'request', False)
+        except Exception:
+            self.stats['invalid'] += 1
+            return
         
-        if msg.topic == self.TOPIC_REQUEST:
-            self.last_request  = time.time()
-        elif msg.topic in [ self.TOPIC_RESPONSE , self.TOPIC_RESPONSE_04 ] :
-            func, args, payload, crc = self.modbus.decode(msg.payload,'response', False)
-            self.trace_response(func,args,payload)
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        device.busy_until = now + delay
+        func = msg.payload[1]
+        topic = mac+'/'+TOPIC_SUFFIX_RESPONSE
+        retain = False
+        if func in (SydpowerModbus.FUNC_READ_HOLDING_REGISTERS, SydpowerModbus.FUNC_READ_INPUT_REGISTERS):
+            start, count = args
+            if func == SydpowerModbus.FUNC_READ_HOLDING_REGISTERS:
+                values = device.hregs
+            else:
+                values = FrameGenerator.drift(self.random, device.iregs)
+                topic = mac+'/'+TOPIC_SUFFIX_RESPONSE_04
+                retain = True
+            if count < 1 or start+count > len(values):
+                response = self.modbus.encode_ErrorResponse(func, 2)  # Illegal data address
+            else:
+                response = self.modbus.encode_ReadRegistersResponse(func, start, values[start:start+count])
+        elif func == SydpowerModbus.FUNC_WRITE_HOLDING_REGISTER:
+            index, value = args
+            if index in self.WRITABLE:
+                device.hregs[index] = value
+                bits = self.STATUS_BITS.get(index)
+                if bits:
+                    status = device.iregs[41] & ~bits
+                    device.iregs[41] = status | bits if value else status
+            # The response is always an echo of the request
+            response = msg.payload
         else:
-            pass
+            response = self.modbus.encode_ErrorResponse(func, 1)  # Illegal function
+        self.stats['answered'] += 1
+        self.send(delay, topic, bytes(response), retain)
+
+    def on_tic(self):
+        now = time.time()
+        while self.responses and self.responses[0][0] <= now:
+            _, _, topic, payload, retain = heapq.heappop(self.responses)
+            self.publish(topic, payload, retain=retain)
+        for device in self.devices.values():
+            if now >= device.next_report:
+                device.next_report += self.args.period
+                values = FrameGenerator.drift(self.random, device.iregs)
+                msg = self.modbus.encode_ReadRegistersResponse(SydpowerModbus.FUNC_READ_INPUT_REGISTERS, 0, values)
+                self.publish(device.mac+'/'+TOPIC_SUFFIX_RESPONSE_04, bytes(msg), retain=True)
+                self.stats['reports'] += 1
+
+    def run(self):
+        try:
+            return super().run()
+        finally:
+            print("# " + " ".join( "{}={}".format(k, v) for k, v in sorted(self.stats.items()) ), flush=True)
+
+            
+# Parse a time given as seconds since epoch or in ISO-8601 format 
+def parse_time(text:str) -> float:
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        print("Error: Invalid time '"+text+"'")
+        sys.exit(1)
+
+# Convert a pcap file or a mosquitto_sub dump to a capture file
+def import_command(args):
+
+    try:
+        reader = open_capture(args.source, args.mqtt_port, args.direction)
+    except Exception as e:
+        print("Error: "+str(e))
+        sys.exit(1)
+    if isinstance(reader, CaptureReader):
+        print("Error: '"+args.source+"' is already a capture file")
+        sys.exit(1)
+    try:
+        writer = CaptureWriter(args.file)
+    except Exception as e:
+        print("Error: "+str(e))
+        sys.exit(1)
+    for msg in reader:
+        writer.write(msg.topic, msg.payload, msg.retain, msg.time)
+    writer.close()
+    reader.close()
+    print("# {}: {}".format(args.source, reader.summary()))
+    print("# {} messages written to {}".format(writer.count, args.file))
+
+#
+# The statistics of the registers of a device for the analyze command.
+#
+# The state of the device (the input registers, the holding registers and
+# the 16 bits of iStatusBits) after each read response is a sample. The
+# samples are processed by chunks and only sums are kept so the memory use
+# does not depend on the number of samples. For each pair of columns (i,j)
+# and over the samples where both are known:
+#  - sx[i,j], sxx[i,j] and sxy[i,j] are the sums of x[i], x[i]*x[i] and
+#    x[i]*x[j]. The values are shifted by a reference value per column to
+#    preserve the precision (that does not change the correlations).
+#  - cochange[i,j] is the number of consecutive samples where both changed
+#    (so cochange[i,i] is the number of changes of i). That matrix is shared
+#    by all devices (see process).
+#
+# A register stays known once known so the number of samples where both i
+# and j are known is min(known[i], known[j]).
+#
+# The three sums cost about 750 KB per device (3 matrices of 176x176
+# float64) until the end of the capture. They are then pooled with
+# pool_covariances() and released. 
+#
+ANALYZE_COLUMNS = IREG_COUNT + HREG_COUNT + 16
+
+class AnalyzeDevice:
+
+    CHUNK = 4096    # the number of responses processed at once
+
+    def __init__(self, mac:str):
+        size = ANALYZE_COLUMNS
+        self.mac = mac
+        self.pending : list[tuple[float,int,int,int,bytes]] = []  # (time, code, start, count, payload)
+        self.last = numpy.full(size, numpy.nan)   # the state after the last sample 
+        self.ref  = numpy.full(size, numpy.nan)
+        self.known = numpy.zeros(size)            # the number of samples where known
+        self.sx   = numpy.zeros((size, size))
+        self.sxx  = numpy.zeros((size, size))
+        self.sxy  = numpy.zeros((size, size))
+        self.transitions = numpy.zeros(size)      # the number of consecutive samples where known
+        self.min  = numpy.full(size, numpy.nan)
+        self.max  = numpy.full(size, numpy.nan)
+        self.samples = 0
+        self.start : float | None = None
+        self.end   : float | None = None
+
+    # Process the pending responses.
+    #
+    # signed is the list of the columns of the signed registers, status the
+    # column of iStatusBits (or None) and cochange the shared co-change
+    # matrix.
+    #
+    def process(self, modbus:SydpowerModbus, signed:list[int], status:int|None, cochange):
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = []
+        if self.start is None:
+            self.start = pending[0][0]
+        self.end = pending[-1][0]
+
+        # One row per response (after the current state) with the registers it provides
+        X = numpy.full((len(pending)+1, ANALYZE_COLUMNS), numpy.nan)
+        X[0] = self.last
+        groups = collections.defaultdict(list)
+        for row, (t, code, start, count, payload) in enumerate(pending, 1):
+            groups[code, start, count].append(row)
+        for (code, start, count), rows in groups.items():
+            values, valid = modbus.decode_batch([ pending[row-1][4] for row in rows ], code, start, count)
+            values = values.astype(numpy.float64)
+            values[~valid] = numpy.nan
+            column = start if code == SydpowerModbus.FUNC_READ_INPUT_REGISTERS else IREG_COUNT+start
+            X[rows, column:column+count] = values
+        if signed:
+            X[:, signed] -= 65536.0 * (X[:, signed] >= 32768)
+
+        # Forward fill the registers that were not part of a response and
+        # drop the invalid responses
+        known = ~numpy.isnan(X)
+        updated = numpy.concatenate( ([True], known[1:].any(axis=1)) )
+        index = numpy.where(known, numpy.arange(len(X))[:,None], 0)
+        numpy.maximum.accumulate(index, axis=0, out=index)
+        X = numpy.take_along_axis(X, index, axis=0)[updated]
+        if status is not None:
+            value = X[:, status]
+            bits = (numpy.nan_to_num(value).astype(numpy.int64)[:,None] >> numpy.arange(16)) & 1
+            X[:, IREG_COUNT+HREG_COUNT:] = numpy.where(numpy.isnan(value)[:,None], numpy.nan, bits)
+
+        Y = X[1:]
+        if not len(Y):
+            return
+        rows = len(Y)
+        self.samples += rows
+        unset = numpy.isnan(self.ref)
+        self.ref[unset] = Y[-1, unset]
+        # A register stays known once known so the samples where both i and
+        # j are known are the rows from overlap[i,j]. Only the columns that
+        # are not constantly equal to their reference value contribute to
+        # the sums.
+        M = ~numpy.isnan(Y)
+        first = numpy.where(M[-1], M.argmax(axis=0), rows)
+        self.known += rows - first
+        Z = numpy.where(M, Y - self.ref, 0.0)
+        varying = numpy.flatnonzero(Z.any(axis=0))
+        if len(varying):
+            Z = Z[:, varying]
+            lanes = numpy.arange(len(varying))[:,None]
+            rows_from = numpy.maximum(first[varying,None], first[None,:])
+            for sums, values in ( (self.sx, Z), (self.sxx, Z*Z) ):
+                # suffix[r] is the sum of the rows from r
+                suffix = numpy.zeros((rows+1, len(varying)))
+                suffix[:rows] = numpy.cumsum(values[::-1], axis=0)[::-1]
+                sums[varying] += suffix[rows_from, lanes]
+            self.sxy[numpy.ix_(varying, varying)] += Z.T @ Z
+        both = M & ~numpy.isnan(X[:-1])
+        changed = both & (Y != X[:-1])
+        self.transitions += both.sum(axis=0)
+        varying = numpy.flatnonzero(changed.any(axis=0))
+        if len(varying):
+            C = changed[:, varying].astype(numpy.float64)
+            cochange[numpy.ix_(varying, varying)] += C.T @ C
+        self.min = numpy.fmin(self.min, numpy.fmin.reduce(Y, axis=0))
+        self.max = numpy.fmax(self.max, numpy.fmax.reduce(Y, axis=0))
+        self.last = X[-1]
+
+    # Add the covariances and the variances for each pair (i,j) over the
+    # samples where both are known to cov and var, then release the sums.
+    def pool_covariances(self, cov, var):
+        n = numpy.minimum.outer(self.known, self.known)
+        n[n == 0] = numpy.inf
+        cov += self.sxy - self.sx * self.sx.T / n
+        var += self.sxx - self.sx * self.sx / n
+        self.sx = self.sxx = self.sxy = None
+
+
+# The name of a column of AnalyzeDevice
+def analyze_column_name(column:int) -> str:
+    if column < IREG_COUNT:
+        return ireg_index_to_name(column)
+    if column < IREG_COUNT+HREG_COUNT:
+        return hreg_index_to_name(column-IREG_COUNT)
+    bit = column-IREG_COUNT-HREG_COUNT
+    flag = STATUS_BIT_FLAGS.get(bit)
+    return "iStatusBits[{}]".format(bit) + ("="+flag if flag else "")
+
+#
+# Compute the change frequency of the registers and the correlations and
+# co-changes between all pairs of registers (and the bits of iStatusBits)
+# from a capture file in order to find the meaning of unknown registers.
+#
+# The correlations are Pearson correlations of the values over the samples
+# where both registers are known. With several devices, the values are
+# centered on the mean of each device. The co-change of a pair is the
+# number of samples where both changed divided by the number of samples
+# where at least one changed.
+#
+def analyze_command(args):
+
+    if numpy is None:
+        print("Error: The analyze command requires NumPy (https://numpy.org)")
+        sys.exit(1)
+    if not args.fleet and not args.mac:
+        print("Error: no device mac address was specified")
+        sys.exit(1)
+    try:
+        reader = open_capture(args.file, args.mqtt_port)
+    except Exception as e:
+        print("Error: "+str(e))
+        sys.exit(1)
+
+    macs = None if args.fleet else set(args.mac.upper().split(','))
+    iregs, hregs = parse_register_names(args.target or ["ALL"])
+    targets = set( ireg_name_to_index(name) for name in iregs ) | set( IREG_COUNT+hreg_name_to_index(name) for name in hregs )
+    unknown = set( ireg_name_to_index(name) for name in IREG_SETS['iOTHER'] ) | set( IREG_COUNT+hreg_name_to_index(name) for name in HREG_SETS['hOTHER'] )
+    signed  = sorted( ireg_name_to_index(name) if name in IREG_SETS['iALL'] else IREG_COUNT+hreg_name_to_index(name)
+                      for name in REGISTER_SIGNED if name in IREG_SETS['iALL'] or name in HREG_SETS['hALL'] )
+    status  = ireg_name_to_index('iStatusBits')
+    
+    modbus = SydpowerModbus()
+    responses = ( TOPIC_SUFFIX_RESPONSE, TOPIC_SUFFIX_RESPONSE_04 )
+    counts = { SydpowerModbus.FUNC_READ_INPUT_REGISTERS: IREG_COUNT,
+               SydpowerModbus.FUNC_READ_HOLDING_REGISTERS: HREG_COUNT }
+    devices : dict[str,AnalyzeDevice] = {}
+    cochange = numpy.zeros((ANALYZE_COLUMNS, ANALYZE_COLUMNS))
+    pending = 0
+    for msg in reader:
+        mac, _, suffix = msg.topic.partition('/')
+        if suffix not in responses or (macs is not None and mac not in macs):
+            continue
+        payload = msg.payload
+        if len(payload) < 10 or payload[1] not in counts:
+            continue
+        code, start, count = MODBUS_HEADER.unpack_from(payload)
+        if count == 0 or start+count > counts[code] or len(payload) != 8+2*count:
+            continue
+        device = devices.get(mac)
+        if device is None:
+            device = devices[mac] = AnalyzeDevice(mac)
+        device.pending.append( (msg.time, code, start, count, payload) )
+        pending += 1
+        if len(device.pending) >= AnalyzeDevice.CHUNK:
+            pending -= len(device.pending)
+            device.process(modbus, signed, status, cochange)
+        elif pending >= 16*AnalyzeDevice.CHUNK:
+            for device in devices.values():
+                device.process(modbus, signed, status, cochange)
+            pending = 0
+    reader.close()
+    for device in devices.values():
+        device.process(modbus, signed, status, cochange)
+
+    devices = { mac: device for mac, device in devices.items() if device.samples }
+    if not devices:
+        print("Error: No read responses found in '"+args.file+"'")
+        sys.exit(1)
+    
+    # Pool the statistics of all devices
+    cov = numpy.zeros((ANALYZE_COLUMNS, ANALYZE_COLUMNS))
+    var = numpy.zeros((ANALYZE_COLUMNS, ANALYZE_COLUMNS))
+    transitions = sum( device.transitions for device in devices.values() )
+    for device in devices.values():
+        device.pool_covariances(cov, var)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        r = cov / numpy.sqrt(var * var.T)
+        changes = numpy.diag(cochange)
+        jaccard = cochange / (changes[:,None] + changes[None,:] - cochange)
+    r = numpy.nan_to_num(r)
+    jaccard = numpy.nan_to_num(jaccard)
+    low  = numpy.fmin.reduce([ device.min for device in devices.values() ])
+    high = numpy.fmax.reduce([ device.max for device in devices.values() ])
+
+    samples = sum( device.samples for device in devices.values() )
+    start = min( device.start for device in devices.values() )
+    end   = max( device.end for device in devices.values() )
+    print("# {} samples of {} devices from {} to {}".format(samples, len(devices), timestamp(start), timestamp(end)))
 
+    registers = IREG_COUNT + HREG_COUNT
+    active = [ k for k in range(ANALYZE_COLUMNS) if changes[k] > 0 ]
+    print("# Change frequency (changes per sample)")
+    for k in active:
+        if k in targets:
+            print("{:<24s} {:>9d} {:>7.3f} {:>7g} {:>7g}".format(analyze_column_name(k), int(changes[k]),
+                                                              changes[k]/transitions[k], low[k], high[k]))
+    constant = [ analyze_column_name(k) for k in sorted(targets) if transitions[k] > 0 and changes[k] == 0 ]
+    print("# {} constant registers".format(len(constant)))
     
-    def trace_response(self, func: str, args : modbus_values, payload):
-        now = timestamp()
-
-        if func=="ReadInputRegisters" :
-            self.last_read_response=func
-            start = args[0]
-            for i in range(args[1]):
-                reg = ireg_index_to_name(start+i)
-                if reg in self.iregs:
-                    old = self.iregs[reg]
-                    new = payload[i]
-                    if old != new:
-                        self.iregs[reg] = new
-                        if self.args.timestamp:
-                            print(now,'',end='')
-                        fmtr=FORMATTER.get(reg,format_dec)
-                        print(reg,"=",fmtr(new),flush = True)
-
-                        
-        elif func=="ReadHoldingRegisters":
-            self.last_read_response=func
-            start = args[0]
-            for i in range(args[1]):
-                reg = hreg_index_to_name(start+i)
-                if reg in self.hregs:
-                    old = self.hregs[reg]
-                    new = payload[i]
-                    if old != new:
-                        self.hregs[reg] = new
-                        if self.args.timestamp:
-                            print(now,'',end='')
-                        fmtr=FORMATTER.get(reg,format_dec)
-                        print(reg,"=",fmtr(new),flush = True)
+    # The pairs of registers with at least one target and (unless --all)
+    # at least one unknown register
+    pairs = [ (i, j) for n, i in enumerate(active) if i < registers for j in active[n+1:] if j < registers
+              if (i in targets or j in targets) and (args.all or i in unknown or j in unknown) ]
+    def display(title, pairs, key, threshold):
+        selected = sorted( (p for p in pairs if key(p) >= threshold), key=key, reverse=True )[:args.top]
+        print("# {} ({} pairs)".format(title, len(selected)))
+        for i, j in selected:
+            print("{:<24s} {:<24s} r={:+.3f} co-change={:.3f}".format(analyze_column_name(i), analyze_column_name(j), r[i,j], jaccard[i,j]))
+    display("Correlated registers", pairs, lambda p: abs(r[p]), args.min_corr)
+    display("Co-changing registers", pairs, lambda p: jaccard[p], args.min_cochange)
+    bits = [ (i, j) for i in active if i < registers and i in targets and (args.all or i in unknown) for j in active if j >= registers ]
+    display("Status bits", bits, lambda p: max(abs(r[p]), jaccard[p]), min(args.min_corr, args.min_cochange))
+
+    # The best explanation of each unknown register among the named
+    # registers and the bits of iStatusBits
+    print("# Candidates for unknown registers")
+    named = [ k for k in active if k not in unknown ]
+    for i in active:
+        if i in unknown and i in targets:
+            others = [ k for k in named if k != i ]
+            if not others:
+                continue
+            best_r = max(others, key=lambda k: abs(r[i,k]))
+            best_c = max(others, key=lambda k: jaccard[i,k])
+            print("{:<24s} r={:+.3f} {:<24s} co-change={:.3f} {}".format(analyze_column_name(i), r[i,best_r], analyze_column_name(best_r),
+                                                                          jaccard[i,best_c], analyze_column_name(best_c)))
+
+# Query a register history (see HistoryStore and trace --history)
+def history_command(args):
+
+    if not os.path.isdir(args.dir):
+        print("Error: No history in '"+args.dir+"'")
+        sys.exit(1)
+    if not args.mac:
+        print("Error: no device mac address was specified")
+        sys.exit(1)
+        
+    store = HistoryStore(args.dir)
+    mac = args.mac.upper()
+    iregs, hregs = parse_register_names( args.target or ["ALL"] )
+    if args.units:
+        enable_scaled_formatters()
+    banks = [ ('i', 'input', iregs, ireg_name_to_index),
+              ('h', 'holding', hregs, hreg_name_to_index) ]
+
+    if args.at:
+        # Display the full state at a given time
+        t = parse_time(args.at)
+        for bank, kind, names, to_index in banks:
+            if not names:
+                continue
+            state = store.state_at(mac, bank, t)
+            if state is None:
+                print("# no {} registers at that time".format(kind))
+                continue
+            print("# {} registers at {}".format(kind, timestamp(state[0])))
+            for name in names:
+                fmtr=FORMATTER.get(name,format_dec)
+                print(name,"=",fmtr(state[1][to_index(name)]))
+    else:
+        # Display the changes between two times 
+        t1 = parse_time(args.start) if args.start else 0.0
+        t2 = parse_time(args.end) if args.end else float('inf')
+        changes = []
+        for bank, kind, names, to_index in banks:
+            for name in names:
+                last = None
+                for t, v in store.series(mac, bank, to_index(name), t1, t2):
+                    if v != last:
+                        changes.append( (t, to_index(name), name, v) )
+                        last = v
+        changes.sort()
+        for t, _, name, v in changes:
+            fmtr=FORMATTER.get(name,format_dec)
+            print(timestamp(t),name,"=",fmtr(v))
+
+
+#
+# A statistical profiler with the same interface as cProfile.Profile.
+#
+# A thread samples the stack of the profiled thread (the one calling 
+# enable) every 'interval' seconds and counts, for each function, the
+# samples where it is executing (self) or on the stack (total). The
+# overhead is low and independent of the number of calls so that can be
+# used on a busy fleet. dump_stats() writes a text report.
+#
+class SamplingProfiler:
+
+    def __init__(self, interval:float=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = collections.Counter()
+        self.total_counts = collections.Counter()
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enable(self):
+        self.thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
 
+    def disable(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
 
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            code = frame.f_code
+            self.self_counts[code] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                if code not in seen:
+                    seen.add(code)
+                    self.total_counts[code] += 1
+                frame = frame.f_back
+
+    def dump_stats(self, filename:str):
+        samples = max(self.samples, 1)
+        with open(filename, 'w') as f:
+            print("# {} samples every {}".format(self.samples, format_duration(self.interval)), file=f)
+            print("#  self%  total%  function", file=f)
+            for code, n in sorted(self.total_counts.items(), key=lambda item: (-self.self_counts[item[0]], -item[1])):
+                print("{:7.1f} {:7.1f}  {} ({}:{})".format(100.0*self.self_counts[code]/samples, 100.0*n/samples,
+                                                          code.co_name, code.co_filename, code.co_firstlineno), file=f)
 
     
 def main():
@@ -777,38 +5476,266 @@ def main():
     parser.add_argument('-p', '--port'     , dest='mqtt_port', default=1883, type=int)
     parser.add_argument('-u', '--username' , dest='mqtt_username')
     parser.add_argument('-P', '--password' , dest='mqtt_password')
-    parser.add_argument('-M', '--mac'      , dest='mac', default=DEFAULT_MAC, help='The device MAC address used as MQTT prefix')
+    parser.add_argument('-M', '--mac'      , dest='mac', default=DEFAULT_MAC,
+                        help='The device MAC address used as MQTT prefix (or a comma separated list)')
+    parser.add_argument('-m', '--model'    , dest='model', default=os.getenv('SYDPOWER_MODEL',None),
+                        help='The device model: a schema file or the name of a schema in the models directory')
+    parser.add_argument('-F', '--fleet'    , dest='fleet', action='store_true',
+                        help='Serve all devices found on the MQTT server (--mac is ignored)')
+    parser.add_argument('-E', '--engine'   , dest='engine', default='thread', choices=['thread','asyncio'],
+                        help='The event loop engine (default thread)')
+    parser.add_argument('-j', '--workers'  , dest='workers', default=1, type=int, metavar='N',
+                        help='Process the messages of the fleet with N worker processes (monitor and trace only)')
+    parser.add_argument('-R', '--replay'   , dest='replay', metavar='FILE',
+                        help='Replay the messages from a capture file instead of connecting to the MQTT server')
+    parser.add_argument('-S', '--speed'    , dest='speed', default=1.0, type=float, metavar='FACTOR',
+                        help='The replay speed factor or 0 for as fast as possible (default 1.0)')
+    parser.add_argument('--request-timeout', dest='request_timeout', default=2.0, type=float, metavar='SECONDS',
+                        help='Delay before a request without response is sent again (default 2.0)')
+    parser.add_argument('--request-retries', dest='request_retries', default=2, type=int, metavar='N',
+                        help='Number of times a request without response is sent again (default 2)')
+    parser.add_argument('--reconnect-min', dest='reconnect_min', default=1.0, type=float, metavar='SECONDS',
+                        help='Initial delay before reconnecting to the MQTT server (default 1)')
+    parser.add_argument('--reconnect-max', dest='reconnect_max', default=60.0, type=float, metavar='SECONDS',
+                        help='Maximal delay before reconnecting to the MQTT server (default 60)')
+    parser.add_argument('--queue-size', dest='queue_size', default=10000, type=int, metavar='N',
+                        help='Maximal number of received messages waiting to be processed or 0 for unlimited (default 10000)')
+    parser.add_argument('--queue-policy', dest='queue_policy', default='block', choices=QUEUE_POLICIES,
+                        help='What to do with new messages when the queue is full (default block)')
+    parser.add_argument('--stats', dest='stats', type=float, metavar='SECONDS',
+                        help='Print processing statistics every SECONDS seconds (0 for only when stopping)')
+    parser.add_argument('--profile', dest='profile', metavar='FILE',
+                        help='Profile the command and write the results to FILE')
+    parser.add_argument('--profile-mode', dest='profile_mode', default='cprofile', choices=['cprofile','sample'],
+                        help='cprofile (deterministic, see the pstats module) or sample (low overhead, text report)')
     
     subparsers = parser.add_subparsers(dest='command',required=True)
     
+    # Options of the commands using an OutputSink
+    def add_output_arguments(sub):
+        sub.add_argument('-o', '--output', metavar='FILE',
+                         help="write the records to that file (default stdout)")
+        sub.add_argument('-f', '--format', default='text', choices=OUTPUT_FORMATS,
+                         help="the output format (default text)")
+        sub.add_argument('--flush-records', default=0, type=int, metavar='N',
+                         help="flush the output every N records")
+        sub.add_argument('--flush-ms', default=0.0, type=float, metavar='MS',
+                         help="flush the output every MS milliseconds")
+
+    # Options of parse_filter_rules 
+    def add_filter_arguments(sub):
+        sub.add_argument('-d', '--deadband', action='append', metavar='[NAMES=]N[%]',
+                         help="ignore changes smaller than N (or N percents) since the last record")
+        sub.add_argument('--min-interval', action='append', metavar='[NAMES=]SECONDS',
+                         help="delay records so that they are at least SECONDS apart")
+        sub.add_argument('--coalesce', action='append', metavar='[NAMES=]SECONDS',
+                         help="merge the changes during SECONDS into a single record")
+    
     sub = subparsers.add_parser('monitor', help='Monitor all MQTT messages')
+    add_output_arguments(sub)
 
     sub = subparsers.add_parser('trace', help='Trace changes to registers')
+    add_output_arguments(sub)
     sub.add_argument('-t', '--timestamp', action='store_true',
                      help="prefix each change by a timestamp")
+    sub.add_argument('--units', action='store_true',
+                     help="also display the physical value of the scaled and signed registers (text format)")
+    sub.add_argument('-q', '--query', action='store_true',
+                     help="query registers every few seconds")
+    sub.add_argument('-i', '--interval', default=1.0, type=float, metavar='SECONDS',
+                     help="minimal delay between two queries to the same device (default 1.0)")
+    sub.add_argument('--history', metavar='DIR',
+                     help="store the history of all registers in that directory")
+    sub.add_argument('--request-cost', default=READ_REQUEST_COST, type=int, metavar='N',
+                     help="the cost of a read request in registers when planning queries (default {})".format(READ_REQUEST_COST))
+    sub.add_argument('--partial-inputs', action='store_true',
+                     help="only query the traced input registers instead of all of them")
+    sub.add_argument('-a', '--adaptive', action='store_true',
+                     help="query the registers that rarely change less often")
+    sub.add_argument('--max-interval', default=60.0, type=float, metavar='SECONDS',
+                     help="maximal delay between two identical queries in adaptive mode (default 60)")
+    add_filter_arguments(sub)
+    
+    sub.add_argument('target', metavar='NAME', nargs='*',
+                     action='extend',
+                     help="a register or register group (default ALL)")
+    
+    sub = subparsers.add_parser('exporter', help='Export the registers to Prometheus')
+    sub.add_argument('-l', '--listen', default='127.0.0.1:9755', metavar='[HOST:]PORT',
+                     help="the address of the HTTP server (default 127.0.0.1:9755)")
+    sub.add_argument('-q', '--query', action='store_true',
+                     help="query registers every few seconds")
+    sub.add_argument('-i', '--interval', default=1.0, type=float, metavar='SECONDS',
+                     help="minimal delay between two queries to the same device (default 1.0)")
+    sub.add_argument('target', metavar='NAME', nargs='*',
+                     action='extend',
+                     help="a register or register group (default NAMED)")
+
+    sub = subparsers.add_parser('bridge', help='Republish the registers for Home Assistant')
+    sub.add_argument('--prefix', default='sydpower', metavar='TOPIC',
+                     help="the prefix of the state topics (default sydpower)")
+    sub.add_argument('--discovery', default='homeassistant', metavar='TOPIC',
+                     help="the Home Assistant discovery prefix (default homeassistant)")
+    add_filter_arguments(sub)
     sub.add_argument('-q', '--query', action='store_true',
                      help="query registers every few seconds")
+    sub.add_argument('-i', '--interval', default=1.0, type=float, metavar='SECONDS',
+                     help="minimal delay between two queries to the same device (default 1.0)")
+    sub.add_argument('target', metavar='NAME', nargs='*',
+                     action='extend',
+                     help="a register or register group (default NAMED)")
+
+    sub = subparsers.add_parser('state-server', help='Serve the last known state of the devices over HTTP')
+    sub.add_argument('-l', '--listen', default='127.0.0.1:9756', metavar='[HOST:]PORT|unix:PATH',
+                     help="the address of the HTTP server or a Unix socket (default 127.0.0.1:9756)")
+    sub.add_argument('-r', '--refresh', default=0.0, type=float, metavar='SECONDS',
+                     help="read the registers older than SECONDS or of unknown age (default 0 for never)")
+
+    sub = subparsers.add_parser('set', help='Write and verify holding registers')
+    sub.add_argument('-w', '--wait', default=5.0, type=float, metavar='SECONDS',
+                     help="in fleet mode, how long to wait for devices (default 5)")
+    sub.add_argument('assignment', metavar='NAME=VALUE', nargs='+',
+                     help="a holding register and its new value")
+
+    sub = subparsers.add_parser('probe', help='Measure the response latency and the safe request rate of the devices')
+    sub.add_argument('-n', '--requests', default=20, type=int, metavar='N',
+                     help="number of requests of each step (default 20)")
+    sub.add_argument('--counts', default='1,10,40,80', metavar='N,...',
+                     help="the register counts of the latency steps (default 1,10,40,80)")
+    sub.add_argument('--spacings', default='0.5,0.2,0.1,0.05,0.02,0', metavar='SECONDS,...',
+                     help="the delays between a response and the next request (default 0.5,0.2,0.1,0.05,0.02,0)")
+    sub.add_argument('--intervals', default='1,0.5,0.3,0.2,0.1,0.05', metavar='SECONDS,...',
+                     help="the intervals between requests sent without waiting for the responses (default 1,0.5,0.3,0.2,0.1,0.05)")
+    sub.add_argument('--max-loss', default=0.05, type=float, metavar='P',
+                     help="the maximal loss rate of a safe delay (default 0.05)")
+    sub.add_argument('-w', '--wait', default=5.0, type=float, metavar='SECONDS',
+                     help="in fleet mode, how long to wait for devices (default 5)")
+
+    sub = subparsers.add_parser('record', help='Record all MQTT messages in a capture file')
+    sub.add_argument('file', metavar='FILE',
+                     help="the capture file (appended if it already exists)")
     
+    sub = subparsers.add_parser('import', help='Convert a pcap file or a mosquitto_sub dump to a capture file')
+    sub.add_argument('-d', '--direction', default='to-broker', choices=PCAP_DIRECTIONS,
+                     help="the MQTT messages extracted from a pcap file (default to-broker). The broker port is given by --port")
+    sub.add_argument('source', metavar='SOURCE',
+                     help="the pcap file (not pcapng) or mosquitto_sub dump")
+    sub.add_argument('file', metavar='FILE',
+                     help="the capture file (appended if it already exists)")
+
+    sub = subparsers.add_parser('analyze', help='Find correlated and co-changing registers in a capture file (requires NumPy)')
+    sub.add_argument('-n', '--top', default=20, type=int, metavar='N',
+                     help="the maximum number of pairs in each section (default 20)")
+    sub.add_argument('-r', '--min-corr', default=0.9, type=float, metavar='R',
+                     help="the minimal absolute correlation of the displayed pairs (default 0.9)")
+    sub.add_argument('-c', '--min-cochange', default=0.5, type=float, metavar='R',
+                     help="the minimal co-change ratio of the displayed pairs (default 0.5)")
+    sub.add_argument('-a', '--all', action='store_true',
+                     help="also display the pairs of named registers")
+    sub.add_argument('file', metavar='FILE',
+                     help="the capture file (or pcap file or mosquitto_sub dump)")
+    sub.add_argument('target', metavar='NAME', nargs='*',
+                     action='extend',
+                     help="a register or register group (default ALL)")
+
+    sub = subparsers.add_parser('history', help='Query a register history recorded by trace --history')
+    sub.add_argument('-d', '--dir', required=True, metavar='DIR',
+                     help="the history directory")
+    sub.add_argument('--from', dest='start', metavar='TIME',
+                     help="display changes from that time (epoch or ISO-8601)")
+    sub.add_argument('--to', dest='end', metavar='TIME',
+                     help="display changes until that time (epoch or ISO-8601)")
+    sub.add_argument('--at', metavar='TIME',
+                     help="display the state of the registers at that time")
+    sub.add_argument('--units', action='store_true',
+                     help="also display the physical value of the scaled and signed registers")
     sub.add_argument('target', metavar='NAME', nargs='*',
                      action='extend',
                      help="a register or register group (default ALL)")
     
+    sub = subparsers.add_parser('bench', help='Benchmark the decoding, tracing and formatting code')
+    sub.add_argument('-d', '--duration', default=0.5, type=float, metavar='SECONDS',
+                     help="minimal duration of each benchmark (default 0.5)")
+    sub.add_argument('-n', '--devices', default=100, type=int, metavar='N',
+                     help="number of devices for the end-to-end benchmarks (default 100)")
+    sub.add_argument('-f', '--format', default='text', choices=OUTPUT_FORMATS,
+                     help="the output format for the end-to-end benchmarks (default text)")
+    sub.add_argument('-o', '--output', metavar='FILE',
+                     help="write the JSON results to that file (default stdout)")
+    sub.add_argument('--seed', default=0, type=int,
+                     help="the seed of the frame generator")
+    sub.add_argument('filter', metavar='NAME', nargs='*',
+                     help="only run the benchmarks whose name contains one of those strings")
+    
+    sub = subparsers.add_parser('simulate', help='Simulate devices for testing')
+    sub.add_argument('-n', '--devices', default=1, type=int, metavar='N',
+                     help="number of simulated devices (default 1, using --mac if specified)")
+    sub.add_argument('--latency', default=200.0, type=float, metavar='MS',
+                     help="average response latency in milliseconds (default 200)")
+    sub.add_argument('--jitter', default=50.0, type=float, metavar='MS',
+                     help="maximal deviation from the average latency in milliseconds (default 50)")
+    sub.add_argument('--drop-rate', default=0.0, type=float, metavar='P',
+                     help="probability that a request is ignored (default 0)")
+    sub.add_argument('--period', default=60.0, type=float, metavar='SECONDS',
+                     help="interval between two full 0x04 responses (default 60)")
+    sub.add_argument('--seed', default=None, type=int,
+                     help="the seed of the random generator")
+    
+    sub = subparsers.add_parser('schema', help='Display the register schema of the model (see --model)')
+    
     sub = subparsers.add_parser('help', help='More help')
     
     args = parser.parse_args(None)
 
     ##########################################################
 
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler() if args.profile_mode == 'sample' else cProfile.Profile()
+        profiler.enable()
+
     try:
         
+        if args.model:
+            load_schema(args.model).install()
+        
         cmd = args.command
-        if cmd in [ "monitor" ] :
+        if args.workers > 1:
+            if cmd not in SHARD_COMMANDS:
+                print("Error: --workers is only supported by the commands "+", ".join(SHARD_COMMANDS))
+                sys.exit(1)
+            AppShard(args).run()
+        elif cmd in [ "monitor" ] :
             AppMonitor(args).run()
         elif cmd in [ "trace" ] :
             AppTrace(args).run()
+        elif cmd in [ "record" ] :
+            AppRecord(args).run()
+        elif cmd in [ "probe" ] :
+            sys.exit(AppProbe(args).run())
+        elif cmd in [ "set" ] :
+            sys.exit(AppSet(args).run())
+        elif cmd in [ "exporter" ] :
+            AppExporter(args).run()
+        elif cmd in [ "bridge" ] :
+            AppBridge(args).run()
+        elif cmd in [ "state-server" ] :
+            AppStateServer(args).run()
+        elif cmd in [ "import" ] :
+            import_command(args)
+        elif cmd in [ "analyze" ] :
+            analyze_command(args)
+        elif cmd in [ "history" ] :
+            history_command(args)
+        elif cmd in [ "bench" ] :
+            bench_command(args)
+        elif cmd in [ "simulate" ] :
+            AppSimulate(args).run()
         elif cmd in [ "help" ] :
             help_register_names()
             help_iStatusBits()
+        elif cmd in [ "schema" ] :
+            print(json.dumps(schema_from_tables(), indent=2))
         else :
             print("ERROR: Unknown command "+cmd)
             sys.exit(-1)
@@ -816,5 +5743,11 @@ def main():
     except KeyboardInterrupt :
         pass
 
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print("# profile written to "+args.profile, file=sys.stderr)
+
 if __name__ == "__main__":
    main()